@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+""" Benchmark suite of the ENM pipeline stages.
+
+    Times contact build, Hessian assembly, eigensolve, matrix.eigenfacs
+    parsing, cooperativity and plotting on synthetic lattices and shells
+    (hundreds to ~100k beads) and on the synthetic fixture homodimer,
+    and appends results to a JSON lines history, so regressions show up
+    between versions (commits). Every stage runs in a forked process,
+    so that its peak RSS is not that of earlier stages.
+
+    Run from the root directory:
+    $ python -m benchmarks.run_benchmarks run --max-beads 10000
+    $ python -m benchmarks.run_benchmarks compare
+"""
+import click
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from os.path import join as join_paths
+import numpy as np
+import pandas as pd
+import src.instrument as instr
+import src.simulation.enm as enm
+import src.simulation.contacts as cnt
+import src.simulation.simulate_enm as se
+import src.data.process_wt as prowt
+import src.data.cooperativity as coop
+import benchmarks.systems as systems
+
+HISTORY_FILEPATH = join_paths(os.path.dirname(os.path.abspath(__file__)), "history.jsonl")
+
+SIZES = [300, 1000, 3000, 10000, 30000, 100000]
+STAGES = ['distance_matrix', 'contacts', 'hessian', 'sparse_hessian', 'eigensolve',
+          'sparse_eigensolve', 'parse', 'legacy_parse', 'cooperativity', 'plot']
+
+# Largest systems for stages that scale as N^2 (memory) or N^3 (time)
+MAX_DENSE_BEADS = 3000
+MAX_LEGACY_BEADS = 10000
+
+CUTOFF_RADIUS = 10.0
+NO_MODES = 20
+NO_STORED_MODES = 50
+
+
+@click.group()
+def main_commandline():
+    """ ENM pipeline benchmarks.
+    """
+
+@main_commandline.command(name='run')
+@click.option('--max-beads', type=int, default=10000, help="Largest synthetic system.")
+@click.option('--stages', default=",".join(STAGES), help="Comma-separated stages.")
+@click.option('--repeat', type=int, default=3, help="Repeats per benchmark (best is kept).")
+@click.option('--history', 'history_filepath', type=click.Path(), default=HISTORY_FILEPATH)
+def run_commandline(max_beads, stages, repeat, history_filepath):
+    """ Runs benchmarks and appends results to history.
+    """
+    records = run_benchmarks(max_beads=max_beads, stages=stages.split(","), repeat=repeat)
+    append_history(history_filepath, records)
+    columns = ['system', 'no_beads', 'stage', 'wall', 'peak_rss', 'stage_rss']
+    click.echo(pd.DataFrame(records)[columns].to_string(index=False))
+
+@main_commandline.command(name='compare')
+@click.option('--history', 'history_filepath', type=click.Path(exists=True), \
+    default=HISTORY_FILEPATH)
+@click.option('--threshold', type=float, default=1.2, help="Slowdown flagged as regression.")
+def compare_commandline(history_filepath, threshold):
+    """ Compares the latest two versions in history.
+    """
+    click.echo(compare(history_filepath, threshold=threshold).to_string(index=False))
+
+
+def benchmark_systems(max_beads):
+    """ Lists benchmark systems: (name, coordinates).
+    """
+    fixture = join_paths(systems.FIXTURES_DIR, "synthetic_dimer.2.pdb")
+    coords, _ = enm.load_beads(fixture, enm.parse_flags("-ca -het"))
+    bench_systems = [("synthetic-dimer", coords)]
+
+    for no_beads in SIZES:
+        if no_beads > max_beads:
+            break
+        bench_systems.append(("lattice", systems.lattice(no_beads)))
+        bench_systems.append(("shell", systems.shell(no_beads)))
+
+    return bench_systems
+
+def run_benchmarks(max_beads=10000, stages=STAGES, repeat=3):
+    """ Runs selected stages on all benchmark systems.
+        Returns list of result records.
+    """
+    records = []
+    version = version_info()
+    with tempfile.TemporaryDirectory() as work_dir:
+        for name, coords in benchmark_systems(max_beads):
+            for stage in stages:
+                result = run_forked(benchmark_stage, stage, coords, work_dir, repeat)
+                if result is None:
+                    continue
+                wall_times, peak_rss, stage_rss = result
+                records.append(dict(version, system=name, no_beads=coords.shape[0], \
+                    stage=stage, wall=min(wall_times), wall_all=wall_times, \
+                    peak_rss=peak_rss, stage_rss=stage_rss))
+
+    return records
+
+def benchmark_stage(stage, coords, work_dir, repeat):
+    """ Sets up and times stage, see time_stage.
+        Returns None if stage does not apply.
+    """
+    setup = stage_setup(stage, coords, work_dir)
+    if setup is None:
+        return None
+
+    return time_stage(setup, repeat)
+
+def run_forked(func, *args):
+    """ Runs func(*args) in a forked process and returns its result.
+        A forked process starts its own peak RSS count (ru_maxrss) from
+        the memory it inherits, which a spawned one would not.
+    """
+    context = multiprocessing.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+
+    def target():
+        try:
+            sender.send((True, func(*args)))
+        except BaseException as error:
+            sender.send((False, repr(error)))
+
+    process = context.Process(target=target)
+    process.start()
+    sender.close()
+    try:
+        is_success, result = receiver.recv()
+    except EOFError:
+        is_success, result = False, "exit code {}".format(process.exitcode)
+    finally:
+        process.join()
+        receiver.close()
+
+    if not is_success:
+        raise RuntimeError("{} failed: {}".format(func.__name__, result))
+
+    return result
+
+def stage_setup(stage, coords, work_dir):
+    """ Prepares inputs of a stage outside of the timing and returns
+        function to be timed, or None if stage does not apply.
+    """
+    no_beads = coords.shape[0]
+    is_dense = no_beads <= MAX_DENSE_BEADS
+
+    if stage == 'distance_matrix' and no_beads <= MAX_LEGACY_BEADS:
+        pdb_filepath = join_paths(work_dir, "{}.pdb".format(no_beads))
+        systems.write_pdb(pdb_filepath, coords)
+        return lambda: se.create_distance_matrix(pdb_filepath)
+    if stage == 'contacts':
+        return lambda: cnt.build_contacts(coords, CUTOFF_RADIUS)
+
+    contacts = cnt.build_contacts(coords, CUTOFF_RADIUS)
+    pair_i, pair_j = cnt.within_radius(contacts, CUTOFF_RADIUS)
+    spring_constants = np.full(pair_i.shape[0], enm.DEFAULT_SPRING_CONSTANT)
+
+    if stage == 'hessian' and is_dense:
+        return lambda: enm.build_hessian(coords, cutoff=CUTOFF_RADIUS, contacts=contacts)
+    if stage == 'sparse_hessian':
+        return lambda: enm.build_sparse_hessian(coords, pair_i, pair_j, spring_constants)
+    if stage == 'eigensolve' and is_dense:
+        hessian = enm.build_hessian(coords, cutoff=CUTOFF_RADIUS, contacts=contacts)
+        return lambda: enm.diagonalise(hessian)
+    if stage == 'sparse_eigensolve':
+        hessian = enm.build_sparse_hessian(coords, pair_i, pair_j, spring_constants)
+        return lambda: enm.lowest_modes(hessian, NO_MODES)
+
+    if stage in ['parse', 'legacy_parse', 'cooperativity', 'plot']:
+        eigenvalues, eigenvectors = synthetic_modes(no_beads)
+    if stage == 'parse':
+        filepath = write_modes(work_dir, eigenvalues, eigenvectors)
+        return lambda: prowt.parse_eigenfacs(filepath)
+    if stage == 'legacy_parse' and no_beads <= MAX_LEGACY_BEADS:
+        filepath = write_modes(work_dir, eigenvalues, eigenvectors)
+        return lambda: prowt.extract_eigenvecs(prowt.read_file(filepath))
+    if stage == 'cooperativity' and is_dense:
+        # Scan grid of 20 cutoff radii x 8 flag combinations with all
+        # modes, as computed by dense solves
+        no_runs = 20 * 8
+        grid = np.abs(eigenvalues[None, None, :] * \
+            (1 + 0.01 * np.random.default_rng(0).standard_normal((no_runs, 3, 1))))
+        grid = np.repeat(grid, max(1, 3 * no_beads // eigenvalues.shape[0]), axis=2)
+        keys = pd.DataFrame({'cutoff': np.repeat(np.arange(20), 8).astype(str),
+                             'flags': np.tile(np.arange(8), 20).astype(str)})
+        return lambda: coop.process_grid(keys, grid)
+    if stage == 'plot':
+        return lambda: plot_modes(eigenvalues, join_paths(work_dir, "plot.pdf"))
+
+    return None
+
+def synthetic_modes(no_beads):
+    """ Generates NO_STORED_MODES orthonormal modes and eigenvalues
+        of a system of no_beads beads.
+    """
+    rng = np.random.default_rng(0)
+    eigenvectors, _ = np.linalg.qr(rng.standard_normal((3 * no_beads, NO_STORED_MODES)))
+    eigenvalues = np.sort(rng.uniform(1e-3, 10.0, NO_STORED_MODES))
+
+    return eigenvalues, eigenvectors
+
+def write_modes(work_dir, eigenvalues, eigenvectors):
+    """ Writes modes as matrix.eigenfacs. Returns file path.
+    """
+    filepath = join_paths(work_dir, "matrix.eigenfacs")
+    enm.write_eigenfacs(filepath, eigenvalues, eigenvectors)
+
+    return filepath
+
+def plot_modes(eigenvalues, figure_path):
+    """ Plots cumulative eigenvalues as visualize.main does
+        for a single run and saves the figure.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fig, axs = plt.subplots(3, 1, figsize=(3, 9))
+    for ax, values in zip(axs, [np.log(eigenvalues).cumsum(), eigenvalues, eigenvalues]):
+        ax.scatter(np.arange(1, values.shape[0] + 1), values, s=4)
+        ax.set_box_aspect(1)
+    fig.tight_layout()
+    fig.savefig(figure_path, bbox_inches='tight')
+    plt.close(fig)
+
+    return None
+
+def time_stage(func, repeat):
+    """ Times function repeat times. Returns wall times (s),
+        peak RSS of the process (kB) and its growth while timing (kB),
+        i.e. memory of the stage beyond its inputs.
+    """
+    start_rss = instr.peak_rss()
+    wall_times = []
+    for _ in range(repeat):
+        start_counter = time.perf_counter()
+        func()
+        wall_times.append(time.perf_counter() - start_counter)
+    peak_rss = instr.peak_rss()
+
+    return wall_times, peak_rss, None if peak_rss is None else peak_rss - start_rss
+
+def version_info():
+    """ Describes code version and machine of a benchmark run.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, \
+            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"), 'commit': commit,
+            'host': platform.node(), 'machine': platform.machine(),
+            'python': platform.python_version(), 'numpy': np.__version__,
+            'cpu_count': os.cpu_count()}
+
+def append_history(history_filepath, records):
+    """ Appends benchmark records to JSON lines history.
+    """
+    with open(history_filepath, 'a') as file:
+        for record in records:
+            file.write(json.dumps(record) + "\n")
+
+    return None
+
+def read_history(history_filepath):
+    """ Reads benchmark history into DataFrame.
+    """
+    with open(history_filepath) as file:
+        return pd.DataFrame([json.loads(line) for line in file if line.strip()])
+
+def compare(history_filepath, threshold=1.2):
+    """ Compares best wall times of the latest two benchmarked versions
+        (commits) on the same host. Returns table with slowdown ratios;
+        ratios above threshold are flagged as regressions.
+    """
+    history = read_history(history_filepath)
+    history = history[history['host'] == history['host'].iloc[-1]]
+    commits = history.sort_values('timestamp')['commit'].drop_duplicates().tolist()
+    if len(commits) < 2:
+        raise click.ClickException("History needs benchmarks of two versions")
+    previous_commit, latest_commit = commits[-2:]
+
+    keys = ['system', 'no_beads', 'stage']
+    best = history.groupby(['commit'] + keys)['wall'].min()
+    table = pd.concat([best[previous_commit].rename('previous'), \
+        best[latest_commit].rename('latest')], axis=1, join='inner').reset_index()
+    table['ratio'] = table['latest'] / table['previous']
+    table['regression'] = table['ratio'] > threshold
+
+    return table
+
+
+if __name__ == '__main__':
+    main_commandline()
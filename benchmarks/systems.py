@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+""" Synthetic ENM systems for benchmarks.
+
+    Carbon alpha lattices (globular proteins) and spherical shells
+    (viral capsids) of any size, with the 3.8 angstrom CA-CA spacing of
+    proteins, and fixture PDB files of a small synthetic homodimer (not
+    a real PDB entry) in apo, holo1 and holo2 forms, so benchmarks need
+    no download.
+"""
+import os
+from os.path import join as join_paths
+import numpy as np
+
+# Carbon alpha - carbon alpha distance (angstroms)
+CA_SPACING = 3.8
+
+FIXTURES_DIR = join_paths(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def lattice(no_beads, spacing=CA_SPACING, seed=0):
+    """ Generates no_beads beads on a slightly perturbed cubic lattice,
+        a model of a globular protein. Returns Nx3 coordinates.
+    """
+    side = int(np.ceil(no_beads ** (1 / 3)))
+    grid = np.stack(np.meshgrid(*[np.arange(side)] * 3, indexing='ij'), axis=-1)
+    coords = grid.reshape(-1, 3)[:no_beads] * spacing
+    noise = np.random.default_rng(seed).normal(scale=0.1 * spacing, size=coords.shape)
+
+    return coords + noise
+
+def shell(no_beads, spacing=CA_SPACING, thickness=3, seed=0):
+    """ Generates no_beads beads in a spherical shell of given thickness
+        (layers), a model of a viral capsid. Beads of every layer lie on
+        a Fibonacci sphere. Returns Nx3 coordinates.
+    """
+    beads_per_layer = int(np.ceil(no_beads / thickness))
+    # Sphere area per bead ~ spacing^2
+    radius = spacing * np.sqrt(beads_per_layer / (4 * np.pi))
+
+    golden_angle = np.pi * (3 - np.sqrt(5))
+    idxs = np.arange(beads_per_layer)
+    heights = 1 - 2 * (idxs + 0.5) / beads_per_layer
+    rings = np.sqrt(1 - heights ** 2)
+    sphere = np.column_stack([rings * np.cos(golden_angle * idxs),
+                              rings * np.sin(golden_angle * idxs), heights])
+
+    layers = [sphere * (radius + layer * spacing) for layer in range(thickness)]
+    coords = np.concatenate(layers)[:no_beads]
+    noise = np.random.default_rng(seed).normal(scale=0.1 * spacing, size=coords.shape)
+
+    return coords + noise
+
+def write_pdb(filepath, coords, chain_ids=None, ligand_coords=()):
+    """ Writes carbon alpha coordinates as ATOM records (alanine) and
+        ligand coordinates as single-atom HETATM records (residue LIG).
+    """
+    if chain_ids is None:
+        chain_ids = ["A"] * coords.shape[0]
+
+    lines = []
+    residue_numbers = {}
+    for serial, (coord, chain_id) in enumerate(zip(coords, chain_ids), start=1):
+        residue_numbers[chain_id] = residue_numbers.get(chain_id, 0) + 1
+        lines.append("ATOM  {:5d}  CA  ALA {:1s}{:4d}    {:8.3f}{:8.3f}{:8.3f}  1.00  0.00           C"
+                     .format(serial % 100000, chain_id, residue_numbers[chain_id] % 10000, *coord))
+    for ligand_idx, coord in enumerate(ligand_coords):
+        serial = coords.shape[0] + ligand_idx + 1
+        lines.append("HETATM{:5d}  C1  LIG {:1s}{:4d}    {:8.3f}{:8.3f}{:8.3f}  1.00  0.00           C"
+                     .format(serial % 100000, chain_ids[0], 900 + ligand_idx, *coord))
+    lines.append("END")
+
+    with open(filepath, 'w') as file:
+        file.write("\n".join(lines) + "\n")
+
+    return None
+
+def make_fixtures(output_dir=FIXTURES_DIR, no_residues=150):
+    """ Writes fixture homodimer (two lattice protomers related by
+        a two-fold axis) in apo (0), holo1 (1) and holo2 (2) forms,
+        with a ligand bound to none, one and both protomers.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    protomer = lattice(no_residues, seed=1)
+    protomer = protomer - protomer.mean(axis=0) + [np.ptp(protomer[:, 0]) / 2 + 2.5, 0, 0]
+    two_fold = np.diag([-1.0, -1.0, 1.0])
+    coords = np.concatenate([protomer, protomer @ two_fold.T])
+    chain_ids = ["A"] * no_residues + ["B"] * no_residues
+
+    # Ligand next to the outer face of protomer A, and its symmetry mate
+    ligand = protomer[np.argmax(protomer[:, 0])] + [CA_SPACING, 0, 0]
+    ligands = [ligand, ligand @ two_fold.T]
+
+    for form_idx in range(3):
+        write_pdb(join_paths(output_dir, "synthetic_dimer.{}.pdb".format(form_idx)), coords, \
+            chain_ids=chain_ids, ligand_coords=ligands[:form_idx])
+
+    return None
+
+
+if __name__ == '__main__':
+    make_fixtures()
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+""" Vectorised cooperativity engine over the whole ENM scan grid.
+
+    Eigenvalues of all runs are loaded into one (run, form, mode) array,
+    where a run is a (cutoff, flags) combination and forms are apo,
+    holo1 and holo2. Cumulative eigenvalues, dissociation constants and
+    cooperativity of all runs are then computed in a few array operations,
+    accumulated in log space (see cooperativity_grid).
+"""
+import os
+from os.path import join as join_paths
+import numpy as np
+import pandas as pd
+import src.instrument as instr
+import src.data.store as store
+
+RUN_NAMES = ['cutoff', 'flags']
+FORMS = ["0", "1", "2"]
+# Values per block of compensated_cumsum
+CUMSUM_BLOCK_SIZE = 1 << 15
+
+
+@instr.traced()
+def store_grid(store_path, pdb_id):
+    """ Loads eigenvalues of all runs of a PDB ID with all three forms
+        from HDF5 result store. Returns run keys DataFrame (cutoff, flags)
+        and (run, form, mode) eigenvalue array.
+    """
+    runs = store.list_runs(store_path)
+    runs = runs[runs['pdb_id'] == pdb_id]
+
+    keys, eigenvalues = [], []
+    for (cutoff_flag, other_flags), forms in runs.groupby(RUN_NAMES):
+        if sorted(forms['form']) != FORMS:
+            print("Structural forms missing in the store: {} {}".format(cutoff_flag, other_flags))
+            continue
+        keys.append((cutoff_flag, other_flags))
+        eigenvalues.append([store.read_eigenvalues(store_path, \
+            (pdb_id, cutoff_flag, other_flags, form_idx)) for form_idx in FORMS])
+
+    return pd.DataFrame(keys, columns=RUN_NAMES), stack_runs(eigenvalues)
+
+def stack_runs(eigenvalues):
+    """ Stacks eigenvalues of runs, a list of [apo, holo1, holo2] arrays,
+        into (run, form, mode) array. Modes are those of the apo form;
+        missing values are NaN.
+    """
+    no_modes = max((run[0].shape[0] for run in eigenvalues), default=0)
+    grid = np.full((len(eigenvalues), len(FORMS), no_modes), np.nan)
+    for run_idx, run in enumerate(eigenvalues):
+        no_apo_modes = run[0].shape[0]
+        for form_idx, form_eigenvalues in enumerate(run):
+            no_form_modes = min(no_apo_modes, form_eigenvalues.shape[0])
+            grid[run_idx, form_idx, :no_form_modes] = form_eigenvalues[:no_form_modes]
+
+    return grid
+
+def cooperativity_grid(eigenvalues):
+    """ Computes cumulative log-eigenvalues, dissociation constants
+        K_1 = holo1/apo, K_2 = holo2/holo1 and cooperativity
+        holo2*apo/holo1^2 (products over modes) from (run, form, mode)
+        eigenvalue array. Returns dictionary of (run, mode) arrays.
+        Products are accumulated in log space with compensated summation
+        as free energy changes dG_1 = ln K_1, dG_2 = ln K_2 and
+        ddG = dG_2 - dG_1 = ln coop (in kT), and only exponentiated at
+        the end, so they neither underflow nor overflow over many modes.
+        Undefined values (e.g. logarithms of negative trivial mode
+        eigenvalues) are skipped, as in pandas cumsum/cumprod.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cum_log_eigenvals = skipna(compensated_cumsum, np.log(eigenvalues), axis=2)
+
+        # Ratios of eigenvalues as magnitude (log) and sign
+        log_eigenvals = np.log(np.abs(eigenvalues))
+        signs = np.sign(eigenvalues)
+        log_ratios = {'1': log_eigenvals[:, 1] - log_eigenvals[:, 0],
+                      '2': log_eigenvals[:, 2] - log_eigenvals[:, 1],
+                      'coop': log_eigenvals[:, 2] + log_eigenvals[:, 0] - 2 * log_eigenvals[:, 1]}
+        ratio_signs = {'1': signs[:, 1] * signs[:, 0], '2': signs[:, 2] * signs[:, 1],
+                       'coop': signs[:, 2] * signs[:, 0]}
+
+        free_energies = {name: skipna(compensated_cumsum, log_ratio, axis=1) \
+            for name, log_ratio in log_ratios.items()}
+        cum_signs = {name: skipna(np.nancumprod, sign, axis=1) \
+            for name, sign in ratio_signs.items()}
+        products = {name: cum_signs[name] * np.exp(free_energies[name]) \
+            for name in log_ratios}
+
+    return {'eigenvalue_0': cum_log_eigenvals[:, 0], 'eigenvalue_1': cum_log_eigenvals[:, 1],
+            'eigenvalue_2': cum_log_eigenvals[:, 2],
+            'K_1': products['1'], 'K_2': products['2'], 'coop': products['coop'],
+            'dG_1': free_energies['1'], 'dG_2': free_energies['2'],
+            'ddG': free_energies['coop']}
+
+def compensated_cumsum(values, axis=-1):
+    """ Cumulative sum along axis with compensated (TwoSum) summation,
+        i.e. accurate to float64 rounding regardless of the number of
+        terms. Vectorised, see compensated_cumsum_block; the other axes
+        are processed in blocks of about CUMSUM_BLOCK_SIZE values,
+        so temporaries stay in cache.
+    """
+    values = np.moveaxis(np.asarray(values, dtype=float), axis, -1)
+    shape = values.shape
+    values = values.reshape(int(np.prod(shape[:-1])), shape[-1])
+    sums = np.empty_like(values)
+
+    no_rows = max(CUMSUM_BLOCK_SIZE // max(shape[-1], 1), 1)
+    for start in range(0, values.shape[0], no_rows):
+        sums[start:start + no_rows] = compensated_cumsum_block(values[start:start + no_rows])
+
+    return np.moveaxis(sums.reshape(shape), -1, axis)
+
+def compensated_cumsum_block(values):
+    """ Compensated cumulative sum along the last axis of 2D array:
+        running sums come from np.cumsum, the rounding error of every
+        addition from the exact TwoSum of consecutive running sums,
+        and the accumulated errors are added back in a second cumsum.
+    """
+    # Terms along the first axis, so that slices of terms are contiguous
+    values = values.T
+    sums = np.cumsum(values, axis=0)
+    previous, new_sums, terms = sums[:-1], sums[1:], values[1:]
+
+    with np.errstate(invalid='ignore'):
+        # Low-order bits lost in previous + term (TwoSum)
+        term_part = new_sums - previous
+        lost = new_sums - term_part
+        np.subtract(previous, lost, out=lost)
+        lost += terms - term_part
+    lost[~np.isfinite(lost)] = 0.0
+    sums[1:] += np.cumsum(lost, axis=0)
+
+    return sums.T
+
+def skipna(cumulative_func, values, axis):
+    """ Applies cumulative function with NaN values treated as neutral
+        (zero terms, unit factors) and keeps NaN where values are NaN.
+    """
+    is_nan = np.isnan(values)
+    neutral = 1.0 if cumulative_func is np.nancumprod else 0.0
+
+    return np.where(is_nan, np.nan, cumulative_func(np.where(is_nan, neutral, values), axis=axis))
+
+def grid_table(keys, results, no_modes=None):
+    """ Converts (run, mode) result arrays into tidy DataFrame with run
+        keys, mode number (1-based) and one column per result.
+        Modes missing in a run are dropped.
+    """
+    no_runs, no_grid_modes = next(iter(results.values())).shape
+    table = keys.loc[keys.index.repeat(no_grid_modes)].reset_index(drop=True)
+    table['mode_number'] = np.tile(np.arange(1, no_grid_modes + 1), no_runs)
+    for name, values in results.items():
+        table[name] = values.ravel()
+
+    if no_modes is not None:
+        no_modes = np.repeat(no_modes, no_grid_modes)
+        table = table[table['mode_number'].to_numpy() <= no_modes].reset_index(drop=True)
+
+    return table
+
+@instr.traced()
+def process_grid(keys, eigenvalues):
+    """ Computes cooperativity of all runs of the scan grid.
+        Returns tidy DataFrame (see grid_table).
+    """
+    no_modes = np.sum(~np.isnan(eigenvalues[:, 0]), axis=1)
+
+    return grid_table(keys, cooperativity_grid(eigenvalues), no_modes=no_modes)
+
+@instr.traced()
+def save_table(table, output_dir):
+    """ Saves tidy results table (see save_run) for every run in
+        results directory, e.g. "data/processed/-c09.50/-mass-ca-het".
+    """
+    for (cutoff_flag, other_flags), run_table in table.groupby(RUN_NAMES, sort=False):
+        save_run(run_table, join_paths(output_dir, cutoff_flag, other_flags))
+
+    return None
+
+def save_run(run_table, output_subdir):
+    """ Saves results of a single run as eigenvals.csv, diss_consts.csv,
+        coop.csv and free_energy.csv (dG_1, dG_2, ddG) in results directory.
+    """
+    files = {"eigenvals.csv": ['eigenvalue_0', 'eigenvalue_1', 'eigenvalue_2'],
+             "diss_consts.csv": ['K_1', 'K_2'],
+             "coop.csv": ['coop'],
+             "free_energy.csv": ['dG_1', 'dG_2', 'ddG']}
+
+    os.makedirs(output_subdir, exist_ok=True)
+    run_table = run_table.set_index('mode_number')
+    for filename, columns in files.items():
+        run_table[columns].to_csv(join_paths(output_subdir, filename))
+
+    return None
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+""" Lazily-loaded access to ENM eigenvectors.
+
+    ModeSet wraps eigenvector storage of one run, either NumPy .npy
+    files opened as memory maps or a dataset of the HDF5 result store,
+    and reads only the requested modes and beads from disk. It is meant
+    for analyses of a few modes outside the pipeline (e.g. notebooks);
+    the pipeline stages only use eigenvalues.
+"""
+import os
+from os.path import join as join_paths
+import h5py
+import numpy as np
+import src.data.store as store
+import src.data.process_wt as prowt
+
+# Eigenvectors read at once when selecting beads
+BLOCK_MODES = 64
+
+
+class ModeSet:
+    """ Eigenvalues and lazily-loaded eigenvectors of one ENM run.
+        Modes are addressed by DDPT mode numbers (1-based, trivial
+        modes included); eigenvectors are returned as (beads, 3) arrays.
+    """
+
+    def __init__(self, eigenvalues, eigenvectors, mode_numbers=None, handle=None):
+        """ eigenvectors must be an array-like (modes, 3N) supporting
+            row slicing without loading, e.g. np.memmap or h5py dataset.
+        """
+        self.eigenvalues = np.asarray(eigenvalues)
+        self.eigenvectors = eigenvectors
+        if mode_numbers is None:
+            mode_numbers = np.arange(1, self.eigenvalues.shape[0] + 1)
+        self.mode_numbers = np.asarray(mode_numbers)
+        self._handle = handle
+
+    @classmethod
+    def from_npy(cls, modes_dir):
+        """ Opens modes saved with save_modes as memory maps.
+        """
+        eigenvalues = np.load(join_paths(modes_dir, "eigenvalues.npy"))
+        mode_numbers = np.load(join_paths(modes_dir, "mode_numbers.npy"))
+        eigenvectors = np.load(join_paths(modes_dir, "eigenvectors.npy"), mmap_mode='r')
+
+        return cls(eigenvalues, eigenvectors, mode_numbers=mode_numbers)
+
+    @classmethod
+    def from_store(cls, store_path, key):
+        """ Opens modes of a run in the HDF5 result store. The file stays
+            open until close() is called.
+        """
+        handle = h5py.File(store_path, 'r')
+        group = handle[store.run_path(key)]
+
+        return cls(group['eigenvalues'][:], group['eigenvectors'], handle=handle)
+
+    @classmethod
+    def from_eigenfacs(cls, filepath, modes_dir=None):
+        """ Converts matrix.eigenfacs into .npy files (next to it by default)
+            once and opens them as memory maps.
+        """
+        if modes_dir is None:
+            modes_dir = join_paths(os.path.dirname(filepath), "modes")
+
+        if not os.path.isfile(join_paths(modes_dir, "eigenvectors.npy")) or \
+            os.path.getmtime(join_paths(modes_dir, "eigenvectors.npy")) < os.path.getmtime(filepath):
+            mode_numbers, eigenvalues, eigenvecs = prowt.parse_eigenfacs(filepath)
+            save_modes(modes_dir, mode_numbers, eigenvalues, eigenvecs)
+
+        return cls.from_npy(modes_dir)
+
+    @property
+    def no_modes(self):
+        return self.mode_numbers.shape[0]
+
+    @property
+    def no_beads(self):
+        return self.eigenvectors.shape[1] // 3
+
+    def mode(self, mode_number):
+        """ Returns eigenvector of a single mode as (beads, 3) array.
+        """
+        row = self._rows([mode_number])[0]
+
+        return np.asarray(self.eigenvectors[row]).reshape(self.no_beads, 3)
+
+    def modes(self, first_mode, last_mode):
+        """ Returns eigenvectors of modes first_mode to last_mode
+            (inclusive) as (modes, beads, 3) array.
+        """
+        first_row, last_row = self._rows([first_mode, last_mode])
+        vectors = np.asarray(self.eigenvectors[first_row:last_row + 1])
+
+        return vectors.reshape(-1, self.no_beads, 3)
+
+    def beads(self, bead_idxs, mode_numbers=None):
+        """ Returns eigenvector components of selected beads (0-based)
+            for selected modes (all by default, in the given order
+            otherwise) as (modes, beads, 3) array. Only the rows of the
+            selected modes are read, BLOCK_MODES rows at a time.
+        """
+        if mode_numbers is None:
+            rows, order = np.arange(self.no_modes), None
+        else:
+            # HDF5 reads rows in increasing order without duplicates
+            rows, order = np.unique(self._rows(mode_numbers), return_inverse=True)
+        coord_idxs = (3 * np.asarray(bead_idxs)[:, None] + np.arange(3)).ravel()
+
+        vectors = np.empty((rows.shape[0], coord_idxs.shape[0]), dtype=self.eigenvectors.dtype)
+        for start in range(0, rows.shape[0], BLOCK_MODES):
+            block_rows = rows[start:start + BLOCK_MODES]
+            if order is None:
+                block_rows = slice(block_rows[0], block_rows[-1] + 1)
+            vectors[start:start + BLOCK_MODES] = \
+                np.asarray(self.eigenvectors[block_rows])[:, coord_idxs]
+        if order is not None:
+            vectors = vectors[order.ravel()]
+
+        return vectors.reshape(vectors.shape[0], -1, 3)
+
+    def close(self):
+        """ Closes the underlying HDF5 file, if any.
+        """
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _rows(self, mode_numbers):
+        """ Converts mode numbers into storage rows.
+        """
+        rows = np.searchsorted(self.mode_numbers, mode_numbers)
+        rows = np.minimum(rows, self.no_modes - 1)
+        if not np.array_equal(self.mode_numbers[rows], mode_numbers):
+            raise KeyError("Modes not found: {}".format(mode_numbers))
+
+        return rows
+
+
+def save_modes(modes_dir, mode_numbers, eigenvalues, eigenvecs):
+    """ Saves modes as .npy files that can be memory-mapped:
+        eigenvectors are stored as rows (modes, 3N), so that a single
+        mode is contiguous on disk.
+    """
+    os.makedirs(modes_dir, exist_ok=True)
+    np.save(join_paths(modes_dir, "mode_numbers.npy"), mode_numbers)
+    np.save(join_paths(modes_dir, "eigenvalues.npy"), eigenvalues)
+    np.save(join_paths(modes_dir, "eigenvectors.npy"), \
+        np.asarray(eigenvecs).reshape(len(eigenvalues), -1))
+
+    return None
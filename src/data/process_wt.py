@@ -4,11 +4,15 @@ import logging
 from pathlib import Path
 from dotenv import find_dotenv, load_dotenv
 
-import glob, os
+import glob, io, os
 from os.path import join as join_paths
 import pandas as pd
 import numpy as np
 import src.utilities as utils
+import src.instrument as instr
+import src.data.store as store
+import src.data.cooperativity as coop
+import src.data.stream as stream
 from shutil import copy
 
 @click.command()
@@ -23,7 +27,7 @@ def main_commandline(input_dir, output_dir):
     logger.info('making processed data set from interim data')
 
     config = utils.read_config()
-    pdb_codes = config['pdb']['codeList']
+    pdb_codes = utils.pdb_codes(config)
     
     # Get paths
     eigenvalues_paths = sorted(glob.glob(os.path.join(input_dir, "*.eigenvalues")))
@@ -88,79 +92,107 @@ def main_commandline(input_dir, output_dir):
 
 #########################################################################
 
-def main(input_dir, output_dir):
+def main(input_dir, output_dir, pdb_id=None):
     """ Runs data processing scripts to turn interim data (from data/interim/) into
         processed data ready to be analysed (saved in data/processed/).
+        Runs are read from the HDF5 result store in input_dir, if the scan
+        writes one (storeFilePath in config.yaml, see main_store), or
+        from the results directory tree otherwise.
     """
-
     config = utils.read_config()
-    pdb_codes = config['pdb']['codeList']
-    
-    # Get paths
+    if config['enm']['storeFilePath'] is not None:
+        return main_store(join_paths(input_dir, config['enm']['storeFilePath']), \
+            output_dir, pdb_id=pdb_id)
+
+    # Process all runs; missing or partial runs are recorded
+    # in missing.csv
     # Directory path example: "data/raw/-c09.50/-mass-ca-het/0"
-    cutoff_paths = glob.glob(join_paths(input_dir, "*"), recursive=True)
-    for cutoff_path in cutoff_paths:
-        flag_paths = glob.glob(join_paths(cutoff_path, "*"), recursive=True)
-        for flag_path in flag_paths:
-            cutoff_flag = os.path.basename(cutoff_path)
-            other_flags = os.path.basename(flag_path)
-            
-            # Read martix.eigenfacs files
-            idxs = ["0", "1", "2"]
-            a_files = [join_paths(flag_path, idx, "matrix.eigenfacs") for idx in idxs]
-            a_exist = [f for f in a_files if os.path.isfile(f)]
-
-            if a_files.sort() == a_exist.sort():
-                eigenfacs_0 = read_file(join_paths(flag_path, "0", "matrix.eigenfacs"))
-                eigenfacs_1 = read_file(join_paths(flag_path, "1", "matrix.eigenfacs"))
-                eigenfacs_2 = read_file(join_paths(flag_path, "2", "matrix.eigenfacs"))
-            else:
-                print("matrix.eigenfacs might be missing")
-                return None
-
-            # Create  DataFrames with eigenvalues 
-            eigenvals_0 = extract_eigenvals(eigenfacs_0)
-            eigenvals_1 = extract_eigenvals(eigenfacs_1)
-            eigenvals_2 = extract_eigenvals(eigenfacs_2)
-
-            # Move all eigenvalues into one DataFrame
-            eigenvals_all = eigenvals_0.copy()
-            eigenvals_all.rename(columns={"eigenvalue": "eigenvalue_0"}, inplace=True)
-            
-            eigenvals_all['eigenvalue_1'] = eigenvals_1['eigenvalue'][eigenvals_1.index \
-                .isin(eigenvals_all.index)]
-            eigenvals_all['eigenvalue_2'] = eigenvals_2['eigenvalue'][eigenvals_2.index \
-                .isin(eigenvals_all.index)]
+    return stream.process_tree(input_dir, output_dir)
 
-            # Calculate dissociation constants and cooperativity
-            mode_number = eigenvals_all.index
+def main_store(store_path, output_dir, pdb_id=None):
+    """ Runs data processing scripts to turn raw data from HDF5 result store
+        (data/raw/enm.h5) into processed data ready to be analysed
+        (saved in data/processed/).
+        pdb_id defaults to the PDB ID in config.yaml.
+    """
+    if pdb_id is None:
+        config = utils.read_config()
+        pdb_id = config['pdb']['id']
+
+    keys, eigenvalues = coop.store_grid(store_path, pdb_id)
+    table = coop.process_grid(keys, eigenvalues)
+    coop.save_table(table, output_dir)
+
+    return table
+
+@instr.traced()
+def parse_eigenfacs(filepath):
+    """ Parses matrix.eigenfacs file in bulk.
+        The file is read as one buffer and VECTOR header lines are
+        located with a single vectorised scan over line starts. The
+        eigenvector components of every mode are decoded by np.loadtxt,
+        which raises on any malformed value; every mode must have
+        the same number N of beads (3N components).
+        Returns mode numbers (modes,), eigenvalues (modes,)
+        and eigenvectors (modes, beads, 3).
+    """
+    with open(filepath, 'rb') as file:
+        data = file.read()
+    buffer = np.frombuffer(data, dtype=np.uint8)
+
+    # Line start and end (newline) positions
+    line_ends = np.flatnonzero(buffer == ord("\n"))
+    if line_ends.shape[0] == 0 or line_ends[-1] != buffer.shape[0] - 1:
+        line_ends = np.append(line_ends, buffer.shape[0])
+    line_starts = np.concatenate(([0], line_ends[:-1] + 1))
+
+    # VECTOR header lines: " VECTOR    1       VALUE  0.1234E-08"
+    header_idxs = np.flatnonzero(is_header(buffer, line_starts))
+    no_modes = header_idxs.shape[0]
+    if no_modes == 0:
+        raise ValueError("No VECTOR records in {}".format(filepath))
+
+    headers = [buffer[line_starts[idx]:line_ends[idx]].tobytes().split() \
+        for idx in header_idxs]
+    mode_numbers = np.array([int(header[1]) for header in headers])
+    eigenvalues = np.array([float(header[3]) for header in headers])
+
+    # Components of every mode, from its header to the next one
+    block_starts = line_ends[header_idxs] + 1
+    block_ends = np.append(line_starts[header_idxs[1:]], buffer.shape[0])
+    eigenvecs = None
+    for mode_idx, (start, end) in enumerate(zip(block_starts, block_ends)):
+        try:
+            # Separator line ("---") is skipped as a comment
+            components = np.loadtxt(io.BytesIO(data[start:end]), comments="--", ndmin=2)
+        except ValueError as error:
+            raise ValueError("Mode {} in {}: {}".format(mode_numbers[mode_idx], filepath, \
+                error)) from error
+        if eigenvecs is None:
+            eigenvecs = np.empty((no_modes, components.shape[0], 3))
+        if components.shape != eigenvecs.shape[1:]:
+            raise ValueError("Mode {} in {} has {}x{} components, expected Nx3 = {}x3" \
+                .format(mode_numbers[mode_idx], filepath, *components.shape, \
+                eigenvecs.shape[1]))
+        eigenvecs[mode_idx] = components
+
+    return mode_numbers, eigenvalues, eigenvecs
+
+def is_header(buffer, line_starts):
+    """ Flags lines of buffer that are VECTOR headers, i.e. start
+        with "VECTOR" after a single leading space.
+    """
+    label = np.frombuffer(b"VECTOR", dtype=np.uint8)
+    line_starts = line_starts[line_starts + label.shape[0] < buffer.shape[0]]
 
-            diss_consts = pd.DataFrame(index=mode_number)
-            diss_consts['K_1'] = (eigenvals_all['eigenvalue_1'] / eigenvals_all['eigenvalue_0']).to_numpy()
-            diss_consts['K_2'] = eigenvals_all['eigenvalue_2'] / eigenvals_all['eigenvalue_1']
-            
-            coop = pd.DataFrame(index=mode_number)
-            coop['coop'] = (eigenvals_all['eigenvalue_2'] * eigenvals_all['eigenvalue_0']) / \
-                        (eigenvals_all['eigenvalue_1'] ** 2)
-
-            # Calcualte cumulative (total) values
-            eigenvals_cum = eigenvals_all.copy()
-            eigenvals_cum[:] = np.log(eigenvals_all[:]).cumsum()
-            diss_consts_cum = diss_consts.copy()
-            diss_consts_cum[:] = np.cumprod(diss_consts_cum[:])
-            coop_cum = coop.copy()
-            coop_cum[:] = np.cumprod(coop[:])
-
-            # Create results directory
-            output_subdir = join_paths(output_dir, cutoff_flag, other_flags)
-            os.makedirs(output_subdir, exist_ok=True)
-
-            # Save data
-            eigenvals_cum.to_csv(join_paths(output_subdir, "eigenvals.csv"))
-            diss_consts_cum.to_csv(join_paths(output_subdir, "diss_consts.csv"))
-            coop_cum.to_csv(join_paths(output_subdir, "coop.csv"))
-            
-    
+    # Check the first letter of every line, then the whole label
+    # of the candidates only
+    flags = np.zeros(line_starts.shape[0], dtype=bool)
+    candidates = np.flatnonzero(buffer[line_starts + 1] == label[0])
+    offsets = line_starts[candidates, None] + np.arange(1, label.shape[0] + 1)[None, :]
+    flags[candidates] = (buffer[offsets] == label).all(axis=1)
+
+    return flags
 
 def read_file(filepath):
     """ Read file line by line.
@@ -266,13 +298,25 @@ def calculate_cooperativity(input_data, cumulative=True, from_eigenvalues=True):
         output_data['cooperativity'] = (output_data['eigenvalue_2'] * output_data['eigenvalue_0']) / (output_data['eigenvalue_1'] ** 2)
 
         if cumulative:
-            output_data.loc[:,'eigenvalue_0':'eigenvalue_2'] = np.cumsum(np.log(output_data.loc[:,'eigenvalue_0':'eigenvalue_2']))
-            output_data.loc[:,'K_1':] = np.cumprod(output_data.loc[:,'K_1':])
+            # Accumulate in log space, so products over many modes
+            # neither underflow nor overflow
+            eigenvalues = output_data.loc[:,'eigenvalue_0':'eigenvalue_2'].to_numpy()
+            results = coop.cooperativity_grid(eigenvalues.T[None])
+            output_data.loc[:,'eigenvalue_0':'eigenvalue_2'] = np.column_stack( \
+                [results[column][0] for column in ['eigenvalue_0', 'eigenvalue_1', 'eigenvalue_2']])
+            output_data['K_1'] = results['K_1'][0]
+            output_data['K_2'] = results['K_2'][0]
+            output_data['cooperativity'] = results['coop'][0]
+            output_data['dG_1'] = results['dG_1'][0]
+            output_data['dG_2'] = results['dG_2'][0]
+            output_data['ddG'] = results['ddG'][0]
             
     else:
         # Calculate allostery from free energy (from DDPT FREQEN module)
         if cumulative:
-            output_data.loc[:,'G_0':] = np.cumprod(output_data.loc[:,'G_0':])
+            # Free energies of modes add up (compensated summation)
+            output_data.loc[:,'G_0':'G_2'] = coop.compensated_cumsum( \
+                output_data.loc[:,'G_0':'G_2'].to_numpy(), axis=0)
     
         output_data['dG_1'] = output_data['G_1'] - output_data['G_0']
         output_data['dG_2'] = output_data['G_2'] - output_data['G_1']
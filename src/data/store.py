@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+""" HDF5 result store for ENM scans.
+
+    All runs of a scan are kept in one file instead of a directory tree
+    of text files. A run is keyed by (pdb_id, cutoff, flags, form), e.g.
+    ('3r6s', '-c09.50', '-mass-ca-het', '0'), and holds two datasets:
+    eigenvalues (modes,) and eigenvectors (modes, 3N), chunked by mode
+    and compressed, so single modes can be read without loading a run.
+
+    Scan workers write runs concurrently, so the store is opened under
+    a lock file next to it (store_path + ".lock"): shared for reading,
+    exclusive for writing.
+"""
+import fcntl
+from contextlib import contextmanager
+import h5py
+import numpy as np
+import pandas as pd
+import src.instrument as instr
+
+KEY_NAMES = ['pdb_id', 'cutoff', 'flags', 'form']
+
+
+@contextmanager
+def open_store(store_path, mode='r'):
+    """ Opens HDF5 store (h5py mode) while holding its lock file.
+    """
+    with open(store_path + ".lock", 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_SH if mode == 'r' else fcntl.LOCK_EX)
+        try:
+            with h5py.File(store_path, mode) as store:
+                yield store
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def run_path(key):
+    """ Converts run key (pdb_id, cutoff, flags, form) into HDF5 group path.
+    """
+    return "/".join(str(part) for part in key)
+
+@instr.traced()
+def write_run(store_path, key, eigenvalues, eigenvectors, attrs=None):
+    """ Writes (or overwrites) eigenvalues and eigenvectors of a run.
+        eigenvectors are given as columns (3N, modes), as returned
+        by the ENM engine, and stored as rows (modes, 3N).
+    """
+    with open_store(store_path, 'a') as store:
+        path = run_path(key)
+        if path in store:
+            del store[path]
+        group = store.create_group(path)
+
+        group.create_dataset('eigenvalues', data=eigenvalues)
+        mode_vectors = np.ascontiguousarray(eigenvectors.T)
+        group.create_dataset('eigenvectors', data=mode_vectors,
+                             chunks=(1, mode_vectors.shape[1]),
+                             compression='gzip', shuffle=True)
+        for name, value in (attrs or {}).items():
+            group.attrs[name] = value
+
+    return None
+
+def has_run(store_path, key):
+    """ Checks if run is in the store.
+    """
+    try:
+        with open_store(store_path) as store:
+            return run_path(key) in store
+    except FileNotFoundError:
+        return False
+
+def read_eigenvalues(store_path, key):
+    """ Reads all eigenvalues of a run.
+    """
+    with open_store(store_path) as store:
+        return store[run_path(key)]['eigenvalues'][:]
+
+def read_modes(store_path, key, modes=slice(None)):
+    """ Reads eigenvectors of selected modes (0-based index, slice or
+        sorted list) as rows (modes, 3N). Only the selected chunks
+        are read from disk.
+    """
+    with open_store(store_path) as store:
+        return store[run_path(key)]['eigenvectors'][modes]
+
+def list_runs(store_path):
+    """ Lists runs in the store as DataFrame with run keys,
+        number of modes and number of EN beads.
+    """
+    runs = []
+
+    def visit(path, node):
+        if isinstance(node, h5py.Group) and 'eigenvalues' in node:
+            no_modes, no_coords = node['eigenvectors'].shape
+            runs.append(path.split("/") + [no_modes, no_coords // 3])
+
+    with open_store(store_path) as store:
+        store.visititems(visit)
+
+    return pd.DataFrame(runs, columns=KEY_NAMES + ['no_modes', 'no_beads'])
+
+def eigenvalue_table(store_path):
+    """ Collects eigenvalues of all runs into a tidy DataFrame
+        with run keys, mode number (1-based) and eigenvalue.
+    """
+    tables = []
+    with open_store(store_path) as store:
+        for key in list_runs(store_path)[KEY_NAMES].itertuples(index=False):
+            eigenvalues = store[run_path(key)]['eigenvalues'][:]
+            table = pd.DataFrame({'mode_number': np.arange(1, eigenvalues.shape[0] + 1),
+                                  'eigenvalue': eigenvalues})
+            for name, value in zip(KEY_NAMES, key):
+                table.insert(KEY_NAMES.index(name), name, value)
+            tables.append(table)
+
+    return pd.concat(tables, ignore_index=True)
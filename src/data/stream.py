@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+""" Streaming cooperativity post-processor.
+
+    Consumes ENM scan results as they are produced, in-process as the
+    on_result callback of simulate_enm.run_scan, and processes every run
+    (cutoff, flags) as soon as its apo, holo1 and holo2 forms are
+    available. A finished results directory tree can be processed the
+    same way (process_tree).
+    Missing or partial runs are recorded in missing.csv instead of
+    stopping the processing.
+"""
+import glob
+import os
+from os.path import join as join_paths
+import pandas as pd
+import src.data.store as store
+import src.data.cooperativity as coop
+import src.data.process_wt as prowt
+
+
+class CooperativityStream:
+    """ Incremental cooperativity post-processor. Call it with scan job
+        results (see simulate_enm.run_scan_job) or add eigenvalues of
+        single forms with add_form; call close() at the end of the scan.
+    """
+
+    def __init__(self, output_dir, store_path=None, pdb_id=None):
+        """ Results are saved in output_dir, e.g. data/processed/.
+            Results without eigenvalues are read from the HDF5 result
+            store (store_path, pdb_id), if given, or from matrix.eigenfacs
+            in their results subdirectory.
+        """
+        self.output_dir = output_dir
+        self.store_path = store_path
+        self.pdb_id = pdb_id
+        self.pending = {}
+        self.missing = []
+        self.tables = []
+
+    def __call__(self, result):
+        self.add_result(result)
+
+    def add_result(self, result):
+        """ Adds finished (or failed) scan job result.
+        """
+        # Failed grouped jobs (sweeps, form batches) fail all their jobs
+        subjobs = result.get('sweep', result.get('forms'))
+        if subjobs is not None:
+            for subjob in subjobs:
+                self.add_result(dict(subjob, status=result.get('status'), \
+                    error=result.get('error')))
+            return None
+
+        key = (result['cutoff'], result['flags'])
+        if result.get('status') != 'done':
+            self.record_missing(key, result['form'], result.get('error', "job failed"))
+            return None
+
+        try:
+            eigenvalues = self.read_eigenvalues(result)
+        except (FileNotFoundError, KeyError, OSError, ValueError) as error:
+            self.record_missing(key, result['form'], repr(error))
+            return None
+
+        return self.add_form(key, result['form'], eigenvalues)
+
+    def read_eigenvalues(self, result):
+        """ Gets eigenvalues of a job result.
+        """
+        if 'eigenvalues' in result:
+            return result['eigenvalues']
+        if self.store_path is not None:
+            return store.read_eigenvalues(self.store_path, \
+                (self.pdb_id, result['cutoff'], result['flags'], result['form']))
+
+        return prowt.parse_eigenfacs(join_paths(result['output_subdir'], "matrix.eigenfacs"))[1]
+
+    def add_form(self, key, form, eigenvalues):
+        """ Adds eigenvalues of a form of run key (cutoff, flags) and
+            processes the run once all forms are there.
+            Returns results table of the run, if processed.
+        """
+        forms = self.pending.setdefault(key, {})
+        forms[form] = eigenvalues
+        # Form may have been missing earlier, e.g. before a retry
+        self.missing = [missing for missing in self.missing if missing[:3] != key + (form,)]
+        if sorted(forms) != coop.FORMS:
+            return None
+        del self.pending[key]
+
+        keys = pd.DataFrame([key], columns=coop.RUN_NAMES)
+        eigenvalues = coop.stack_runs([[forms[form_idx] for form_idx in coop.FORMS]])
+        table = coop.process_grid(keys, eigenvalues)
+        coop.save_table(table, self.output_dir)
+        self.tables.append(table)
+
+        return table
+
+    def record_missing(self, key, form, reason):
+        """ Records missing or partial form of a run.
+        """
+        print("Run {} {} form {} is missing: {}".format(*key, form, reason))
+        self.missing.append(key + (form, reason))
+
+        return None
+
+    def close(self):
+        """ Records runs with forms still missing, saves missing.csv
+            (if any) and returns results table of all processed runs.
+        """
+        for key, forms in self.pending.items():
+            for form in sorted(set(coop.FORMS) - set(forms)):
+                if not any(missing[:3] == key + (form,) for missing in self.missing):
+                    self.record_missing(key, form, "no result")
+        self.pending = {}
+
+        if self.missing:
+            os.makedirs(self.output_dir, exist_ok=True)
+            # (cooperativity and process_wt import this module,
+            # so RUN_NAMES is only looked up at run time)
+            pd.DataFrame(self.missing, columns=coop.RUN_NAMES + ['form', 'reason']) \
+                .to_csv(join_paths(self.output_dir, "missing.csv"), index=False)
+
+        if not self.tables:
+            return pd.DataFrame(columns=coop.RUN_NAMES + ['mode_number'])
+
+        return pd.concat(self.tables, ignore_index=True)
+
+
+def process_tree(input_dir, output_dir):
+    """ Processes all runs in results directory tree,
+        e.g. "data/raw/-c09.50/-mass-ca-het/0", at once.
+        Returns results table.
+    """
+    stream = CooperativityStream(output_dir)
+    for key, form, filepath in tree_files(input_dir):
+        add_file(stream, key, form, filepath)
+
+    return stream.close()
+
+def tree_files(input_dir):
+    """ Lists (run key, form, matrix.eigenfacs filepath) of results
+        directory tree; files may not exist yet.
+    """
+    files = []
+    # Cutoff directories (-cXX.XX, -pf), not e.g. occupancy/
+    for flag_path in sorted(glob.glob(join_paths(input_dir, "-*", "*"))):
+        if not os.path.isdir(flag_path):
+            continue
+        cutoff_path, other_flags = os.path.split(flag_path)
+        key = (os.path.basename(cutoff_path), other_flags)
+        for form in coop.FORMS:
+            files.append((key, form, join_paths(flag_path, form, "matrix.eigenfacs")))
+
+    return files
+
+def add_file(stream, key, form, filepath):
+    """ Parses matrix.eigenfacs file and adds it to the stream; missing
+        and partial files are recorded.
+    """
+    try:
+        _, eigenvalues, _ = prowt.parse_eigenfacs(filepath)
+    except (FileNotFoundError, ValueError) as error:
+        return stream.record_missing(key, form, repr(error))
+
+    return stream.add_form(key, form, eigenvalues)
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+""" Timing and memory instrumentation for the pipeline stages.
+
+    Stages and ENM jobs are wrapped with stage() or traced(), which
+    record wall time, CPU time (of the calling thread and of finished
+    child processes, e.g. pool workers), the peak resident set size
+    (RSS) of the process so far and its growth during the stage as JSON
+    lines in the trace file given by the PIPELINE_TRACE environment
+    variable (e.g. in .env). Without it, nothing is recorded.
+    Worker processes inherit the variable and append to the same file.
+
+    Summarise a trace or convert it for chrome://tracing (or Perfetto):
+    $ python -m src.instrument summary trace.jsonl
+    $ python -m src.instrument chrome trace.jsonl trace.json
+"""
+import click
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+TRACE_VARIABLE = "PIPELINE_TRACE"
+
+
+@click.group()
+def main_commandline():
+    """ Reports pipeline traces.
+    """
+
+@main_commandline.command(name='summary')
+@click.argument('trace_path', type=click.Path(exists=True))
+def summary_commandline(trace_path):
+    """ Prints time and memory summary of trace by stage.
+    """
+    click.echo(summary(trace_path).to_string())
+
+@main_commandline.command(name='chrome')
+@click.argument('trace_path', type=click.Path(exists=True))
+@click.argument('output_path', type=click.Path())
+def chrome_commandline(trace_path, output_path):
+    """ Converts trace into Chrome trace format.
+    """
+    to_chrome_trace(trace_path, output_path)
+
+
+def configure(trace_path):
+    """ Enables tracing into trace_path for this process and worker
+        processes started afterwards. None keeps the current setting.
+    """
+    if trace_path is not None:
+        os.environ[TRACE_VARIABLE] = os.path.abspath(trace_path)
+
+    return None
+
+def trace_path():
+    """ Returns current trace file path, None if tracing is off.
+    """
+    return os.environ.get(TRACE_VARIABLE) or None
+
+def children_cpu():
+    """ User and system CPU time of finished (waited for) child
+        processes of the process so far (s).
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return usage.ru_utime + usage.ru_stime
+
+def peak_rss():
+    """ Peak resident set size of the process so far (kB).
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports kB, macOS bytes
+    return max_rss // 1024 if os.uname().sysname == "Darwin" else max_rss
+
+@contextmanager
+def stage(name, category="stage", **args):
+    """ Records wall time, CPU time of the calling thread (cpu), CPU
+        time of child processes finished during the enclosed block
+        (child_cpu, process-wide, so it includes children of stages
+        running in other threads), peak RSS of the process so far
+        (process_peak_rss) and its growth during the block (rss_growth,
+        zero if the block stays below an earlier peak).
+        args (JSON serialisable) are added to the trace event.
+    """
+    path = trace_path()
+    if path is None:
+        yield
+        return
+
+    start_time = time.time()
+    start_counter = time.perf_counter()
+    start_cpu = time.thread_time()
+    start_child_cpu = children_cpu()
+    start_rss = peak_rss()
+    try:
+        yield
+    finally:
+        end_rss = peak_rss()
+        end_child_cpu = children_cpu()
+        event = {'name': name, 'cat': category, 'ts': start_time,
+                 'wall': time.perf_counter() - start_counter,
+                 'cpu': time.thread_time() - start_cpu,
+                 'child_cpu': None if end_child_cpu is None else \
+                     end_child_cpu - start_child_cpu,
+                 'process_peak_rss': end_rss,
+                 'rss_growth': None if end_rss is None else end_rss - start_rss,
+                 'pid': os.getpid(), 'tid': threading.get_ident(),
+                 'args': args}
+        write_event(path, event)
+
+def traced(name=None, category="function"):
+    """ Decorator recording every call of a function as a stage
+        (named after the function by default).
+    """
+    def decorator(func):
+        stage_name = name or "{}.{}".format(func.__module__.split(".")[-1], func.__name__)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name, category=category):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+def write_event(trace_path, event):
+    """ Appends trace event as a single line, so that concurrent
+        processes do not interleave events.
+    """
+    line = (json.dumps(event, default=str) + "\n").encode()
+    file_descriptor = os.open(trace_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(file_descriptor, line)
+    finally:
+        os.close(file_descriptor)
+
+    return None
+
+def read_trace(trace_path):
+    """ Reads trace events into DataFrame.
+    """
+    with open(trace_path) as file:
+        events = [json.loads(line) for line in file if line.strip()]
+
+    return pd.DataFrame(events, columns=['name', 'cat', 'ts', 'wall', 'cpu', 'child_cpu', \
+        'process_peak_rss', 'rss_growth', 'pid', 'tid', 'args'])
+
+def summary(trace_path):
+    """ Summarises trace by stage: number of calls, total and mean wall
+        time, total CPU time of the stage threads and of child processes
+        (s), maximum peak RSS of the process and maximum RSS growth
+        during the stage (MB), sorted by total wall time.
+    """
+    events = read_trace(trace_path)
+    report = events.groupby(['cat', 'name']).agg(
+        calls=('wall', 'size'), wall_total=('wall', 'sum'), wall_mean=('wall', 'mean'),
+        cpu_total=('cpu', 'sum'), child_cpu_total=('child_cpu', 'sum'),
+        process_peak_rss_mb=('process_peak_rss', 'max'),
+        rss_growth_mb=('rss_growth', 'max'))
+    report[['process_peak_rss_mb', 'rss_growth_mb']] /= 1024
+
+    return report.sort_values('wall_total', ascending=False)
+
+def to_chrome_trace(trace_path, output_path):
+    """ Converts trace into Chrome trace format (complete events,
+        times in microseconds).
+    """
+    events = read_trace(trace_path)
+    chrome_events = [{'name': event.name, 'cat': event.cat, 'ph': 'X',
+                      'ts': event.ts * 1e6, 'dur': event.wall * 1e6,
+                      'pid': event.pid, 'tid': event.tid,
+                      'args': dict(event.args, cpu=event.cpu, child_cpu=event.child_cpu, \
+                          process_peak_rss=event.process_peak_rss, rss_growth=event.rss_growth)}
+                     for event in events.itertuples(index=False)]
+
+    with open(output_path, 'w') as file:
+        json.dump({'traceEvents': chrome_events, 'displayTimeUnit': 'ms'}, file)
+
+    return None
+
+
+if __name__ == '__main__':
+    main_commandline()
@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 """ This is the master script for recreating the results.
 
-    It imports each of the key module fucntions 
-    and runs them one by one.
+    It runs the pipeline stages (see src/pipeline.py) for the PDB ID
+    (or ID list) in config.yaml; stages that are up to date are skipped.
 
     Run the whole thing from the root directory 
     to replicate all the results:
@@ -10,16 +10,18 @@
     $ python -m src.main
 """
 
+import logging
 import src.utilities as utils
-import src.structure as struct
-import src.simulation as sim
-import src.data as data
-import src.visualization as viz
+import src.instrument as instr
+import src.pipeline as pipeline
+
+log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+logging.basicConfig(level=logging.INFO, format=log_fmt)
 
 config = utils.read_config()
 # utils.clean()
-struct.download_pdb.main(config['pdb']['rawFilePath'])
-# mkpdb.main(config['pdb']['rawFilePath'])
-# simenm.main(config['pdb']['proFilePath'], config['data']['rawFilePath'])
-# prowt.main(config['data']['rawFilePath'], config['data']['proFilePath'])
-# viz.main(config['data']['proFilePath'], config['data']['outPathScratch'])
\ No newline at end of file
+pipeline.main(utils.pdb_codes(config))
+
+# Stage timing and memory trace (data.traceFilePath), see src/instrument.py
+if instr.trace_path() is not None:
+    print(instr.summary(instr.trace_path()).to_string())
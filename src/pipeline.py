@@ -0,0 +1,420 @@
+#!/usr/bin/env python
+""" Pipeline runner: download -> transform_pdb -> process_pdb ->
+    simulate_enm -> process_wt -> visualize as a DAG of stages.
+
+    Every stage declares its input and output files (or directories)
+    and is run for one PDB ID (and one structural form for process_pdb).
+    A stage depends on the stages producing its inputs. Stages are rerun
+    only if the content hashes of their inputs or parameters changed, or
+    their outputs are missing or were modified, since their last
+    successful run (recorded in the state file, see config.yaml).
+    Independent branches (PDB IDs, forms) run concurrently.
+
+    Run from the root directory:
+    $ python -m src.pipeline run
+    $ python -m src.pipeline run 3r6s 1m9a --target simulate_enm
+    $ python -m src.pipeline run --ids-file homodimers.txt
+    $ python -m src.pipeline status
+
+    Batch runs over many PDB IDs (an ID list or file, see config.yaml)
+    bound the number of concurrent stages of every kind and keep a
+    per-structure status table up to date.
+"""
+import click
+import hashlib
+import importlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from os.path import join as join_paths
+import pandas as pd
+import src.utilities as utils
+import src.instrument as instr
+
+STAGE_KINDS = ['download', 'transform_pdb', 'process_pdb', 'simulate_enm', \
+    'process_wt', 'visualize']
+FORMS = [0, 1, 2]
+
+
+@click.group()
+def main_commandline():
+    """ Runs the pipeline.
+    """
+
+@main_commandline.command(name='run')
+@click.argument('pdb_codes', nargs=-1)
+@click.option('--ids-file', type=click.Path(exists=True), default=None, \
+    help="File with PDB IDs (one per line).")
+@click.option('--target', type=click.Choice(STAGE_KINDS), default=None, \
+    help="Last stage to run (default: all stages).")
+@click.option('--force', is_flag=True, help="Rerun stages even if up to date.")
+@click.option('--workers', type=int, default=None, help="Concurrent stages.")
+def run_commandline(pdb_codes, ids_file, target, force, workers):
+    """ Runs outdated stages for PDB IDs (default: PDB IDs in config.yaml).
+    """
+    pdb_codes = command_line_codes(pdb_codes, ids_file)
+    results = main(pdb_codes or None, target=target, force=force, workers=workers)
+    click.echo(status_table(results).to_string())
+
+@main_commandline.command(name='status')
+@click.argument('pdb_codes', nargs=-1)
+@click.option('--ids-file', type=click.Path(exists=True), default=None, \
+    help="File with PDB IDs (one per line).")
+def status_commandline(pdb_codes, ids_file):
+    """ Shows which stages of every structure are up to date.
+    """
+    pdb_codes = command_line_codes(pdb_codes, ids_file)
+    click.echo(status(pdb_codes or None).to_string())
+
+def command_line_codes(pdb_codes, ids_file):
+    """ PDB IDs given as arguments followed by those in ids_file,
+        each once.
+    """
+    if ids_file is not None:
+        pdb_codes = pdb_codes + tuple(utils.read_pdb_codes(ids_file))
+
+    return list(dict.fromkeys(pdb_codes))
+
+
+def main(pdb_codes=None, target=None, force=False, workers=None):
+    """ Runs outdated pipeline stages for PDB IDs up to target stage.
+        PDB IDs default to the ID list (or ID) in config.yaml. Stages
+        are traced into data.traceFilePath, if set (see instrument.py).
+        Returns list of stage results.
+    """
+    config = utils.read_config()
+    instr.configure(config['data']['traceFilePath'])
+    if pdb_codes is None:
+        pdb_codes = utils.pdb_codes(config)
+    if workers is None:
+        workers = config['pipeline']['workers']
+
+    stages = select_stages(build_stages(pdb_codes, config), target)
+
+    return run_stages(stages, config['pipeline']['stateFilePath'], workers=workers, \
+        stage_workers=config['pipeline']['stageWorkers'], force=force, \
+        status_path=config['pipeline']['statusFilePath'])
+
+def status(pdb_codes=None):
+    """ Reports stages of every structure as up to date or outdated
+        (any form outdated for process_pdb). Returns DataFrame indexed
+        by PDB ID.
+    """
+    config = utils.read_config()
+    if pdb_codes is None:
+        pdb_codes = utils.pdb_codes(config)
+
+    state = load_state(config['pipeline']['stateFilePath'])
+    rows = [{'pdb_id': stage['pdb_id'], 'kind': stage['kind'], \
+             'up_to_date': is_up_to_date(stage, state)} \
+            for stage in build_stages(pdb_codes, config)]
+    table = pd.DataFrame(rows).groupby(['pdb_id', 'kind'], sort=False)['up_to_date'] \
+        .all().unstack()
+
+    return table[STAGE_KINDS].replace({True: "up to date", False: "outdated"})
+
+def build_stages(pdb_codes, config):
+    """ Lists stages for every PDB ID (duplicates are ignored). Every
+        PDB ID gets its own subdirectory after the (shared) raw and
+        interim PDB directories. Stage functions are given by module and
+        function name and are imported when the stage runs.
+    """
+    pdb = config['pdb']
+    data = config['data']
+
+    stages = []
+    for pdb_code in dict.fromkeys(pdb_codes):
+        raw_pdb_path = join_paths(pdb['rawFilePath'], "{}.pdb1".format(pdb_code))
+        interim_pdb_path = join_paths(pdb['intFilePath'], "{}.pdb".format(pdb_code))
+        forms_dir = join_paths(pdb['proFilePath'], pdb_code)
+        form_paths = [join_paths(forms_dir, "{}.pdb".format(form_idx)) for form_idx in FORMS]
+        raw_dir = join_paths(data['rawFilePath'], pdb_code)
+        processed_dir = join_paths(data['proFilePath'], pdb_code)
+        figures_dir = join_paths(data['outPathScratch'], pdb_code)
+
+        stages.append(make_stage('download', pdb_code, 'src.structure.download_pdb', \
+            'download_pdb', args=[pdb_code, pdb['rawFilePath']], \
+            outputs=[raw_pdb_path]))
+        stages.append(make_stage('transform_pdb', pdb_code, 'src.structure.transform_pdb', \
+            'main', args=[pdb['rawFilePath'], pdb['intFilePath']], \
+            kwargs={'pdb_code': pdb_code}, inputs=[raw_pdb_path], \
+            outputs=[interim_pdb_path]))
+        for form_idx, form_path in zip(FORMS, form_paths):
+            stages.append(make_stage('process_pdb', pdb_code, 'src.structure.process_pdb', \
+                'main', args=[pdb['intFilePath'], forms_dir], \
+                kwargs={'pdb_code': pdb_code, 'form_idxs': [form_idx]}, \
+                inputs=[interim_pdb_path], outputs=[form_path], \
+                label="{} {}".format(pdb_code, form_idx)))
+        # ENM settings are parameters of the scan. Cooperativity is not
+        # streamed into processed_dir, which is the output of process_wt
+        enm_params = {key: value for key, value in config['enm'].items() \
+            if key != 'streamProcessing'}
+        stages.append(make_stage('simulate_enm', pdb_code, 'src.simulation.simulate_enm', \
+            'main', args=[forms_dir, raw_dir], \
+            kwargs={'pdb_code': pdb_code, 'stream_processing': False}, \
+            inputs=form_paths, outputs=[raw_dir], params=enm_params))
+        # Reads the HDF5 result store, if storeFilePath is set
+        stages.append(make_stage('process_wt', pdb_code, 'src.data.process_wt', 'main', \
+            args=[raw_dir, processed_dir], kwargs={'pdb_id': pdb_code}, inputs=[raw_dir], \
+            outputs=[processed_dir], params={'storeFilePath': config['enm']['storeFilePath']}))
+        stages.append(make_stage('visualize', pdb_code, 'src.visualization.visualize', \
+            'main', args=[processed_dir, figures_dir], inputs=[processed_dir], \
+            outputs=[figures_dir], params=config['viz']))
+
+    return stages
+
+def make_stage(kind, pdb_code, module, function, args=(), kwargs=None, inputs=(), \
+    outputs=(), params=None, label=None):
+    """ Describes a pipeline stage of a structure: function
+        module.function(*args, **kwargs) reading inputs and writing
+        outputs (file or directory paths). params are extra settings
+        the outputs depend on.
+    """
+    return {'name': "{} {}".format(kind, label or pdb_code), 'kind': kind, \
+        'pdb_id': pdb_code, 'module': module, 'function': function, 'args': list(args), \
+        'kwargs': kwargs or {}, 'inputs': list(inputs), 'outputs': list(outputs), \
+        'params': params}
+
+def select_stages(stages, target=None):
+    """ Selects stages up to target stage kind (and their upstream stages).
+    """
+    if target is None:
+        return stages
+    last_kind = STAGE_KINDS.index(target)
+
+    return [stage for stage in stages if STAGE_KINDS.index(stage['kind']) <= last_kind]
+
+def stage_dependencies(stages):
+    """ Maps every stage name to names of stages producing its inputs
+        (an input is produced by a stage if it is, or lies in, one of
+        its outputs).
+    """
+    producers = [(os.path.normpath(output), stage['name']) for stage in stages \
+        for output in stage['outputs']]
+    dependencies = {}
+    for stage in stages:
+        dependencies[stage['name']] = set()
+        for stage_input in map(os.path.normpath, stage['inputs']):
+            for output, producer in producers:
+                if stage_input == output or stage_input.startswith(output + os.sep):
+                    dependencies[stage['name']].add(producer)
+
+    return dependencies
+
+def run_stages(stages, state_path, workers=4, stage_workers=None, force=False, \
+    status_path=None):
+    """ Runs stages in dependency order, independent stages concurrently
+        on workers threads (stages spawn their own worker processes,
+        e.g. the ENM scan). stage_workers bounds concurrent stages of
+        every kind, e.g. {'simulate_enm': 1}. A failed stage blocks its
+        downstream stages but not independent branches. The per-structure
+        status table is saved in status_path (if given) as stages finish.
+        Returns list of stage results.
+    """
+    logger = logging.getLogger(__name__)
+    dependencies = stage_dependencies(stages)
+    stage_workers = stage_workers or {}
+    for kind, no_workers in stage_workers.items():
+        # Stages of a kind without workers would never run
+        if not isinstance(no_workers, int) or no_workers < 1:
+            raise ValueError("stageWorkers of {} must be a positive integer, got {!r}" \
+                .format(kind, no_workers))
+    state = load_state(state_path)
+    state_lock = threading.Lock()
+
+    results = {}
+    pending = {stage['name']: stage for stage in stages}
+    running = {kind: 0 for kind in STAGE_KINDS}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        while pending or futures:
+            for name, stage in list(pending.items()):
+                upstream = [results.get(dependency) for dependency in dependencies[name]]
+                if any(result is None for result in upstream):
+                    continue
+                if any(result['status'] in ['failed', 'blocked'] for result in upstream):
+                    del pending[name]
+                    results[name] = stage_result(stage, 'blocked')
+                    continue
+                if running[stage['kind']] >= stage_workers.get(stage['kind'], workers):
+                    continue
+                del pending[name]
+                running[stage['kind']] += 1
+                futures[executor.submit(run_stage, stage, state, state_lock, \
+                    state_path, force)] = stage
+            if not futures:
+                continue
+
+            finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = futures.pop(future)
+                running[stage['kind']] -= 1
+                result = future.result()
+                results[stage['name']] = result
+                logger.info("%-40s %-8s %9.2f s", result['stage'], result['status'], \
+                    result['wall_time'])
+            if status_path is not None:
+                save_status(status_path, status_table(results.values()))
+
+    return [results[stage['name']] for stage in stages]
+
+def run_stage(stage, state, state_lock, state_path, force=False):
+    """ Runs stage unless it is up to date and records its input
+        and output hashes in the state file. Returns stage result.
+    """
+    start_time = time.time()
+    with state_lock:
+        input_digest = inputs_digest(stage, state)
+        if not force and is_up_to_date(stage, state, input_digest):
+            return stage_result(stage, 'skipped')
+
+    for output in stage['outputs']:
+        # Output directories and parent directories of output files
+        os.makedirs(output if not os.path.splitext(output)[1] else \
+            os.path.dirname(output) or ".", exist_ok=True)
+    try:
+        func = getattr(importlib.import_module(stage['module']), stage['function'])
+        with instr.stage(stage['name'], category="pipeline"):
+            func(*stage['args'], **stage['kwargs'])
+    except Exception as error:
+        logging.getLogger(__name__).error("Stage %s failed: %r", stage['name'], error)
+        return stage_result(stage, 'failed', time.time() - start_time, repr(error))
+
+    with state_lock:
+        state['stages'][stage['name']] = {'inputs': input_digest, \
+            'outputs': outputs_digest(stage, state), 'end_time': time.time()}
+        save_state(state_path, state)
+
+    return stage_result(stage, 'done', time.time() - start_time)
+
+def stage_result(stage, status, wall_time=0.0, error=None):
+    """ Result of a stage run: status is done, skipped (up to date),
+        failed or blocked (by a failed upstream stage).
+    """
+    return {'stage': stage['name'], 'pdb_id': stage['pdb_id'], 'kind': stage['kind'], \
+        'status': status, 'wall_time': wall_time, 'error': error}
+
+def status_table(results):
+    """ Tabulates stage results per structure: status of every stage
+        kind (the worst one over forms), total wall time and the first
+        error. Returns DataFrame indexed by PDB ID.
+    """
+    results = pd.DataFrame(results, columns=['stage', 'pdb_id', 'kind', 'status', \
+        'wall_time', 'error'])
+    # Worst status first
+    results['status'] = pd.Categorical(results['status'], \
+        categories=['failed', 'blocked', 'done', 'skipped'], ordered=True)
+
+    table = results.groupby(['pdb_id', 'kind'], observed=True)['status'].min().unstack()
+    table = table.reindex(columns=[kind for kind in STAGE_KINDS if kind in table.columns])
+    table['wall_time'] = results.groupby('pdb_id')['wall_time'].sum()
+    table['error'] = results.dropna(subset=['error']).groupby('pdb_id')['error'].first()
+
+    return table
+
+def save_status(status_path, table):
+    """ Saves per-structure status table as CSV file.
+    """
+    os.makedirs(os.path.dirname(status_path) or ".", exist_ok=True)
+    table.to_csv(status_path)
+
+    return None
+
+def is_up_to_date(stage, state, input_digest=None):
+    """ Checks that stage ran with the current inputs and parameters and
+        that its outputs exist and are unchanged since.
+    """
+    record = state['stages'].get(stage['name'])
+    if record is None:
+        return False
+    if input_digest is None:
+        input_digest = inputs_digest(stage, state)
+    if record['inputs'] != input_digest:
+        return False
+    if not all(os.path.exists(output) for output in stage['outputs']):
+        return False
+
+    return record['outputs'] == outputs_digest(stage, state)
+
+def inputs_digest(stage, state):
+    """ Hashes stage function, arguments, parameters and input contents.
+    """
+    description = {key: stage[key] for key in ['module', 'function', 'args', 'kwargs', \
+        'params']}
+    description['inputs'] = [path_digest(path, state['files']) for path in stage['inputs']]
+
+    return hashlib.sha256(json.dumps(description, sort_keys=True, default=str) \
+        .encode()).hexdigest()
+
+def outputs_digest(stage, state):
+    """ Hashes stage output contents.
+    """
+    digests = [path_digest(path, state['files']) for path in stage['outputs']]
+
+    return hashlib.sha256(json.dumps(digests).encode()).hexdigest()
+
+def path_digest(path, file_digests):
+    """ Content hash of file or directory tree (file names and contents);
+        None if path does not exist.
+    """
+    if os.path.isfile(path):
+        return file_digest(path, file_digests)
+    if not os.path.isdir(path):
+        return None
+
+    digest = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            filepath = join_paths(dirpath, filename)
+            digest.update(os.path.relpath(filepath, path).encode())
+            digest.update(file_digest(filepath, file_digests).encode())
+
+    return digest.hexdigest()
+
+def file_digest(filepath, file_digests):
+    """ sha256 of file contents. Digests are cached by file path with
+        size and modification time, so unchanged files are not reread.
+    """
+    stat = os.stat(filepath)
+    cached = file_digests.get(filepath)
+    if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return cached[2]
+
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    file_digests[filepath] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+
+    return file_digests[filepath][2]
+
+def load_state(state_path):
+    """ Loads pipeline state: stage records and cached file digests.
+    """
+    try:
+        with open(state_path) as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return {'stages': {}, 'files': {}}
+
+def save_state(state_path, state):
+    """ Saves pipeline state atomically.
+    """
+    os.makedirs(os.path.dirname(state_path) or ".", exist_ok=True)
+    tmp_path = "{}.tmp".format(state_path)
+    with open(tmp_path, 'w') as file:
+        json.dump(state, file)
+    os.replace(tmp_path, state_path)
+
+    return None
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main_commandline()
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+""" Content-addressed cache of native ENM results.
+
+    Results are keyed by a hash of the EN bead coordinates and masses,
+    the GENENMM flags, the solver options and the engine version, so
+    unchanged (form, cutoff, flags) combinations are never recomputed.
+    The cache is size-bounded with least-recently-used eviction.
+
+    List and prune entries from the command line:
+    $ python -m src.simulation.cache list tmp/enm-cache
+    $ python -m src.simulation.cache prune tmp/enm-cache --max-size 5
+"""
+import click
+import hashlib
+import json
+import os
+import time
+from os.path import join as join_paths
+import numpy as np
+import pandas as pd
+import src.simulation.enm as enm
+import src.structure.symmetry as symmetry
+
+CACHE_EXTENSION = ".npz"
+
+
+@click.group()
+def main_commandline():
+    """ Manages content-addressed cache of ENM results.
+    """
+
+@main_commandline.command(name='list')
+@click.argument('cache_dir', type=click.Path(exists=True))
+def list_commandline(cache_dir):
+    """ Lists cache entries, least recently used first.
+    """
+    entries = list_entries(cache_dir)
+    click.echo(entries.to_string(index=False))
+    click.echo("{} entries, {:.3f} GB".format(entries.shape[0], entries['size'].sum() / 1e9))
+
+@main_commandline.command(name='prune')
+@click.argument('cache_dir', type=click.Path(exists=True))
+@click.option('--max-size', type=float, default=None, help="Maximum cache size (GB).")
+@click.option('--max-age', type=float, default=None, help="Maximum days since last use.")
+def prune_commandline(cache_dir, max_size, max_age):
+    """ Evicts least recently used cache entries.
+    """
+    max_size = None if max_size is None else max_size * 1e9
+    max_age = None if max_age is None else max_age * 86400
+    removed = prune(cache_dir, max_size=max_size, max_age=max_age)
+    click.echo("Removed {} entries".format(removed))
+
+
+def cache_key(coords, masses, flags, operators=None, **solver_options):
+    """ Hashes EN beads, GENENMM flags, symmetry operators (symmetric
+        mode), solver options and engine version.
+    """
+    digest = hashlib.sha256()
+    digest.update(enm.ENGINE_VERSION.encode())
+    digest.update(np.ascontiguousarray(coords, dtype=float).tobytes())
+    digest.update(np.ascontiguousarray(masses, dtype=float).tobytes())
+    digest.update(json.dumps(flags, sort_keys=True).encode())
+    digest.update(json.dumps(solver_options, sort_keys=True).encode())
+    for rotation, translation in operators or []:
+        digest.update(np.ascontiguousarray(rotation, dtype=float).tobytes())
+        digest.update(np.ascontiguousarray(translation, dtype=float).tobytes())
+
+    return digest.hexdigest()
+
+def entry_path(cache_dir, key):
+    """ Returns file path of a cache entry.
+    """
+    return join_paths(cache_dir, key[:2], key + CACHE_EXTENSION)
+
+def get(cache_dir, key):
+    """ Returns cached eigenvalues and eigenvectors, or None on a miss.
+        A hit marks the entry as recently used.
+    """
+    path = entry_path(cache_dir, key)
+    try:
+        with np.load(path) as entry:
+            result = entry['eigenvalues'], entry['eigenvectors']
+        os.utime(path)
+    except (FileNotFoundError, OSError, ValueError):
+        # Missing, evicted concurrently or partially written
+        return None
+
+    return result
+
+def put(cache_dir, key, eigenvalues, eigenvectors, max_size=None):
+    """ Stores eigenvalues and eigenvectors; evicts least recently used
+        entries if the cache grows beyond max_size (bytes).
+    """
+    path = entry_path(cache_dir, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Write to a temporary file first, so readers never see partial entries
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, 'wb') as file:
+        np.savez(file, eigenvalues=eigenvalues, eigenvectors=eigenvectors)
+    os.replace(tmp_path, path)
+
+    if max_size is not None:
+        prune(cache_dir, max_size=max_size)
+
+    return None
+
+def list_entries(cache_dir):
+    """ Lists cache entries (key, size in bytes, last use time),
+        least recently used first.
+    """
+    entries = []
+    for root, _, filenames in os.walk(cache_dir):
+        for filename in filenames:
+            if not filename.endswith(CACHE_EXTENSION):
+                continue
+            try:
+                stat = os.stat(join_paths(root, filename))
+            except FileNotFoundError:
+                continue
+            entries.append((filename[:-len(CACHE_EXTENSION)], stat.st_size, stat.st_mtime))
+
+    entries = pd.DataFrame(entries, columns=['key', 'size', 'last_used'])
+    entries = entries.sort_values('last_used', ignore_index=True)
+    entries['last_used'] = pd.to_datetime(entries['last_used'], unit='s')
+
+    return entries
+
+def prune(cache_dir, max_size=None, max_age=None):
+    """ Evicts least recently used entries until the cache is at most
+        max_size bytes, and entries unused for more than max_age seconds.
+        Returns number of removed entries.
+    """
+    entries = list_entries(cache_dir)
+    evict = np.zeros(entries.shape[0], dtype=bool)
+
+    if max_age is not None:
+        age = time.time() - entries['last_used'].astype('int64').to_numpy() / 1e9
+        evict |= age > max_age
+    if max_size is not None:
+        # Sizes remaining from the most recently used entry down
+        kept_size = entries['size'][::-1].cumsum()[::-1].to_numpy()
+        evict |= kept_size > max_size
+
+    for key in entries['key'][evict]:
+        try:
+            os.remove(entry_path(cache_dir, key))
+        except FileNotFoundError:
+            pass
+
+    return int(evict.sum())
+
+def cached_solve(coords, masses, flags, cache_dir=None, max_size=None, operators=None, \
+    **solver_options):
+    """ Solves ENM (see enm.solve_enm), serving results from the cache
+        in cache_dir if possible.
+    """
+    if cache_dir is None:
+        return enm.solve_enm(coords, masses, flags, operators=operators, **solver_options)
+
+    key = cache_key(coords, masses, flags, operators=operators, **solver_options)
+    result = get(cache_dir, key)
+    if result is None:
+        result = enm.solve_enm(coords, masses, flags, operators=operators, **solver_options)
+        put(cache_dir, key, *result, max_size=max_size)
+
+    return result
+
+def cached_run_enm(pdb_filepath, flag_combo, cache_dir=None, max_size=None, **solver_options):
+    """ Runs ENM for a PDB file (see enm.run_enm) with result cache.
+    """
+    flags = enm.parse_flags(flag_combo)
+    coords, masses = enm.load_beads(pdb_filepath, flags)
+    operators = None
+    if solver_options.get('mode') == "symmetric":
+        operators = symmetry.pdb_operators(pdb_filepath)
+
+    return cached_solve(coords, masses, flags, cache_dir=cache_dir, max_size=max_size, \
+        operators=operators, **solver_options)
+
+
+if __name__ == '__main__':
+    main_commandline()
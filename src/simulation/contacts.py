@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+""" Spatial-index (KD-tree) contact builder for EN beads.
+
+    Replaces the full NxN distance matrix with a compact edge list of
+    bead pairs within a maximum radius, which is all the cutoff search
+    and the ENM engine need.
+"""
+import numpy as np
+import scipy.sparse as sparse
+from scipy.sparse.csgraph import minimum_spanning_tree
+from scipy.spatial import cKDTree
+from src.structure.structure import read_structure
+
+
+def load_ca_coords(pdb_filepath):
+    """ Loads PDB carbon alpha coordinates
+        (through the parse cache, see structure.read_structure).
+    """
+    structure = read_structure(pdb_filepath)
+    is_ca = ~structure.is_hetatm & (structure['atom_name'] == b"CA")
+
+    # Rounding recovers the 3-decimal PDB coordinates (see Structure.to_frame)
+    return structure.coords[is_ca].astype(float).round(3)
+
+def build_contacts(coords, max_radius):
+    """ Finds all bead pairs within max_radius.
+        Returns edge list as a dictionary of arrays: 'i', 'j' (i < j)
+        and 'dist', sorted by distance.
+    """
+    pairs = cKDTree(coords).query_pairs(max_radius, output_type='ndarray')
+    pair_i, pair_j = pairs[:, 0], pairs[:, 1]
+    bond_vectors = coords[pair_j] - coords[pair_i]
+    dist = np.sqrt(np.einsum('ij,ij->i', bond_vectors, bond_vectors))
+
+    order = np.argsort(dist, kind='stable')
+
+    return {'i': pair_i[order].astype(np.int32),
+            'j': pair_j[order].astype(np.int32),
+            'dist': dist[order]}
+
+def within_radius(contacts, radius):
+    """ Returns pair indices of contacts within radius.
+        Contacts must be sorted by distance (see build_contacts).
+    """
+    no_pairs = np.searchsorted(contacts['dist'], radius, side='right')
+
+    return contacts['i'][:no_pairs], contacts['j'][:no_pairs]
+
+def knn_distances(coords, no_neighbours=3):
+    """ Distances from every bead to its no_neighbours nearest beads
+        (excluding itself). Returns Nxno_neighbours array.
+    """
+    dist, _ = cKDTree(coords).query(coords, k=no_neighbours + 1)
+
+    return dist[:, 1:]
+
+def min_springs_cutoff(coords, no_springs=3):
+    """ Finds the smallest isotropic cutoff radius for all EN beads
+        to have at least no_springs springs.
+    """
+    return np.amax(knn_distances(coords, no_neighbours=no_springs)[:, -1])
+
+def connectivity_cutoff(no_beads, contacts):
+    """ Finds the smallest cutoff radius at which the contact graph is
+        connected, i.e. the longest edge of its minimum spanning tree.
+        Returns inf if the graph is not connected within the maximum
+        radius of contacts.
+    """
+    if no_beads < 2:
+        return 0.0
+
+    # Shift distances by one, so that zero-length contacts are kept
+    graph = sparse.coo_matrix((contacts['dist'] + 1.0, (contacts['i'], contacts['j'])),
+                              shape=(no_beads, no_beads))
+    tree = minimum_spanning_tree(graph)
+    if tree.nnz < no_beads - 1:
+        return np.inf
+
+    return tree.data.max() - 1.0
+
+def rigidity_lower_bound(coords, contacts, no_springs=3):
+    """ Cheap lower bound on the smallest non-floppy cutoff radius.
+        Below it the contact graph is either disconnected or has beads
+        with fewer than no_springs springs, so the ENM must be floppy.
+    """
+    return max(connectivity_cutoff(coords.shape[0], contacts),
+               min_springs_cutoff(coords, no_springs=no_springs))
+
+def save_contacts(filepath, contacts):
+    """ Saves contact edge list as compressed NumPy archive.
+    """
+    np.savez_compressed(filepath, i=contacts['i'], j=contacts['j'],
+                        dist=contacts['dist'].astype(np.float32))
+
+    return None
+
+def load_contacts(filepath):
+    """ Loads contact edge list saved with save_contacts.
+    """
+    with np.load(filepath) as archive:
+        contacts = {key: archive[key] for key in ['i', 'j', 'dist']}
+    contacts['dist'] = contacts['dist'].astype(float)
+
+    return contacts
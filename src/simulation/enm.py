@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+""" Native elastic network model (ENM) engine.
+
+    Builds the anisotropic network model (ANM) Hessian for the GENENMM
+    flag set straight from PDB coordinates and diagonalises it in memory,
+    i.e. without the GENENMM/DIAGSTD round-trip of run_enm.sh.
+"""
+import hashlib
+import io
+import warnings
+import numpy as np
+import scipy.sparse as sparse
+from scipy.sparse.linalg import LinearOperator, eigsh, lobpcg, splu
+from scipy.spatial.distance import pdist
+from src.structure.structure import read_structure
+import src.structure.symmetry as symmetry
+import src.structure.occupancy as occupancy
+import src.simulation.contacts as cnt
+import src.instrument as instr
+
+# GENENMM default cutoff radius (angstroms) and spring constant
+DEFAULT_CUTOFF_RADIUS = 8.0
+DEFAULT_SPRING_CONSTANT = 1.0
+
+# Number of trivial (rigid-body) modes
+NO_TRIVIAL_MODES = 6
+# Eigensolver modes of solve_enm
+SOLVER_MODES = ["dense", "sparse", "symmetric"]
+
+# Engine version, part of the result cache key (see cache.py);
+# bump it whenever results of the engine change
+ENGINE_VERSION = "1"
+
+# Standard atomic weights for elements found in PDB files
+ATOMIC_MASSES = {
+    'H': 1.008, 'C': 12.011, 'N': 14.007, 'O': 15.999, 'F': 18.998,
+    'NA': 22.990, 'MG': 24.305, 'P': 30.974, 'S': 32.06, 'CL': 35.45,
+    'K': 39.098, 'CA': 40.078, 'MN': 54.938, 'FE': 55.845, 'CO': 58.933,
+    'NI': 58.693, 'CU': 63.546, 'ZN': 65.38, 'SE': 78.971, 'BR': 79.904,
+    'I': 126.904,
+}
+
+
+def parse_flags(flag_combo):
+    """ Parses GENENMM flag string, e.g. "-mass -ca -het -c 8.00",
+        into a dictionary of engine options.
+    """
+    tokens = flag_combo.split()
+    flags = {'ca': False, 'het': False, 'mass': False, 'res': False,
+             'lig1': False, 'pf': False, 'cutoff': DEFAULT_CUTOFF_RADIUS}
+
+    idx = 0
+    while idx < len(tokens):
+        token = tokens[idx]
+        if token == '-c':
+            flags['cutoff'] = float(tokens[idx+1])
+            idx += 1
+        elif token.lstrip('-') in flags:
+            flags[token.lstrip('-')] = True
+        else:
+            raise ValueError("Unknown GENENMM flag: {}".format(token))
+        idx += 1
+
+    return flags
+
+def atom_masses(records):
+    """ Looks up atomic masses for BioPandas ATOM/HETATM records.
+        Unknown elements are given the mass of carbon.
+    """
+    elements = records['element_symbol'].str.strip().str.upper()
+    return elements.map(ATOMIC_MASSES).fillna(ATOMIC_MASSES['C']).to_numpy()
+
+def select_beads(atom_records, hetatm_records, flags):
+    """ Selects EN beads and their masses from BioPandas ATOM and HETATM
+        records according to GENENMM flags:
+        -ca     protein is represented by carbon alpha atoms only;
+        -het    HETATM records are included in the EN;
+        -mass   beads are weighted by their atomic masses;
+        -res    (with -ca) carbon alpha carries the whole residue mass;
+        -lig1   each ligand (binding site, see occupancy.binding_sites)
+                is represented by its first atom, which carries
+                the whole ligand mass.
+        Without -mass all beads have unit mass.
+    """
+    residue_keys = ['segment_id', 'chain_id', 'residue_number', 'insertion']
+
+    masses = atom_masses(atom_records)
+    if flags['ca']:
+        is_ca = (atom_records['atom_name'] == 'CA').to_numpy()
+        if flags['res']:
+            residue_masses = atom_records.assign(mass=masses) \
+                .groupby(residue_keys, sort=False)['mass'].transform('sum')
+            masses = residue_masses.to_numpy()
+        atom_records = atom_records[is_ca]
+        masses = masses[is_ca]
+
+    coords = [atom_records[['x_coord', 'y_coord', 'z_coord']].to_numpy()]
+    bead_masses = [masses]
+
+    if flags['het'] and hetatm_records.shape[0] > 0:
+        het_masses = atom_masses(hetatm_records)
+        if flags['lig1']:
+            grouped = hetatm_records.assign(mass=het_masses) \
+                .groupby(occupancy.SITE_KEYS, sort=False)
+            first_atoms = grouped.head(1)
+            het_masses = grouped['mass'].sum().to_numpy()
+            hetatm_records = first_atoms
+        coords.append(hetatm_records[['x_coord', 'y_coord', 'z_coord']]
+                      .to_numpy())
+        bead_masses.append(het_masses)
+
+    coords = np.concatenate(coords).astype(float)
+    masses = np.concatenate(bead_masses).astype(float)
+
+    if not flags['mass']:
+        masses = np.ones_like(masses)
+
+    return coords, masses
+
+@instr.traced()
+def load_beads(pdb_filepath, flags):
+    """ Loads EN bead coordinates and masses from a PDB file
+        (through the parse cache, see structure.read_structure).
+    """
+    frame = read_structure(pdb_filepath).to_frame()
+    is_hetatm = (frame['record_name'] == 'HETATM').to_numpy()
+
+    return select_beads(frame[~is_hetatm], frame[is_hetatm], flags)
+
+def spring_blocks(coords, pair_i, pair_j, spring_constants):
+    """ Returns 3x3 off-diagonal Hessian super-elements for springs
+        between beads pair_i and pair_j.
+    """
+    bond_vectors = coords[pair_j] - coords[pair_i]
+    sq_lengths = np.einsum('ij,ij->i', bond_vectors, bond_vectors)
+    scale = spring_constants / sq_lengths
+
+    return -scale[:, None, None] * bond_vectors[:, :, None] \
+        * bond_vectors[:, None, :]
+
+@instr.traced()
+def build_hessian(coords, cutoff=DEFAULT_CUTOFF_RADIUS, parameter_free=False,
+                  spring_constant=DEFAULT_SPRING_CONSTANT, contacts=None):
+    """ Builds dense 3Nx3N ANM Hessian.
+        Cutoff ENM: uniform springs between beads within cutoff radius,
+        taken from contacts edge list (built if not given).
+        pfENM (parameter_free=True): springs between all beads with
+        spring constants scaled as 1/r^2 and no cutoff.
+    """
+    no_beads = coords.shape[0]
+
+    if parameter_free:
+        pair_i, pair_j = np.triu_indices(no_beads, k=1)
+        spring_constants = spring_constant / pdist(coords) ** 2
+    else:
+        pair_i, pair_j = cutoff_pairs(coords, cutoff, contacts=contacts)
+        spring_constants = np.full(pair_i.shape[0], spring_constant)
+
+    blocks = spring_blocks(coords, pair_i, pair_j, spring_constants)
+
+    return assemble_hessian(no_beads, pair_i, pair_j, blocks)
+
+def assemble_hessian(no_beads, pair_i, pair_j, blocks):
+    """ Assembles dense Hessian from off-diagonal super-elements.
+        Diagonal super-elements are minus the sum of the row.
+    """
+    hessian = np.zeros((3 * no_beads, 3 * no_beads))
+    add_springs(hessian, pair_i, pair_j, blocks)
+
+    return hessian
+
+def add_springs(hessian, pair_i, pair_j, blocks, masses=None):
+    """ Adds springs to dense Hessian in place. Each pair must appear
+        only once. If masses are given, super-elements are mass-weighted
+        before they are added.
+    """
+    no_beads = hessian.shape[0] // 3
+    hessian_blocks = hessian.reshape(no_beads, 3, no_beads, 3)
+
+    diagonal_i, diagonal_j = -blocks, -blocks
+    if masses is not None:
+        blocks = blocks / np.sqrt(masses[pair_i] * masses[pair_j])[:, None, None]
+        diagonal_i = diagonal_i / masses[pair_i][:, None, None]
+        diagonal_j = diagonal_j / masses[pair_j][:, None, None]
+
+    hessian_blocks[pair_i, :, pair_j, :] += blocks
+    hessian_blocks[pair_j, :, pair_i, :] += blocks
+    diagonal = np.zeros((no_beads, 3, 3))
+    np.add.at(diagonal, pair_i, diagonal_i)
+    np.add.at(diagonal, pair_j, diagonal_j)
+    bead_idxs = np.arange(no_beads)
+    hessian_blocks[bead_idxs, :, bead_idxs, :] += diagonal
+
+    return None
+
+def mass_weight(hessian, masses):
+    """ Mass-weights Hessian: M^(-1/2) H M^(-1/2).
+    """
+    inv_sqrt_mass = np.repeat(1.0 / np.sqrt(masses), 3)
+
+    return hessian * inv_sqrt_mass[:, None] * inv_sqrt_mass[None, :]
+
+@instr.traced()
+def build_sparse_hessian(coords, pair_i, pair_j, spring_constants):
+    """ Builds sparse (CSR) 3Nx3N ANM Hessian from a neighbour list.
+        Memory scales with the number of springs, not N^2.
+    """
+    no_beads = coords.shape[0]
+    blocks = spring_blocks(coords, pair_i, pair_j, spring_constants)
+
+    # Row and column indices of 3x3 super-elements
+    xyz = np.arange(3)
+    rows_i = (3 * pair_i[:, None, None] + xyz[None, :, None]).repeat(3, axis=2)
+    cols_j = (3 * pair_j[:, None, None] + xyz[None, None, :]).repeat(3, axis=1)
+    rows_j = (3 * pair_j[:, None, None] + xyz[None, :, None]).repeat(3, axis=2)
+    cols_i = (3 * pair_i[:, None, None] + xyz[None, None, :]).repeat(3, axis=1)
+
+    rows = np.concatenate([rows_i, rows_j, rows_i, rows_j], axis=None)
+    cols = np.concatenate([cols_j, cols_i, cols_i, cols_j], axis=None)
+    values = np.concatenate([blocks, blocks, -blocks, -blocks], axis=None)
+
+    hessian = sparse.coo_matrix((values, (rows, cols)),
+                                shape=(3 * no_beads, 3 * no_beads))
+
+    return hessian.tocsr()
+
+def cutoff_pairs(coords, cutoff=DEFAULT_CUTOFF_RADIUS, contacts=None):
+    """ Returns pair indices (i < j) of beads within cutoff radius.
+        A precomputed contacts edge list with a maximum radius of at
+        least cutoff can be reused (see contacts.py).
+    """
+    if contacts is None:
+        contacts = cnt.build_contacts(coords, cutoff)
+
+    return cnt.within_radius(contacts, cutoff)
+
+def sparse_mass_weight(hessian, masses):
+    """ Mass-weights sparse Hessian: M^(-1/2) H M^(-1/2).
+    """
+    inv_sqrt_mass = sparse.diags(np.repeat(1.0 / np.sqrt(masses), 3))
+
+    return (inv_sqrt_mass @ hessian @ inv_sqrt_mass).tocsr()
+
+@instr.traced()
+def diagonalise(hessian):
+    """ Diagonalises Hessian. Returns eigenvalues in ascending order
+        and eigenvectors as columns of 3Nx3N array.
+    """
+    return np.linalg.eigh(hessian)
+
+@instr.traced()
+def lowest_modes(hessian, no_modes, method="shift-invert", guess=None):
+    """ Computes the lowest no_modes non-trivial modes (plus the six
+        trivial ones) of a sparse Hessian.
+        method = "shift-invert" uses Lanczos (ARPACK) in shift-invert mode
+        around a small negative shift, so that H - sigma*I is positive
+        definite; method = "lobpcg" uses LOBPCG, optionally started from
+        guess eigenvectors (e.g. from a previous, similar Hessian),
+        which shift-invert ignores.
+        Returns eigenvalues in ascending order and eigenvectors as columns.
+    """
+    dim = hessian.shape[0]
+    no_eigs = min(no_modes + NO_TRIVIAL_MODES, dim - 1)
+
+    sigma = -1e-4 * hessian.diagonal().mean()
+
+    if method == "shift-invert":
+        eigenvalues, eigenvectors = eigsh(hessian, k=no_eigs, sigma=sigma,
+                                          which='LM')
+    elif method == "lobpcg":
+        if guess is None or guess.shape != (dim, no_eigs):
+            guess = np.random.default_rng(0).standard_normal((dim, no_eigs))
+        # (H - sigma*I)^-1 preconditioner, i.e. LOBPCG in shift-invert mode
+        shifted = splu((hessian - sigma * sparse.identity(dim)).tocsc())
+        preconditioner = LinearOperator((dim, dim), matvec=shifted.solve,
+                                        matmat=shifted.solve)
+        tolerance = 1e-8 * hessian.diagonal().mean()
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)
+            eigenvalues, eigenvectors = lobpcg(hessian, guess, M=preconditioner,
+                                               tol=tolerance, largest=False,
+                                               maxiter=200)
+        residuals = hessian @ eigenvectors - eigenvectors * eigenvalues
+        if np.amax(np.linalg.norm(residuals, axis=0)) > 10 * tolerance:
+            # LOBPCG breaks down when the guess is (nearly) converged
+            # or degenerate, fall back to shift-invert Lanczos
+            return lowest_modes(hessian, no_modes)
+    else:
+        raise ValueError("Unknown eigensolver method: {}".format(method))
+
+    order = np.argsort(eigenvalues)
+
+    return eigenvalues[order], eigenvectors[:, order]
+
+def check_solver_options(mode="dense", no_modes=None):
+    """ Checks eigensolver options of solve_enm (enm.mode and
+        enm.noModes in config.yaml) before any ENM is solved.
+    """
+    if mode not in SOLVER_MODES:
+        raise ValueError("Unknown ENM solver mode: {}".format(mode))
+    if mode == "sparse" and no_modes is None:
+        raise ValueError("Sparse mode needs the number of modes (noModes)")
+    if no_modes is not None and no_modes < 1:
+        raise ValueError("Number of modes must be positive: {}".format(no_modes))
+
+    return None
+
+def solve_enm(coords, masses, flags, mode="dense", no_modes=None, contacts=None,
+              operators=None):
+    """ Builds and diagonalises ENM Hessian for given beads.
+        mode = "dense" builds the full Hessian and computes all modes;
+        mode = "sparse" builds the cutoff Hessian from a neighbour list
+        and computes only the lowest no_modes non-trivial modes
+        (pfENM connects all beads and is solved densely);
+        mode = "symmetric" solves the Hessian block by block using
+        symmetry operators of the assembly (see symmetric.py).
+        contacts edge list, if given, is reused for the cutoff springs.
+    """
+    if mode == "symmetric":
+        # Imported here, symmetric.py builds on this module
+        import src.simulation.symmetric as symmetric
+        if operators is None:
+            raise ValueError("Symmetric mode needs symmetry operators")
+        return symmetric.solve_symmetric(coords, masses, flags, operators,
+                                         no_modes=no_modes, contacts=contacts)
+
+    if mode == "sparse" and not flags['pf']:
+        pair_i, pair_j = cutoff_pairs(coords, flags['cutoff'], contacts=contacts)
+        spring_constants = np.full(pair_i.shape[0], DEFAULT_SPRING_CONSTANT)
+        hessian = build_sparse_hessian(coords, pair_i, pair_j, spring_constants)
+        if flags['mass']:
+            hessian = sparse_mass_weight(hessian, masses)
+
+        return lowest_modes(hessian, no_modes)
+
+    hessian = build_hessian(coords, cutoff=flags['cutoff'],
+                            parameter_free=flags['pf'], contacts=contacts)
+    if flags['mass']:
+        hessian = mass_weight(hessian, masses)
+
+    eigenvalues, eigenvectors = diagonalise(hessian)
+    if no_modes is not None:
+        no_eigs = no_modes + NO_TRIVIAL_MODES
+        eigenvalues, eigenvectors = eigenvalues[:no_eigs], eigenvectors[:, :no_eigs]
+
+    return eigenvalues, eigenvectors
+
+def run_enm(pdb_filepath, flag_combo="-ca -het -c 8.00", mode="dense",
+            no_modes=None):
+    """ Runs ENM in-process for a PDB file with GENENMM flags.
+        In symmetric mode, symmetry operators are read from the BIOMT
+        records of the file or inferred from its chains.
+        Returns eigenvalues and eigenvectors arrays.
+    """
+    flags = parse_flags(flag_combo)
+    coords, masses = load_beads(pdb_filepath, flags)
+    operators = None
+    if mode == "symmetric":
+        operators = symmetry.pdb_operators(pdb_filepath)
+
+    return solve_enm(coords, masses, flags, mode=mode, no_modes=no_modes,
+                     operators=operators)
+
+@instr.traced()
+def write_eigenfacs(filepath, eigenvalues, eigenvectors):
+    """ Writes eigenvalues and eigenvectors in DIAGSTD matrix.eigenfacs
+        format, so native results can be processed as DDPT ones.
+        Returns SHA-256 checksum (hex) of the written file.
+    """
+    no_beads = eigenvectors.shape[0] // 3
+    separator = " " + "-" * 35
+    digest = hashlib.sha256()
+
+    with open(filepath, 'wb') as file:
+        for mode_idx, eigenvalue in enumerate(eigenvalues):
+            block = io.BytesIO()
+            block.write(" VECTOR{:5d}       VALUE {: .3E}\n{}\n"
+                        .format(mode_idx + 1, eigenvalue, separator).encode('ascii'))
+            np.savetxt(block, eigenvectors[:, mode_idx].reshape(no_beads, 3),
+                       fmt='% .6E')
+            file.write(block.getvalue())
+            digest.update(block.getvalue())
+
+    return digest.hexdigest()
+
+def write_eigenvals(filepath, eigenvalues):
+    """ Writes eigenvalues column as extracted by run_enm.sh.
+    """
+    np.savetxt(filepath, eigenvalues, fmt='% .3E')
+
+    return None
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+""" Batched ENM solve of structural forms (apo, holo1, holo2).
+
+    Forms made by process_pdb.create_form differ only in their HETATM
+    (ligand) records, so their EN beads share the protein part. The
+    protein-protein spring block of the Hessian is built once, and only
+    springs with ligand beads are added per form. In dense mode this
+    saves the Hessian assembly only, every form is still diagonalised in
+    full; in sparse mode the holo forms are also started from the apo
+    modes (LOBPCG). Cutoff scans sweep
+    the protein block over the cutoff radii (see sweep.py) and solve
+    all forms at every radius. Ligand-occupancy
+    forms of multi-site assemblies (see structure/occupancy.py) are
+    solved as a stream of bead masks (see simulate_enm.occupancy_scan).
+"""
+import numpy as np
+import scipy.sparse as sparse
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
+import src.simulation.enm as enm
+import src.simulation.sweep as sweep
+import src.structure.occupancy as occupancy
+
+
+def shared_beads(form_beads):
+    """ Counts leading EN beads (protein) with the same coordinates
+        and masses in all forms. form_beads is a list of
+        (coords, masses) tuples.
+    """
+    coords_0, masses_0 = form_beads[0]
+    no_shared = coords_0.shape[0]
+    for coords, masses in form_beads[1:]:
+        no_common = min(no_shared, coords.shape[0])
+        is_equal = np.all(coords[:no_common] == coords_0[:no_common], axis=1) & \
+            (masses[:no_common] == masses_0[:no_common])
+        mismatch = np.flatnonzero(~is_equal)
+        no_shared = mismatch[0] if mismatch.shape[0] > 0 else no_common
+
+    return no_shared
+
+def ligand_springs(coords, no_shared, flags):
+    """ Lists springs (i < j) of beads no_shared onwards (ligands)
+        with all beads and their spring constants.
+    """
+    ligand_coords = coords[no_shared:]
+
+    if flags['pf']:
+        dist = cdist(coords, ligand_coords)
+        pair_i, pair_j = np.nonzero(np.ones_like(dist, dtype=bool))
+        dist = dist[pair_i, pair_j]
+    else:
+        dist_matrix = cKDTree(coords).sparse_distance_matrix( \
+            cKDTree(ligand_coords), flags['cutoff'], output_type='ndarray')
+        pair_i, pair_j, dist = dist_matrix['i'], dist_matrix['j'], dist_matrix['v']
+    pair_j = pair_j + no_shared
+
+    # Every ligand-ligand pair is found twice
+    is_pair = pair_i < pair_j
+    pair_i, pair_j, dist = pair_i[is_pair], pair_j[is_pair], dist[is_pair]
+
+    if flags['pf']:
+        spring_constants = enm.DEFAULT_SPRING_CONSTANT / dist ** 2
+    else:
+        spring_constants = np.full(pair_i.shape[0], enm.DEFAULT_SPRING_CONSTANT)
+
+    return pair_i, pair_j, spring_constants
+
+def solve_forms(form_beads, flags, mode="dense", no_modes=None):
+    """ Solves ENM of several forms with shared protein beads at once.
+        mode and no_modes are as in enm.solve_enm; in sparse mode every
+        form after the first is started from the modes of the first one
+        (usually apo). Returns list of (eigenvalues, eigenvectors).
+    """
+    return list(iter_forms(form_beads, flags, mode=mode, no_modes=no_modes))
+
+def iter_forms(form_beads, flags, mode="dense", no_modes=None):
+    """ Lazy solve_forms: yields (eigenvalues, eigenvectors) of every
+        form as soon as it is solved.
+    """
+    no_shared = shared_beads(form_beads)
+    shared_coords, shared_masses = form_beads[0][0][:no_shared], form_beads[0][1][:no_shared]
+
+    yield from solve_form_stream(shared_coords, shared_masses, form_beads, flags, \
+        mode=mode, no_modes=no_modes)
+
+def sweep_forms(form_beads, flags, cutoff_radii, mode="dense", no_modes=None):
+    """ Solves cutoff ENM of forms for increasing cutoff radii. The
+        protein block is swept over the radii once for all forms.
+        Yields (cutoff_radius, form index, eigenvalues, eigenvectors).
+    """
+    no_shared = shared_beads(form_beads)
+    shared_coords, shared_masses = form_beads[0][0][:no_shared], form_beads[0][1][:no_shared]
+
+    for cutoff_radius, shared_hessian in sweep.hessian_sweep(shared_coords, shared_masses, \
+        cutoff_radii, mass_weighted=flags['mass'], mode=mode):
+        form_flags = dict(flags, cutoff=cutoff_radius)
+        form_stream = solve_form_stream(shared_coords, shared_masses, form_beads, \
+            form_flags, mode=mode, no_modes=no_modes, shared_hessian=shared_hessian)
+        for form_idx, (eigenvalues, eigenvectors) in enumerate(form_stream):
+            yield cutoff_radius, form_idx, eigenvalues, eigenvectors
+
+def solve_form_stream(shared_coords, shared_masses, form_beads, flags, mode="dense", \
+    no_modes=None, shared_hessian=None):
+    """ Lazily solves ENM of forms, form_beads being an iterable of
+        (coords, masses) whose leading beads are shared_coords and
+        shared_masses. The mass-weighted protein block shared_hessian
+        is built from flags, if not given. Dense Hessians of the forms
+        are diagonalised in full, see solve_sparse_forms for warm starts.
+        Yields (eigenvalues, eigenvectors) of every form.
+    """
+    if mode == "sparse" and not flags['pf']:
+        yield from solve_sparse_forms(shared_coords, shared_masses, form_beads, flags, \
+            no_modes, shared_hessian=shared_hessian)
+        return
+
+    # Mass-weighted protein-protein block, the same for all forms
+    no_shared = shared_coords.shape[0]
+    if shared_hessian is None:
+        shared_hessian = enm.build_hessian(shared_coords, cutoff=flags['cutoff'], \
+            parameter_free=flags['pf'])
+        if flags['mass']:
+            shared_hessian = enm.mass_weight(shared_hessian, shared_masses)
+
+    for coords, masses in form_beads:
+        hessian = np.zeros((3 * coords.shape[0], 3 * coords.shape[0]))
+        hessian[:3 * no_shared, :3 * no_shared] = shared_hessian
+        pair_i, pair_j, spring_constants = ligand_springs(coords, no_shared, flags)
+        blocks = enm.spring_blocks(coords, pair_i, pair_j, spring_constants)
+        enm.add_springs(hessian, pair_i, pair_j, blocks, \
+            masses=masses if flags['mass'] else None)
+
+        eigenvalues, eigenvectors = enm.diagonalise(hessian)
+        if no_modes is not None:
+            no_eigs = no_modes + enm.NO_TRIVIAL_MODES
+            eigenvalues, eigenvectors = eigenvalues[:no_eigs], eigenvectors[:, :no_eigs]
+        yield eigenvalues, eigenvectors
+
+def solve_sparse_forms(shared_coords, shared_masses, form_beads, flags, no_modes, \
+    shared_hessian=None):
+    """ Sparse mode of solve_form_stream (cutoff ENM only).
+    """
+    no_shared = shared_coords.shape[0]
+    if shared_hessian is None:
+        pair_i, pair_j = enm.cutoff_pairs(shared_coords, flags['cutoff'])
+        spring_constants = np.full(pair_i.shape[0], enm.DEFAULT_SPRING_CONSTANT)
+        shared_hessian = enm.build_sparse_hessian(shared_coords, pair_i, pair_j, \
+            spring_constants)
+        if flags['mass']:
+            shared_hessian = enm.sparse_mass_weight(shared_hessian, shared_masses)
+
+    first_vectors = None
+    for coords, masses in form_beads:
+        no_ligand = coords.shape[0] - no_shared
+        hessian = sparse.block_diag((shared_hessian, \
+            sparse.csr_matrix((3 * no_ligand, 3 * no_ligand))), format='csr')
+        pair_i, pair_j, spring_constants = ligand_springs(coords, no_shared, flags)
+        increment = enm.build_sparse_hessian(coords, pair_i, pair_j, spring_constants)
+        if flags['mass']:
+            increment = enm.sparse_mass_weight(increment, masses)
+        hessian = (hessian + increment).tocsr()
+
+        if first_vectors is None:
+            eigenvalues, eigenvectors = enm.lowest_modes(hessian, no_modes)
+            first_vectors = eigenvectors[:3 * no_shared].reshape(no_shared, 3, -1)
+            yield eigenvalues, eigenvectors
+            continue
+
+        # Ligands move with their nearest protein bead
+        _, nearest = cKDTree(coords[:no_shared]).query(coords[no_shared:])
+        bead_idxs = np.concatenate([np.arange(no_shared), nearest])
+        guess = first_vectors[bead_idxs].reshape(3 * coords.shape[0], -1)
+        yield enm.lowest_modes(hessian, no_modes, method="lobpcg", guess=guess)
+
+def run_forms(pdb_filepaths, flag_combo, mode="dense", no_modes=None):
+    """ Runs ENM in-process for PDB files of forms with GENENMM flags.
+        Returns list of (eigenvalues, eigenvectors), one per form.
+    """
+    flags = enm.parse_flags(flag_combo)
+    form_beads = [enm.load_beads(pdb_filepath, flags) for pdb_filepath in pdb_filepaths]
+
+    return solve_forms(form_beads, flags, mode=mode, no_modes=no_modes)
+
+def occupancy_beads(structure, site_idxs, flags):
+    """ Selects EN beads of structure (see structure.Structure) with
+        all binding sites occupied. Returns coordinates and masses of
+        protein beads and of ligand beads, and binding site of every
+        ligand bead.
+    """
+    frame = structure.to_frame()
+    is_atom = site_idxs < 0
+    protein_coords, protein_masses = enm.select_beads(frame[is_atom], frame.iloc[:0], flags)
+    ligand_coords, ligand_masses = enm.select_beads(frame.iloc[:0], frame[~is_atom], flags)
+
+    if not flags['het']:
+        bead_sites = np.zeros(0, dtype=int)
+    elif flags['lig1']:
+        # First atom of every site, grouped by the same keys
+        # (occupancy.SITE_KEYS) in select_beads
+        ligand_sites = site_idxs[~is_atom]
+        _, first_idxs = np.unique(ligand_sites, return_index=True)
+        bead_sites = ligand_sites[np.sort(first_idxs)]
+    else:
+        bead_sites = site_idxs[~is_atom]
+
+    return (protein_coords, protein_masses), (ligand_coords, ligand_masses), bead_sites
+
+def solve_occupancy_forms(structure, flag_combo, mode="dense", no_modes=None, **form_options):
+    """ Lazily solves ENM of the symmetry-unique ligand-occupancy forms
+        of structure (form_options as in occupancy.occupancy_forms).
+        Beads of every form are selected by a mask of the beads with
+        all sites occupied; the protein block is built only once.
+        Yields (form, eigenvalues, eigenvectors).
+    """
+    flags = enm.parse_flags(flag_combo)
+    site_idxs, _ = occupancy.binding_sites(structure)
+    (protein_coords, protein_masses), (ligand_coords, ligand_masses), bead_sites = \
+        occupancy_beads(structure, site_idxs, flags)
+
+    forms = occupancy.occupancy_forms(structure, **form_options)
+    # Forms are consumed as they are solved
+    pending = []
+
+    def form_beads():
+        for form in forms:
+            pending.append(form)
+            is_bound = form['pattern'][bead_sites]
+            yield np.concatenate([protein_coords, ligand_coords[is_bound]]), \
+                np.concatenate([protein_masses, ligand_masses[is_bound]])
+
+    for eigenvalues, eigenvectors in solve_form_stream(protein_coords, protein_masses, \
+        form_beads(), flags, mode=mode, no_modes=no_modes):
+        yield pending.pop(0), eigenvalues, eigenvectors
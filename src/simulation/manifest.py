@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+""" Persistent job manifest for resumable ENM scans.
+
+    The manifest is a JSON lines file with one record per finished
+    (or failed) job attempt: job ID, status, timing and a checksum of
+    the job output. Records are appended and flushed to disk as jobs
+    finish, so the manifest survives a crash or kill of the scan, and
+    a restarted scan skips jobs with verified output.
+"""
+import hashlib
+import json
+import os
+from os.path import join as join_paths
+import numpy as np
+import src.data.store as store
+
+RECORD_KEYS = ['job_id', 'status', 'start_time', 'wall_time', 'attempts', 'checksum', 'error']
+
+
+def job_id(job):
+    """ Identifies ENM scan job by its PDB file and GENENMM flags.
+    """
+    return "{} {}".format(job['pdb_filepath'], job['flag_combo'])
+
+def load_manifest(manifest_path):
+    """ Loads manifest into dictionary of the latest record of every job.
+        A partially written last line (crash while writing) is ignored.
+    """
+    records = {}
+    try:
+        with open(manifest_path) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                records[record['job_id']] = record
+    except FileNotFoundError:
+        pass
+
+    return records
+
+def append_record(manifest_path, record):
+    """ Appends job record to manifest and flushes it to disk.
+    """
+    with open(manifest_path, 'a') as file:
+        file.write(json.dumps(record) + "\n")
+        file.flush()
+        os.fsync(file.fileno())
+
+    return None
+
+def output_checksum(job, store_path=None, pdb_id=None):
+    """ Computes checksum of job output: eigenvalues in the HDF5 result
+        store, if store_path is given, or matrix.eigenfacs file otherwise.
+        Returns None if output is missing.
+    """
+    digest = hashlib.sha256()
+    try:
+        if store_path is not None:
+            return eigenvalues_checksum(store.read_eigenvalues(store_path, \
+                (pdb_id, job['cutoff'], job['flags'], job['form'])))
+        with open(join_paths(job['output_subdir'], "matrix.eigenfacs"), 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                digest.update(block)
+    except (FileNotFoundError, KeyError, OSError):
+        return None
+
+    return digest.hexdigest()
+
+def eigenvalues_checksum(eigenvalues):
+    """ Computes checksum of eigenvalues written into the HDF5 result
+        store (see output_checksum).
+    """
+    return hashlib.sha256(np.ascontiguousarray(eigenvalues).tobytes()).hexdigest()
+
+def record_result(result, manifest_path, store_path=None, pdb_id=None):
+    """ Appends job result (after its output is written) to manifest.
+        The output checksum is taken from the result, if the worker
+        computed it while writing the output, or computed here.
+        Failed grouped jobs (sweeps, form batches) are recorded per job.
+    """
+    subjobs = result.get('sweep', result.get('forms'))
+    if subjobs is not None:
+        for subjob in subjobs:
+            record_result(dict(subjob, **{key: result.get(key) for key in RECORD_KEYS[1:]}), \
+                manifest_path, store_path=store_path, pdb_id=pdb_id)
+        return None
+
+    record = {key: result.get(key) for key in RECORD_KEYS}
+    record['job_id'] = job_id(result)
+    if result.get('status') == 'done':
+        record['checksum'] = result.get('checksum') or \
+            output_checksum(result, store_path=store_path, pdb_id=pdb_id)
+        if record['checksum'] is None:
+            record.update(status='failed', error="output missing")
+    append_record(manifest_path, record)
+
+    return None
+
+def is_completed(job, records, store_path=None, pdb_id=None):
+    """ Checks that job is done according to the manifest and that its
+        output still matches the recorded checksum.
+    """
+    record = records.get(job_id(job))
+    if record is None or record['status'] != 'done':
+        return False
+
+    return output_checksum(job, store_path=store_path, pdb_id=pdb_id) == record['checksum']
+
+def pending_jobs(jobs, manifest_path, store_path=None, pdb_id=None):
+    """ Splits jobs into pending ones and completed ones (skipped).
+    """
+    records = load_manifest(manifest_path)
+    pending, completed = [], []
+    for job in jobs:
+        if is_completed(job, records, store_path=store_path, pdb_id=pdb_id):
+            completed.append(job)
+        else:
+            pending.append(job)
+
+    return pending, completed
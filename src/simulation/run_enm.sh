@@ -2,12 +2,15 @@
 # Executes essential DDPT routines on PDB file
 # DDPT must be installed and added to PATH
 
-if [ "$#" -ne 3 ]; then
-    echo "Usage: $0 <pdb-filepath> <results-dir> <GENENMM-flags>"
+if [ "$#" -lt 3 ] || [ "$#" -gt 4 ]; then
+    echo "Usage: $0 <pdb-filepath> <results-dir> <GENENMM-flags> [<working-dir>]"
     echo "Example: $0 pdb/processed/1.pdb "-ca -het -c 8.0""
     exit 1
 fi
 
+# Exit with an error as soon as a routine fails
+set -e
+
 echo "PDB filepath:"    $1
 echo "Results dir:"     $2
 echo "GENENMM flags:"   $3
@@ -25,8 +28,10 @@ FILENAME="${FILENAME%%.*}"
 echo "Filename:"          ${FILENAME}
 
 # Create results and working dirs
+# Working dir can be given explicitly, so that concurrent runs
+# on the same PDB file do not share it
 # printf -v CUTOFF_PAD "%04.1f" $CUTOFF
-WORK_DIR=$ROOT/tmp/working-${FILENAME}
+WORK_DIR=${4:-$ROOT/tmp/working-${FILENAME}}
 mkdir -p $RESULTS_DIR $WORK_DIR 
 
 # Copy auxilary files, if any are present,
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+""" Process-pool scheduler for ENM scan jobs.
+
+    A job is a dictionary describing one ENM run, e.g.
+    {'pdb_filepath': ..., 'output_subdir': ..., 'flag_combo': ...},
+    and is executed by a picklable top-level job function.
+"""
+import logging
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+import src.instrument as instr
+
+try:
+    import threadpoolctl
+except ImportError:  # Optional, see limit_threads
+    threadpoolctl = None
+
+# Start method of worker processes: forking a multithreaded process
+# (e.g. the pipeline) may copy locks held by other threads
+START_METHOD = "forkserver"
+# Thread counts of native libraries (OpenMP, OpenBLAS, MKL)
+THREAD_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+
+def run_jobs(jobs, job_func, workers=None, on_result=None, retries=0, backoff=1.0):
+    """ Fans jobs out over a pool of worker processes and collects
+        results as jobs finish (in order of completion).
+        workers = None uses all CPU cores; workers = 1 runs jobs
+        one after another in the current process.
+        on_result is called with every result as soon as it is available.
+        Failed jobs are retried up to retries times, waiting
+        backoff * 2^attempt seconds before each retry. If a worker
+        process dies, the pool is restarted and the jobs that were in
+        flight are run again one at a time; the job whose worker dies
+        then counts a failed attempt. Worker processes run one native
+        thread each, see limit_threads.
+    """
+    logger = logging.getLogger(__name__)
+    results = []
+    progress = {'no_jobs': len(jobs), 'no_finished': 0, 'start_time': time.time()}
+
+    if workers == 1:
+        for job in jobs:
+            for attempt in range(retries + 1):
+                if attempt > 0:
+                    time.sleep(backoff * 2 ** (attempt - 1))
+                result = run_job(job_func, job, attempt=attempt + 1)
+                if not is_failed(result):
+                    break
+                logger.warning("Job failed (attempt %d): %s", attempt + 1, result.get('error'))
+            finish_job(result, results, progress, on_result, logger)
+
+        return results
+
+    no_workers = workers or os.cpu_count()
+    # Jobs ready to be submitted: (job, attempt)
+    queue = deque((job, 1) for job in jobs)
+    # Retries waiting for their backoff: (ready time, job, attempt)
+    retry_queue = []
+    # Jobs in flight when a worker process died, run one at a time
+    # to find the job that kills its worker: (job, attempt)
+    suspects = deque()
+
+    def finish_attempt(job, attempt, result):
+        if is_failed(result) and attempt <= retries:
+            logger.warning("Job failed (attempt %d): %s", attempt, result.get('error'))
+            retry_queue.append((time.time() + backoff * 2 ** (attempt - 1), job, attempt + 1))
+        else:
+            finish_job(result, results, progress, on_result, logger)
+
+    executor = new_pool(workers)
+    futures = {}
+    try:
+        while queue or retry_queue or suspects or futures:
+            now = time.time()
+            for ready_time, job, attempt in [item for item in retry_queue if item[0] <= now]:
+                retry_queue.remove((ready_time, job, attempt))
+                queue.append((job, attempt))
+
+            if suspects:
+                if not futures:
+                    job, attempt = suspects.popleft()
+                    futures[executor.submit(run_job, job_func, job, attempt)] = (job, attempt)
+            else:
+                while queue and len(futures) < no_workers:
+                    job, attempt = queue.popleft()
+                    futures[executor.submit(run_job, job_func, job, attempt)] = (job, attempt)
+
+            timeout = None
+            if retry_queue:
+                timeout = max(min(item[0] for item in retry_queue) - now, 0.0)
+            if not futures:
+                time.sleep(timeout)
+                continue
+
+            finished, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+            crashed = []
+            while finished:
+                for future in finished:
+                    job, attempt = futures.pop(future)
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool:
+                        # A worker process died (e.g. killed by the OOM killer),
+                        # all jobs in flight in the pool are lost
+                        crashed.append((job, attempt))
+                        continue
+                    finish_attempt(job, attempt, result)
+                # The other jobs of a broken pool finish (or fail) right away
+                finished = wait(futures)[0] if crashed else set()
+
+            if crashed:
+                executor = restart_pool(executor, workers, crashed, logger)
+                if len(crashed) == 1:
+                    job, attempt = crashed[0]
+                    finish_attempt(job, attempt, dict(job, status='failed', \
+                        attempts=attempt, error="worker process died"))
+                else:
+                    suspects.extend(crashed)
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+    return results
+
+def restart_pool(executor, workers, crashed, logger):
+    """ Replaces a broken process pool by a new one. Jobs finished
+        before the crash are already collected (and recorded in the job
+        manifest), only the jobs in flight are run again.
+    """
+    logger.error("Worker process died, restarting pool and requeueing %d jobs: %s", \
+        len(crashed), ", ".join(str(job.get('output_subdir', job.get('flag_combo'))) \
+        for job, _ in crashed))
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    return new_pool(workers)
+
+def new_pool(workers):
+    """ Creates process pool of workers started by the forkserver
+        (see START_METHOD) with one native thread each.
+    """
+    return ProcessPoolExecutor(max_workers=workers, initializer=limit_threads, \
+        mp_context=multiprocessing.get_context(START_METHOD))
+
+def limit_threads():
+    """ Initialises worker process with a single native (BLAS, OpenMP)
+        thread, so that workers do not oversubscribe the CPU cores.
+        The environment variables apply to libraries loaded afterwards
+        and to DDPT; threadpoolctl (if installed) also limits libraries
+        already loaded, e.g. the BLAS of numpy in forked workers.
+    """
+    for variable in THREAD_VARIABLES:
+        os.environ[variable] = "1"
+    if threadpoolctl is not None:
+        threadpoolctl.threadpool_limits(limits=1)
+
+    return None
+
+def run_job(job_func, job, attempt=1):
+    """ Runs job function and records failure instead of raising,
+        so that one failed job does not cancel the whole scan.
+        Results get start time, wall time (of the whole job, if it
+        returns a list of results) and attempt number.
+    """
+    start_time = time.time()
+    try:
+        with instr.stage("job", category="job", flag_combo=job.get('flag_combo'), \
+            pdb_filepath=job.get('pdb_filepath'), attempt=attempt):
+            result = job_func(job)
+    except Exception as error:
+        result = dict(job, status='failed', error=repr(error))
+    timing = {'start_time': start_time, 'wall_time': time.time() - start_time, \
+        'attempts': attempt}
+
+    if isinstance(result, list):
+        return [dict(subresult, **timing) for subresult in result]
+
+    return dict(result, **timing)
+
+def is_failed(result):
+    """ Checks if job (or any job of a list of results) failed.
+    """
+    if isinstance(result, list):
+        return any(is_failed(subresult) for subresult in result)
+
+    return result.get('status') == 'failed'
+
+def finish_job(result, results, progress, on_result, logger):
+    """ Collects results of a finished job and reports progress.
+    """
+    collect_result(result, results, progress['no_jobs'], on_result, logger)
+
+    progress['no_finished'] += 1
+    elapsed_time = time.time() - progress['start_time']
+    remaining_time = elapsed_time / progress['no_finished'] * \
+        (progress['no_jobs'] - progress['no_finished'])
+    logger.info("Progress: %d/%d jobs (%.1f%%), elapsed %.0f s, remaining ~%.0f s", \
+        progress['no_finished'], progress['no_jobs'], \
+        100.0 * progress['no_finished'] / progress['no_jobs'], elapsed_time, remaining_time)
+
+    return None
+
+def collect_result(result, results, no_jobs, on_result, logger):
+    """ Appends finished job result and reports progress.
+        A job function may return a list of results, e.g. a sweep job
+        covering several cutoff radii.
+    """
+    if isinstance(result, list):
+        for subresult in result:
+            collect_result(subresult, results, no_jobs, on_result, logger)
+
+        return None
+
+    results.append(result)
+    if result.get('status') == 'failed':
+        logger.error("Job failed: %s (%s)", result.get('output_subdir'),
+                     result.get('error'))
+    logger.debug("Finished %d results (%d jobs submitted)", len(results), no_jobs)
+
+    if on_result is not None:
+        on_result(result)
+
+    return None
@@ -8,15 +8,31 @@ from dotenv import find_dotenv, load_dotenv
 
 import subprocess
 import os
+import shutil
+import tempfile
+from functools import partial
 from os.path import join as join_paths
 import glob
 import src.utilities as utils
+import src.instrument as instr
+import src.simulation.enm as enm
+import src.simulation.scheduler as scheduler
+import src.simulation.contacts as cnt
+import src.simulation.sweep as sweep
+import src.simulation.forms as forms
+import src.simulation.manifest as manifest
+import src.simulation.cache as cache
+import src.data.store as store
+import src.data.process_wt as prowt
+import src.data.stream as stream
+from src.structure.structure import read_structure
 import numpy as np
 import itertools
 import pandas as pd
-from biopandas.pdb import PandasPdb
 from scipy.spatial.distance import pdist, squareform
 
+# Largest cutoff radius of ENM scans (angstroms)
+MAX_CUTOFF_RADIUS = 15.0
 
 @click.command()
 @click.argument('input_dir', type=click.Path(exists=True))
@@ -29,37 +45,86 @@ def main_comandline(input_dir, output_dir):
     logger.info('making simulation data set from processed PDB structures')
     main(input_dir, output_dir)
 
-def main(input_dir, output_dir):
+def main(input_dir, output_dir, pdb_code=None, processed_dir=None, stream_processing=None):
     """ Runs simualtion scripts for processed PDB data (from pdb/processed/) 
         to generate raw data ready to be processed (saved in data/raw/).
+        pdb_code (ID in the result store), processed_dir (streamed
+        cooperativity) and stream_processing default to the PDB ID,
+        data/processed/ and enm.streamProcessing in config.yaml.
     """
-
-
-    # config = utils.read_config()
-    # pdb_codes = config['pdb']['codeList']
+    config = utils.read_config()
+    if pdb_code is None:
+        pdb_code = config['pdb']['id']
+    if processed_dir is None:
+        processed_dir = config['data']['proFilePath']
+    if stream_processing is None:
+        stream_processing = config['enm']['streamProcessing']
+    engine = config['enm']['engine']
+    workers = config['enm']['workers']
+    solver_options = {'mode': config['enm']['mode'], 'no_modes': config['enm']['noModes']}
+    enm.check_solver_options(**solver_options)
+    cache_dir = config['enm']['cacheDir']
+    cache_max_size = config['enm']['cacheMaxSizeGB']
+    if cache_max_size is not None:
+        cache_max_size = cache_max_size * 1e9
 
     # Get PDB files in input directory
     pdb_filepaths = [join_paths(input_dir, "{}.pdb".format(form_idx)) for form_idx in range(3)]
 
     apo_pdb_path = pdb_filepaths[0]
 
-    dist = create_distance_matrix(apo_pdb_path)
-    np.savetxt(join_paths(output_dir, "dist.csv"), dist, delimiter=',', fmt='%.3f')
+    # Contacts (edge list) up to the largest scanned cutoff radius
+    with instr.stage("simulate_enm.contacts"):
+        ca_coord = cnt.load_ca_coords(apo_pdb_path)
+        contacts = cnt.build_contacts(ca_coord, MAX_CUTOFF_RADIUS)
+        cnt.save_contacts(join_paths(output_dir, "contacts.npz"), contacts)
 
     # Find the smallest cutoff for all EN beads
     # to have at least three springs in the ENM with 
     # isotropic cutoff radius
-    sorted_dist = np.sort(dist, axis=0)
-    cutoff_radius_3springs = np.amax(sorted_dist[2])
+    cutoff_radius_3springs = cnt.min_springs_cutoff(ca_coord, no_springs=3)
     print("Minimum 3 springs per EN bead\nCutoff radius = {:.3f}".\
         format(cutoff_radius_3springs))
 
     # Find smallest non-floppy ENM cutoff radius
-    cutoff_radius_nonfloppy = find_smallest_cutoff_radius(apo_pdb_path, output_dir)
+    with instr.stage("simulate_enm.cutoff_search"):
+        cutoff_radius_nonfloppy = find_smallest_cutoff_radius(apo_pdb_path, output_dir, \
+            engine=engine, method=config['enm']['cutoffSearch'], \
+            resolution=config['enm']['cutoffResolution'])
     
-    # Brute-force ENM scan
+    # Brute-force ENM scan over all structural forms at once
+    jobs = []
     for pdb_filepath in pdb_filepaths:
-        brute_force_scan(pdb_filepath, output_dir, start_cutoff_radius=cutoff_radius_nonfloppy)
+        jobs += scan_jobs(pdb_filepath, output_dir, \
+            start_cutoff_radius=cutoff_radius_nonfloppy)
+    store_path = config['enm']['storeFilePath']
+    if store_path is not None:
+        store_path = join_paths(output_dir, store_path)
+    on_result = None
+    if stream_processing:
+        # Post-process runs while the scan is still running
+        on_result = stream.CooperativityStream(processed_dir, \
+            store_path=store_path, pdb_id=pdb_code)
+    manifest_path = config['enm']['manifestFilePath']
+    if manifest_path is not None:
+        manifest_path = join_paths(output_dir, manifest_path)
+    with instr.stage("simulate_enm.scan", no_jobs=len(jobs)):
+        run_scan(jobs, engine=engine, workers=workers, on_result=on_result, \
+            store_path=store_path, pdb_id=pdb_code, cache_dir=cache_dir, \
+            cache_max_size=cache_max_size, manifest_path=manifest_path, \
+            retries=config['enm']['retries'], backoff=config['enm']['retryBackoff'], \
+            **solver_options)
+    if on_result is not None:
+        on_result.close()
+
+    # Ligand-occupancy forms of the form with all ligands bound (holo2)
+    if config['enm']['occupancyScan']:
+        if engine != "native":
+            raise ValueError("Occupancy scans need the native engine")
+        with instr.stage("simulate_enm.occupancy_scan"):
+            occupancy_scan(pdb_filepaths[-1], join_paths(output_dir, "occupancy"), \
+                start_cutoff_radius=cutoff_radius_nonfloppy, workers=workers, \
+                no_samples=config['enm']['occupancySamples'], **solver_options)
     
     # Simulate ENM
     # for pdb_filepath in pdb_filepaths:
@@ -67,21 +132,45 @@ def main(input_dir, output_dir):
     #         flag_combo="-ca -het -c 8.00")
 
 
-def run_enm(pdb_filepath, output_dir, flag_combo="-ca -het -c 8.00"):
-    """ Executes Shell script with essential DDPT routines.
-        For inputs see run_enm.sh
+def run_enm(pdb_filepath, output_dir, flag_combo="-ca -het -c 8.00", \
+    engine="ddpt", log_file=None, work_dir=None, cache_dir=None, cache_max_size=None, \
+    **solver_options):
+    """ Runs ENM and saves matrix.eigenfacs and eigenvals.csv
+        in output directory.
+        engine = "ddpt" executes Shell script with essential DDPT routines,
+        for inputs see run_enm.sh; engine = "native" builds and diagonalises
+        the Hessian in-process (see enm.py) with solver_options,
+        e.g. mode="sparse", no_modes=300 for large assemblies.
+        Native results are served from the result cache in cache_dir,
+        if given (see cache.py).
+        DDPT runs in work_dir (default: tmp/working-<PDB filename>).
+        Returns eigenvalues array for the native engine, None otherwise.
     """
-    # Usage: run_enm.sh <pdb-filepath> <results-filepath> <cutoff>
-    subprocess.call(['bash', 'src/simulation/run_enm.sh', pdb_filepath, output_dir, flag_combo]) 
+    if engine == "native":
+        eigenvalues, eigenvectors = cache.cached_run_enm(pdb_filepath, flag_combo, \
+            cache_dir=cache_dir, max_size=cache_max_size, **solver_options)
+        os.makedirs(output_dir, exist_ok=True)
+        enm.write_eigenfacs(join_paths(output_dir, "matrix.eigenfacs"), \
+            eigenvalues, eigenvectors)
+        enm.write_eigenvals(join_paths(output_dir, "eigenvals.csv"), eigenvalues)
+
+        return eigenvalues
+
+    # Usage: run_enm.sh <pdb-filepath> <results-filepath> <GENENMM-flags> [<working-dir>]
+    command = ['bash', 'src/simulation/run_enm.sh', pdb_filepath, output_dir, flag_combo]
+    if work_dir is not None:
+        command.append(os.path.abspath(work_dir))
+    # Raises CalledProcessError if DDPT fails, so the job is recorded as failed
+    subprocess.run(command, stdout=log_file, check=True)
 
     return None
 
 def create_distance_matrix(pdb_filepath):
     """ Creates distance matrix for PDB carbon alpha coordinates.
+        Note: memory scales as N^2, use contacts.build_contacts
+        for large structures.
     """
-    ppdb = PandasPdb().read_pdb(pdb_filepath)
-    ca_records = ppdb.df['ATOM'][ppdb.df['ATOM']['atom_name'] == 'CA']
-    ca_coord = ca_records[['x_coord', 'y_coord', 'z_coord']].to_numpy()
+    ca_coord = cnt.load_ca_coords(pdb_filepath)
 
     # Calculate distance matrix
     dist = pdist(ca_coord)
@@ -89,28 +178,51 @@ def create_distance_matrix(pdb_filepath):
 
     return dist
 
-def find_smallest_cutoff_radius(pdb_filepath, output_dir, start_cutoff_radius = 5.0, step=0.5):
+def find_smallest_cutoff_radius(pdb_filepath, output_dir, start_cutoff_radius = 5.0, step=0.5, \
+    engine="ddpt", method="linear", resolution=0.01):
     """ Finds minimal cutoff radius values for the ENM which 
         avoids floppy modes due-to underconnected EN.
-        Choose starting cutoff radius (default == 5.0) and scan up to 
+        method = "linear": choose starting cutoff radius (default == 5.0) and scan up to 
         15.0 angstroms in 0.5 angstrom steps until non-floppy ENM is found.
+        method = "bisect": bisect on the cutoff radius to given resolution
+        (native engine only, see bisect_cutoff_radius); the result is
+        rounded up to the step grid of the scan.
     """
+    if method == "bisect":
+        if engine != "native":
+            raise ValueError("Bisection cutoff search needs the native engine")
+        cutoff_radius = bisect_cutoff_radius(pdb_filepath, resolution=resolution)
+        if cutoff_radius is None:
+            return None
+        print("Non-floppy ENM\nCutoff radius = {:.3f}".format(cutoff_radius))
 
-    for cutoff_radius in np.arange(start_cutoff_radius, 15.5, 0.5):
+        return np.ceil(cutoff_radius / step) * step
+
+    cutoff_radii = np.arange(start_cutoff_radius, 15.5, 0.5)
+
+    if engine == "native":
+        # Beads and contacts are the same for all cutoff radii,
+        # springs are added incrementally
+        coords, masses = enm.load_beads(pdb_filepath, enm.parse_flags("-ca"))
+        native_sweep = sweep.sweep_cutoffs(coords, masses, cutoff_radii)
+
+    for cutoff_radius in cutoff_radii:
         flag_combo = "-c {} -ca".format(cutoff_radius)
-        run_enm(pdb_filepath, output_dir, flag_combo=flag_combo)
 
-        eigenvalues = np.loadtxt(join_paths(output_dir, "eigenvals.csv"), max_rows=7)
-        eigenvals_sum_6 = np.sum(eigenvalues[0:6])
-        eigenvals_sum_7 = np.sum(eigenvalues[0:7])
+        if engine == "native":
+            _, eigenvalues, _ = next(native_sweep)
+            eigenvalues = eigenvalues[:7]
+        else:
+            run_enm(pdb_filepath, output_dir, flag_combo=flag_combo)
+            eigenvalues = np.loadtxt(join_paths(output_dir, "eigenvals.csv"), max_rows=7)
 
         print("""
     Cutoff radius:          {:.2f}
     First 6 eigenvalue sum: {:.3e}
     First 7 eigenvalue sum: {:.3e}
-        """.format(cutoff_radius, eigenvals_sum_6, eigenvals_sum_7))
+        """.format(cutoff_radius, np.sum(eigenvalues[0:6]), np.sum(eigenvalues[0:7])))
 
-        if (eigenvals_sum_6 < 1e-7) and (eigenvals_sum_7 > 1e-7):
+        if is_nonfloppy(eigenvalues):
             # Cutoff condition is met
             print("The ENM has no floppy modes!")
             return cutoff_radius
@@ -122,9 +234,72 @@ def find_smallest_cutoff_radius(pdb_filepath, output_dir, start_cutoff_radius =
 
     return None
 
-def brute_force_scan(pdb_filepath, output_dir, start_cutoff_radius=5.0):
+def bisect_cutoff_radius(pdb_filepath, resolution=0.01):
+    """ Finds minimal non-floppy cutoff radius by bisection.
+        Contact graph connectivity and the 3-springs criterion give a
+        cheap lower bound; eigenvalues are only computed between it
+        and 15.0 angstroms. Adding springs never makes the ENM floppier,
+        so bisection is exact up to the resolution.
+    """
+    coords = cnt.load_ca_coords(pdb_filepath)
+    contacts = cnt.build_contacts(coords, MAX_CUTOFF_RADIUS)
+
+    lower_radius = cnt.rigidity_lower_bound(coords, contacts)
+    print("Connected ENM with 3 springs per EN bead\nCutoff radius = {:.3f}".\
+        format(lower_radius))
+    if lower_radius > MAX_CUTOFF_RADIUS or \
+        not is_nonfloppy(lowest_eigenvalues(coords, contacts, MAX_CUTOFF_RADIUS)):
+        print("15.0 angstrom cutoff radius is not enough\nCheck the PDB file")
+        return None
+
+    if is_nonfloppy(lowest_eigenvalues(coords, contacts, lower_radius)):
+        return lower_radius
+
+    # Floppy at lower_radius, non-floppy at upper_radius
+    upper_radius = MAX_CUTOFF_RADIUS
+    while upper_radius - lower_radius > resolution:
+        cutoff_radius = 0.5 * (lower_radius + upper_radius)
+        if is_nonfloppy(lowest_eigenvalues(coords, contacts, cutoff_radius)):
+            upper_radius = cutoff_radius
+        else:
+            lower_radius = cutoff_radius
+
+    return upper_radius
+
+def lowest_eigenvalues(coords, contacts, cutoff_radius):
+    """ Computes the seven lowest eigenvalues of cutoff ENM
+        (six trivial and the first non-trivial).
+    """
+    pair_i, pair_j = cnt.within_radius(contacts, cutoff_radius)
+    spring_constants = np.full(pair_i.shape[0], enm.DEFAULT_SPRING_CONSTANT)
+    hessian = enm.build_sparse_hessian(coords, pair_i, pair_j, spring_constants)
+    eigenvalues, _ = enm.lowest_modes(hessian, no_modes=1)
+
+    return eigenvalues
+
+def is_nonfloppy(eigenvalues):
+    """ Checks that ENM has exactly six zero (trivial) modes:
+        the sum of the first 6 eigenvalues vanishes and
+        the sum of the first 7 does not.
+    """
+    eigenvals_sum_6 = np.sum(eigenvalues[0:6])
+    eigenvals_sum_7 = np.sum(eigenvalues[0:7])
+
+    return (eigenvals_sum_6 < 1e-7) and (eigenvals_sum_7 > 1e-7)
+
+def brute_force_scan(pdb_filepath, output_dir, start_cutoff_radius=5.0, engine="ddpt", \
+    workers=None, **solver_options):
     """ Brute-force ENM scan to find an optimal ENM.
     """
+    jobs = scan_jobs(pdb_filepath, output_dir, start_cutoff_radius=start_cutoff_radius)
+
+    return run_scan(jobs, engine=engine, workers=workers, **solver_options)
+
+def scan_jobs(pdb_filepath, output_dir, start_cutoff_radius=5.0):
+    """ Lists brute-force ENM scan jobs (ANM and pfENM) for a PDB file.
+        Each job is a dictionary with PDB filepath, results subdirectory
+        and GENENMM flags.
+    """
     # DDPT flags in the ordr of apperas in GENENMM sourcecode
     mass_flag   = ['', '-mass']
     ca_flag     = ['-ca']   # Always present
@@ -144,6 +319,7 @@ def brute_force_scan(pdb_filepath, output_dir, start_cutoff_radius=5.0):
 
     pdb_filename = os.path.splitext(os.path.basename(pdb_filepath))[0]
 
+    jobs = []
     # ANM (with cutoff radius)
     for cutoff_radius in cutoff_radii:
         for flag_combo in flag_combos:
@@ -153,15 +329,13 @@ def brute_force_scan(pdb_filepath, output_dir, start_cutoff_radius=5.0):
 
             output_subdir = join_paths(output_dir, cutoff_flag_lbl, \
                 "".join(flag_combo).replace(" ", ""), pdb_filename)
-            os.makedirs(output_subdir, exist_ok=True)
 
             appended_flag_combo = flag_combo.copy()
             appended_flag_combo.append(cutoff_flag)
 
-            with open(join_paths(output_subdir, "main.log"), 'w') as log_file:
-                # Usage: run_enm.sh <pdb-filepath> <results-filepath> <GENENMM-flags>
-                subprocess.call(['bash', 'src/simulation/run_enm.sh', pdb_filepath, output_subdir, \
-                    " ".join(appended_flag_combo)], stdout=log_file)
+            jobs.append({'pdb_filepath': pdb_filepath, 'output_subdir': output_subdir, \
+                'flag_combo': " ".join(appended_flag_combo), 'cutoff': cutoff_flag_lbl, \
+                'flags': "".join(flag_combo).replace(" ", ""), 'form': pdb_filename})
     
     # pfENM
     for flag_combo in flag_combos:
@@ -169,19 +343,321 @@ def brute_force_scan(pdb_filepath, output_dir, start_cutoff_radius=5.0):
 
         output_subdir = join_paths(output_dir, pf_flag, \
             "".join(flag_combo).replace(" ", ""), pdb_filename)
-        os.makedirs(output_subdir, exist_ok=True)
 
         appended_flag_combo = flag_combo.copy()
         appended_flag_combo.append(pf_flag)
 
-        with open(join_paths(output_subdir, "main.log"), 'w') as log_file:
-            # Usage: run_enm.sh <pdb-filepath> <results-filepath> <GENENMM-flags>
-            subprocess.call(['bash', 'src/simulation/run_enm.sh', pdb_filepath, output_subdir, \
-                " ".join(appended_flag_combo)], stdout=log_file)
+        jobs.append({'pdb_filepath': pdb_filepath, 'output_subdir': output_subdir, \
+            'flag_combo': " ".join(appended_flag_combo), 'cutoff': pf_flag, \
+            'flags': "".join(flag_combo).replace(" ", ""), 'form': pdb_filename})
+
+    return jobs
+
+def run_scan(jobs, engine="ddpt", workers=None, on_result=None, store_path=None, \
+    pdb_id=None, cache_dir=None, cache_max_size=None, manifest_path=None, retries=0, \
+    backoff=1.0, **solver_options):
+    """ Runs ENM scan jobs over a pool of worker processes.
+        Returns job results in order of completion.
+        If store_path is given, eigenvalues and eigenvectors are written
+        into the HDF5 result store (see src/data/store.py) under pdb_id
+        by the workers as they are solved; native jobs then write no
+        text files. Results only carry eigenvalues.
+        Native results are cached in cache_dir, if given, so re-running
+        a scan only computes new (form, cutoff, flags) combinations.
+        If manifest_path is given, finished jobs are recorded in the job
+        manifest (see manifest.py) and jobs completed by a previous,
+        interrupted scan are skipped; on_result still gets them.
+        Failed jobs are retried (see scheduler.run_jobs).
+    """
+    if manifest_path is not None:
+        jobs, completed_jobs = manifest.pending_jobs(jobs, manifest_path, \
+            store_path=store_path, pdb_id=pdb_id)
+        logging.getLogger(__name__).info("Resuming scan: %d jobs completed, %d pending", \
+            len(completed_jobs), len(jobs))
+        if on_result is not None:
+            for job in completed_jobs:
+                on_result(dict(job, status='done'))
+        on_result = partial(manifest_result, manifest_path=manifest_path, \
+            store_path=store_path, pdb_id=pdb_id, on_result=on_result)
+
+    if engine == "native" and solver_options.get('mode') != "symmetric":
+        # Symmetric mode solves every job block by block on its own.
+        # Sweeps are split into cutoff chunks, so that all workers get jobs
+        jobs = sweep_jobs(jobs, min_jobs=workers or os.cpu_count())
+        jobs = [job for job in jobs if 'sweep' in job] + \
+            form_jobs([job for job in jobs if 'sweep' not in job])
+    job_func = partial(run_scan_job, engine=engine, store_path=store_path, pdb_id=pdb_id, \
+        cache_dir=cache_dir, cache_max_size=cache_max_size, **solver_options)
+
+    return scheduler.run_jobs(jobs, job_func, workers=workers, on_result=on_result, \
+        retries=retries, backoff=backoff)
+
+def manifest_result(result, manifest_path, store_path=None, pdb_id=None, on_result=None):
+    """ Records finished job result, whose output is written,
+        in the job manifest.
+    """
+    manifest.record_result(result, manifest_path, store_path=store_path, pdb_id=pdb_id)
 
+    if on_result is not None:
+        on_result(result)
 
     return None
 
+def run_scan_job(job, engine="ddpt", work_root="tmp", store_path=None, pdb_id=None, \
+    cache_dir=None, cache_max_size=None, **solver_options):
+    """ Runs a single ENM scan job. DDPT jobs get their own
+        working directory, so that jobs can run concurrently.
+        If store_path is given, modes are written into the HDF5 result
+        store under pdb_id (see save_modes).
+    """
+    if 'sweep' in job:
+        return run_sweep_job(job, store_path=store_path, pdb_id=pdb_id, \
+            cache_dir=cache_dir, cache_max_size=cache_max_size, **solver_options)
+    if 'forms' in job:
+        return run_forms_job(job, store_path=store_path, pdb_id=pdb_id, \
+            cache_dir=cache_dir, cache_max_size=cache_max_size, **solver_options)
+
+    if engine == "native":
+        eigenvalues, eigenvectors = cache.cached_run_enm(job['pdb_filepath'], \
+            job['flag_combo'], cache_dir=cache_dir, max_size=cache_max_size, **solver_options)
+        return save_modes(job, eigenvalues, eigenvectors, "Native ENM", \
+            store_path=store_path, pdb_id=pdb_id)
+
+    output_subdir = job['output_subdir']
+    os.makedirs(output_subdir, exist_ok=True)
+
+    work_dir = None
+    if engine == "ddpt":
+        os.makedirs(work_root, exist_ok=True)
+        work_dir = tempfile.mkdtemp(prefix="working-", dir=work_root)
+
+    try:
+        with open(join_paths(output_subdir, "main.log"), 'w') as log_file:
+            run_enm(job['pdb_filepath'], output_subdir, job['flag_combo'], \
+                engine=engine, log_file=log_file, work_dir=work_dir, cache_dir=cache_dir, \
+                cache_max_size=cache_max_size, **solver_options)
+    finally:
+        if work_dir is not None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if store_path is None:
+        # DIAGSTD wrote the file, checksum it here rather than in the parent
+        return dict(job, status='done', checksum=manifest.output_checksum(job))
+
+    _, eigenvalues, eigenvectors = prowt.parse_eigenfacs( \
+        join_paths(output_subdir, "matrix.eigenfacs"))
+    eigenvectors = eigenvectors.reshape(eigenvalues.shape[0], -1).T
+    checksum = store_modes(job, eigenvalues, eigenvectors, store_path, pdb_id)
+
+    return dict(job, status='done', eigenvalues=eigenvalues, checksum=checksum)
+
+def sweep_jobs(jobs, min_jobs=1):
+    """ Groups cutoff ENM jobs that differ only in cutoff radius and
+        structural form (PDB file) into sweep jobs, which the native
+        engine solves incrementally, sharing the protein part of the
+        Hessian between forms (see forms.sweep_forms). Every sweep is
+        split into chunks of consecutive cutoff radii, so that there are
+        at least min_jobs sweep jobs (if there are as many radii).
+        pfENM jobs are kept as they are.
+    """
+    sweeps = {}
+    other_jobs = []
+    for job in jobs:
+        tokens = job['flag_combo'].split()
+        if '-c' not in tokens:
+            other_jobs.append(job)
+            continue
+
+        cutoff_idx = tokens.index('-c')
+        cutoff_radius = float(tokens[cutoff_idx+1])
+        del tokens[cutoff_idx:cutoff_idx+2]
+        flag_combo = " ".join(tokens)
+
+        if flag_combo not in sweeps:
+            sweeps[flag_combo] = {'flag_combo': flag_combo, 'sweep': []}
+        sweeps[flag_combo]['sweep'].append(dict(job, cutoff_radius=cutoff_radius))
+
+    chunked_sweeps = []
+    no_chunks = -(-min_jobs // max(len(sweeps), 1))
+    for sweep in sweeps.values():
+        cutoff_radii = sorted(set(subjob['cutoff_radius'] for subjob in sweep['sweep']))
+        for chunk in np.array_split(cutoff_radii, min(no_chunks, len(cutoff_radii))):
+            chunk = set(chunk)
+            chunked_sweeps.append(dict(sweep, sweep=[subjob for subjob in sweep['sweep'] \
+                if subjob['cutoff_radius'] in chunk]))
+
+    return chunked_sweeps + other_jobs
+
+def run_sweep_job(job, store_path=None, pdb_id=None, cache_dir=None, cache_max_size=None, \
+    **solver_options):
+    """ Runs native ENM sweep over cutoff radii and structural forms
+        and saves results of every (cutoff radius, form) as soon as it
+        is solved (see save_modes), so only one run is held in memory.
+        Runs found in the result cache (cache_dir) are served from it,
+        only cutoff radii with uncached runs are swept.
+        Returns list of results of the grouped jobs.
+    """
+    flags = enm.parse_flags(job['flag_combo'])
+    pdb_filepaths = list(dict.fromkeys(subjob['pdb_filepath'] for subjob in job['sweep']))
+    form_beads = [enm.load_beads(pdb_filepath, flags) for pdb_filepath in pdb_filepaths]
+    subjobs = {(subjob['cutoff_radius'], pdb_filepaths.index(subjob['pdb_filepath'])): \
+        subjob for subjob in job['sweep']}
+
+    results = []
+    cache_keys = {}
+    if cache_dir is not None:
+        for (cutoff_radius, form_idx), subjob in list(subjobs.items()):
+            coords, masses = form_beads[form_idx]
+            cache_keys[cutoff_radius, form_idx] = cache.cache_key(coords, masses, \
+                dict(flags, cutoff=cutoff_radius), **solver_options)
+            modes = cache.get(cache_dir, cache_keys[cutoff_radius, form_idx])
+            if modes is not None:
+                results.append(save_modes(subjob, *modes, "Native ENM sweep", \
+                    store_path=store_path, pdb_id=pdb_id))
+                del subjobs[cutoff_radius, form_idx]
+    new_radii = sorted(set(cutoff_radius for cutoff_radius, _ in subjobs))
+    if not new_radii:
+        return results
+
+    # All forms are solved at a swept cutoff radius, cached ones are skipped
+    for cutoff_radius, form_idx, eigenvalues, eigenvectors in forms.sweep_forms(form_beads, \
+        flags, new_radii, **solver_options):
+        subjob = subjobs.get((cutoff_radius, form_idx))
+        if subjob is None:
+            continue
+        if cache_dir is not None:
+            cache.put(cache_dir, cache_keys[cutoff_radius, form_idx], eigenvalues, \
+                eigenvectors, max_size=cache_max_size)
+
+        results.append(save_modes(subjob, eigenvalues, eigenvectors, "Native ENM sweep", \
+            store_path=store_path, pdb_id=pdb_id))
+
+    return results
+
+def form_jobs(jobs):
+    """ Groups ENM jobs that differ only in structural form (PDB file)
+        into form jobs, which the native engine solves in one batch
+        sharing the protein part of the Hessian (see forms.py).
+    """
+    batches = {}
+    for job in jobs:
+        if job['flag_combo'] not in batches:
+            batches[job['flag_combo']] = {'flag_combo': job['flag_combo'], 'forms': []}
+        batches[job['flag_combo']]['forms'].append(job)
+
+    return list(batches.values())
+
+def run_forms_job(job, store_path=None, pdb_id=None, cache_dir=None, cache_max_size=None, \
+    **solver_options):
+    """ Runs batched native ENM solve of structural forms and saves
+        results of every form as soon as it is solved (see save_modes).
+        Forms found in the result cache (cache_dir) are served from it.
+        Returns list of results of the grouped jobs.
+    """
+    flags = enm.parse_flags(job['flag_combo'])
+    form_beads = [enm.load_beads(subjob['pdb_filepath'], flags) for subjob in job['forms']]
+
+    spectra = [None] * len(form_beads)
+    cache_keys = [None] * len(form_beads)
+    if cache_dir is not None:
+        for form_idx, (coords, masses) in enumerate(form_beads):
+            cache_keys[form_idx] = cache.cache_key(coords, masses, flags, **solver_options)
+            spectra[form_idx] = cache.get(cache_dir, cache_keys[form_idx])
+    new_idxs = [form_idx for form_idx, modes in enumerate(spectra) if modes is None]
+
+    new_spectra = iter(())
+    if new_idxs:
+        new_spectra = forms.iter_forms([form_beads[form_idx] for form_idx in new_idxs], \
+            flags, **solver_options)
+
+    results = []
+    for form_idx, subjob in enumerate(job['forms']):
+        modes = spectra[form_idx]
+        spectra[form_idx] = None
+        if modes is None:
+            modes = next(new_spectra)
+            if cache_dir is not None:
+                cache.put(cache_dir, cache_keys[form_idx], *modes, max_size=cache_max_size)
+        results.append(save_modes(subjob, *modes, "Native ENM forms", \
+            store_path=store_path, pdb_id=pdb_id))
+
+    return results
+
+def occupancy_scan(pdb_filepath, output_dir, start_cutoff_radius=5.0, workers=None, \
+    no_ligands=None, no_samples=None, seed=0, **solver_options):
+    """ Native ENM scan (as scan_jobs) of the symmetry-unique
+        ligand-occupancy forms of a PDB file with all binding sites
+        occupied (see forms.solve_occupancy_forms). Modes of every form
+        are saved in output_dir/<cutoff>/<flags>/<pattern>/, pattern
+        marking the occupied sites, e.g. 0110; the forms of every run
+        with their multiplicities are listed in output_dir/occupancy.csv.
+        no_ligands, no_samples and seed select forms as in
+        occupancy.occupancy_forms. Returns the forms table.
+    """
+    jobs = scan_jobs(pdb_filepath, output_dir, start_cutoff_radius=start_cutoff_radius)
+    job_func = partial(run_occupancy_job, no_ligands=no_ligands, no_samples=no_samples, \
+        seed=seed, **solver_options)
+    results = scheduler.run_jobs(jobs, job_func, workers=workers)
+
+    table = pd.DataFrame(results, columns=['cutoff', 'flags', 'form', 'no_ligands', \
+        'multiplicity', 'status'])
+    table.to_csv(join_paths(output_dir, "occupancy.csv"), index=False)
+
+    return table
+
+def run_occupancy_job(job, no_ligands=None, no_samples=None, seed=0, **solver_options):
+    """ Solves native ENM of the ligand-occupancy forms of a scan job
+        and saves modes of every form as soon as it is solved (see
+        save_modes). Returns list of results, one per form.
+    """
+    structure = read_structure(job['pdb_filepath'])
+    form_stream = forms.solve_occupancy_forms(structure, job['flag_combo'], \
+        no_ligands=no_ligands, no_samples=no_samples, seed=seed, **solver_options)
+
+    results = []
+    for form, eigenvalues, eigenvectors in form_stream:
+        pattern = "".join(map(str, form['pattern'].astype(int)))
+        subjob = dict(job, form=pattern, no_ligands=int(form['pattern'].sum()), \
+            multiplicity=form['multiplicity'], \
+            output_subdir=join_paths(os.path.dirname(job['output_subdir']), pattern))
+        result = save_modes(subjob, eigenvalues, eigenvectors, "Native ENM occupancy form")
+        # Only the forms table is kept
+        del result['eigenvalues']
+        results.append(result)
+
+    return results
+
+def save_modes(subjob, eigenvalues, eigenvectors, log_message, store_path=None, pdb_id=None):
+    """ Saves modes of a job into the HDF5 result store, if store_path
+        is given, or in its results subdirectory. Returns job result
+        with eigenvalues and output checksum (see manifest.py),
+        eigenvectors are not kept.
+    """
+    if store_path is not None:
+        checksum = store_modes(subjob, eigenvalues, eigenvectors, store_path, pdb_id)
+        return dict(subjob, status='done', eigenvalues=eigenvalues, checksum=checksum)
+
+    output_subdir = subjob['output_subdir']
+    os.makedirs(output_subdir, exist_ok=True)
+
+    checksum = enm.write_eigenfacs(join_paths(output_subdir, "matrix.eigenfacs"), \
+        eigenvalues, eigenvectors)
+    enm.write_eigenvals(join_paths(output_subdir, "eigenvals.csv"), eigenvalues)
+    with open(join_paths(output_subdir, "main.log"), 'w') as log_file:
+        log_file.write("{}: {}\n".format(log_message, subjob['flag_combo']))
+
+    return dict(subjob, status='done', eigenvalues=eigenvalues, checksum=checksum)
+
+def store_modes(job, eigenvalues, eigenvectors, store_path, pdb_id):
+    """ Writes modes of a job into the HDF5 result store under pdb_id.
+        Returns output checksum.
+    """
+    key = (pdb_id, job['cutoff'], job['flags'], job['form'])
+    store.write_run(store_path, key, eigenvalues, eigenvectors, \
+        attrs={'flag_combo': job['flag_combo']})
+
+    return manifest.eigenvalues_checksum(eigenvalues)
+
 def write_cfile(input_data):
     """ Writes cfile that contains custom cutoff radii
         for different atom names, e.g. 'CA ', 'C  ', 'O  '.
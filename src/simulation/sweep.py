@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+""" Incremental cutoff sweep for the native ENM engine.
+
+    Going from cutoff radius r to r' > r only adds springs, so pair
+    distances are sorted once and every step adds just the new springs
+    to the previous Hessian. In sparse mode the eigensolver is
+    warm-started from the previous step's eigenvectors.
+"""
+import numpy as np
+import scipy.sparse as sparse
+import src.simulation.enm as enm
+import src.simulation.contacts as cnt
+
+
+def sweep_cutoffs(coords, masses, cutoff_radii, mass_weighted=False,
+                  mode="dense", no_modes=None, contacts=None):
+    """ Solves the cutoff ENM for increasing cutoff radii.
+        Yields (cutoff_radius, eigenvalues, eigenvectors) for every radius,
+        so a caller can stop the sweep early.
+        mode and no_modes are as in enm.solve_enm.
+    """
+    eigenvectors = None
+    for cutoff_radius, hessian in hessian_sweep(coords, masses, cutoff_radii,
+                                                mass_weighted=mass_weighted,
+                                                mode=mode, contacts=contacts):
+        if mode == "sparse":
+            eigenvalues, eigenvectors = enm.lowest_modes(
+                hessian, no_modes, method="lobpcg", guess=eigenvectors)
+        else:
+            eigenvalues, eigenvectors = enm.diagonalise(hessian)
+            if no_modes is not None:
+                no_eigs = no_modes + enm.NO_TRIVIAL_MODES
+                eigenvalues = eigenvalues[:no_eigs]
+                eigenvectors = eigenvectors[:, :no_eigs]
+
+        yield cutoff_radius, eigenvalues, eigenvectors
+
+def hessian_sweep(coords, masses, cutoff_radii, mass_weighted=False, mode="dense",
+                  contacts=None):
+    """ Builds the cutoff ENM Hessian (dense or sparse, see mode)
+        for increasing cutoff radii. Yields (cutoff_radius, hessian);
+        the dense Hessian is updated in place, so copy it to keep it.
+    """
+    cutoff_radii = np.sort(cutoff_radii)
+    if contacts is None:
+        contacts = cnt.build_contacts(coords, cutoff_radii[-1])
+    weights = masses if mass_weighted else None
+
+    no_beads = coords.shape[0]
+    if mode == "sparse":
+        hessian = sparse.csr_matrix((3 * no_beads, 3 * no_beads))
+    else:
+        hessian = np.zeros((3 * no_beads, 3 * no_beads))
+
+    no_springs = 0
+    for cutoff_radius in cutoff_radii:
+        pair_i, pair_j = cnt.within_radius(contacts, cutoff_radius)
+        new_i, new_j = pair_i[no_springs:], pair_j[no_springs:]
+        no_springs = pair_i.shape[0]
+
+        hessian = add_springs(hessian, coords, new_i, new_j, weights)
+
+        yield cutoff_radius, hessian
+
+def add_springs(hessian, coords, pair_i, pair_j, masses=None):
+    """ Adds uniform springs to dense (in place) or sparse Hessian.
+        Returns updated Hessian.
+    """
+    spring_constants = np.full(pair_i.shape[0], enm.DEFAULT_SPRING_CONSTANT)
+    if pair_i.shape[0] == 0:
+        return hessian
+
+    if sparse.issparse(hessian):
+        increment = enm.build_sparse_hessian(coords, pair_i, pair_j, spring_constants)
+        if masses is not None:
+            increment = enm.sparse_mass_weight(increment, masses)
+
+        return hessian + increment
+
+    blocks = enm.spring_blocks(coords, pair_i, pair_j, spring_constants)
+    enm.add_springs(hessian, pair_i, pair_j, blocks, masses=masses)
+
+    return hessian
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+""" Symmetry-adapted ENM solve of symmetric assemblies.
+
+    A symmetry group G of the assembly (cyclic, dihedral, icosahedral...)
+    permutes its EN beads, and the Hessian commutes with this action.
+    With one protomer (n beads) as reference unit and coordinates of
+    every copy in its own rotated frame, the Hessian is a group
+    convolution F(g^-1 h) over the |G| copies, which the irreducible
+    representations (irreps) of G block-diagonalise: the spectrum is the
+    union of the spectra of the 3n*d blocks sum_k Gamma(k) x F(k) of the
+    irreps Gamma of dimension d, each eigenvalue repeated d times.
+    A 60-fold capsid is solved as 5 blocks of at most 5 protomers
+    instead of one dense 60-protomer problem.
+
+    Irreps are computed numerically from the multiplication table of the
+    group, which is read off the bead permutations of the operators.
+    Springs of the reference unit stand for those of every copy, so beads
+    that are symmetric only within BEAD_TOLERANCE (e.g. coordinates
+    rounded in PDB files) are solved as exactly symmetric.
+"""
+import numpy as np
+import src.simulation.enm as enm
+import src.structure.symmetry as symmetry
+import src.instrument as instr
+
+# Largest distance (angstroms) of symmetry-equivalent EN beads
+BEAD_TOLERANCE = 0.1
+
+
+@instr.traced()
+def solve_symmetric(coords, masses, flags, operators, no_modes=None, contacts=None, \
+    tolerance=BEAD_TOLERANCE):
+    """ Solves ENM of symmetric EN beads block by block (see module
+        docstring). Operators (see structure/symmetry.py) that do not map
+        the beads onto themselves within tolerance are dropped, so e.g.
+        a holo1 form of a homodimer is solved as one (dense) block.
+        Returns eigenvalues in ascending order and eigenvectors as columns
+        (lowest no_modes non-trivial modes plus the six trivial ones,
+        or all modes), as enm.solve_enm.
+    """
+    permutations, rotations = bead_permutations(coords, operators, tolerance=tolerance)
+    table = multiplication_table(permutations)
+    copy_idxs, unit_idxs, unit_beads = symmetry_units(permutations)
+    if not np.allclose(masses, masses[unit_beads][unit_idxs]):
+        raise ValueError("Masses of symmetry-equivalent EN beads differ")
+
+    kernel = convolution_kernel(coords, masses, flags, rotations, copy_idxs, unit_idxs, \
+        unit_beads, contacts=contacts)
+    blocks = [(irrep, block_modes(irrep, kernel)) for irrep in irreps(table)]
+
+    no_eigs = 3 * coords.shape[0] if no_modes is None else \
+        min(no_modes + enm.NO_TRIVIAL_MODES, 3 * coords.shape[0])
+
+    return assemble_modes(blocks, rotations, permutations, unit_beads, no_eigs)
+
+def bead_permutations(coords, operators, tolerance=BEAD_TOLERANCE):
+    """ Permutations of EN beads by the operators that map the beads
+        onto themselves. Returns (no_operators, no_beads) array of
+        permutations and (no_operators, 3, 3) array of their rotations.
+    """
+    permutations = []
+    rotations = []
+    for operator in operators:
+        permutation = symmetry.point_permutations(coords, [operator], tolerance=tolerance)
+        if permutation.shape[0] > 0:
+            permutations.append(permutation[0])
+            rotations.append(operator[0])
+
+    if not permutations:
+        # No symmetry: identity only
+        return np.arange(coords.shape[0])[None, :], np.eye(3)[None, :, :]
+
+    return np.array(permutations), np.array(rotations)
+
+def multiplication_table(permutations):
+    """ Multiplication table of the group of bead permutations:
+        table[g, h] is the index of g*h (h applied first).
+        Raises ValueError if the permutations are not a group.
+    """
+    no_elements = permutations.shape[0]
+    if np.unique(permutations, axis=0).shape[0] != no_elements:
+        raise ValueError("Symmetry operators permute the EN beads identically")
+    index = {permutation.tobytes(): idx for idx, permutation in enumerate(permutations)}
+
+    table = np.empty((no_elements, no_elements), dtype=int)
+    for g in range(no_elements):
+        for h in range(no_elements):
+            product = permutations[g][permutations[h]].tobytes()
+            if product not in index:
+                raise ValueError("Symmetry operators are not a group (not closed)")
+            table[g, h] = index[product]
+
+    return table
+
+def symmetry_units(permutations):
+    """ Splits EN beads into symmetry copies of a reference unit, one
+        bead of every orbit. Bead unit_beads[m] is mapped onto bead
+        permutations[g, unit_beads[m]] of copy g. Returns copy and unit
+        index of every bead and unit beads.
+        Raises ValueError if a bead lies on a symmetry axis.
+    """
+    no_elements, no_beads = permutations.shape
+    is_identity = np.all(permutations == np.arange(no_beads), axis=1)
+    if np.any(permutations[~is_identity] == np.arange(no_beads)):
+        raise ValueError("EN beads on symmetry axes are not supported")
+    # Reference unit is the identity copy
+    permutations = permutations[np.argsort(~is_identity, kind='stable')]
+
+    copy_idxs = np.full(no_beads, -1)
+    unit_idxs = np.full(no_beads, -1)
+    unit_beads = []
+    for bead in range(no_beads):
+        if copy_idxs[bead] >= 0:
+            continue
+        orbit = permutations[:, bead]
+        copy_idxs[orbit] = np.arange(no_elements)
+        unit_idxs[orbit] = len(unit_beads)
+        unit_beads.append(bead)
+
+    # Back to the order of the permutations
+    order = np.argsort(~is_identity, kind='stable')
+    copy_idxs = order[copy_idxs]
+
+    return copy_idxs, unit_idxs, np.array(unit_beads)
+
+def convolution_kernel(coords, masses, flags, rotations, copy_idxs, unit_idxs, unit_beads, \
+    contacts=None):
+    """ Hessian rows of the reference unit in the frames of the copies:
+        kernel[k] = H[unit, copy k] R_k, a 3n x 3n block for every group
+        element k (mass-weighted if flags['mass']). Cutoff ENM springs
+        are taken from contacts edge list (built if not given).
+    """
+    no_elements = rotations.shape[0]
+    no_units = unit_beads.shape[0]
+    is_unit = np.zeros(coords.shape[0], dtype=bool)
+    is_unit[unit_beads] = True
+
+    if flags['pf']:
+        rows = np.repeat(unit_beads, coords.shape[0])
+        cols = np.tile(np.arange(coords.shape[0]), no_units)
+        rows, cols = rows[rows != cols], cols[rows != cols]
+        spring_constants = enm.DEFAULT_SPRING_CONSTANT / \
+            np.sum((coords[cols] - coords[rows]) ** 2, axis=1)
+    else:
+        pair_i, pair_j = enm.cutoff_pairs(coords, flags['cutoff'], contacts=contacts)
+        # Every spring of a unit bead, seen from the unit bead
+        rows = np.concatenate([pair_i[is_unit[pair_i]], pair_j[is_unit[pair_j]]])
+        cols = np.concatenate([pair_j[is_unit[pair_i]], pair_i[is_unit[pair_j]]])
+        spring_constants = np.full(rows.shape[0], enm.DEFAULT_SPRING_CONSTANT)
+
+    blocks = enm.spring_blocks(coords, rows, cols, spring_constants)
+    row_units = unit_idxs[rows]
+    identity = copy_idxs[unit_beads[0]]
+
+    kernel = np.zeros((no_elements, no_units, 3, no_units, 3))
+    # Off-diagonal super-elements, rotated into the frames of the copies
+    col_copies = copy_idxs[cols]
+    np.add.at(kernel, (col_copies, row_units, slice(None), unit_idxs[cols]), \
+        np.einsum('pij,pjk->pik', blocks, rotations[col_copies]))
+    # Diagonal super-elements: minus the sum of the row
+    diagonal = np.zeros((no_units, 3, 3))
+    np.add.at(diagonal, row_units, -blocks)
+    kernel[identity, np.arange(no_units), :, np.arange(no_units), :] += diagonal
+
+    if flags['mass']:
+        inv_sqrt_mass = np.repeat(1.0 / np.sqrt(masses[unit_beads]), 3)
+        kernel = kernel.reshape(no_elements, 3 * no_units, 3 * no_units) \
+            * inv_sqrt_mass[None, :, None] * inv_sqrt_mass[None, None, :]
+
+    return kernel.reshape(no_elements, 3 * no_units, 3 * no_units)
+
+def irreps(table, seed=0):
+    """ Irreducible unitary representations of a finite group given by
+        its multiplication table. The eigenspaces of a random Hermitian
+        matrix commuting with the left regular representation carry its
+        irreducible components; one of every character is kept.
+        Returns list of (no_elements, d, d) arrays.
+    """
+    no_elements = table.shape[0]
+    rng = np.random.default_rng(seed)
+    matrix = rng.standard_normal((no_elements, no_elements)) \
+        + 1j * rng.standard_normal((no_elements, no_elements))
+    matrix = matrix + matrix.conj().T
+    # Left regular representation L(g) e_h = e_gh permutes rows and columns
+    commutant = np.zeros_like(matrix)
+    for g in range(no_elements):
+        commutant[np.ix_(table[g], table[g])] += matrix
+    eigenvalues, eigenvectors = np.linalg.eigh(commutant)
+
+    representations = {}
+    for cluster in eigenvalue_clusters(eigenvalues):
+        basis = eigenvectors[:, cluster]
+        regular_basis = np.empty((no_elements,) + basis.shape, dtype=complex)
+        regular_basis[np.arange(no_elements)[:, None], table] = basis
+        representation = np.einsum('ia,gib->gab', basis.conj(), regular_basis)
+        # (+ 0.0 turns -0.0 into 0.0)
+        character = np.round(np.trace(representation, axis1=1, axis2=2), 6) + 0.0
+        representations.setdefault(character.tobytes(), representation)
+
+    representations = list(representations.values())
+    if sum(representation.shape[1] ** 2 for representation in representations) != no_elements:
+        # Accidentally degenerate random matrix
+        return irreps(table, seed=seed + 1)
+
+    return representations
+
+def eigenvalue_clusters(eigenvalues, rtol=1e-8):
+    """ Groups indices of (ascending) eigenvalues equal within rtol
+        of the largest eigenvalue magnitude.
+    """
+    tolerance = rtol * max(np.abs(eigenvalues).max(), 1.0)
+    breaks = np.flatnonzero(np.diff(eigenvalues) > tolerance) + 1
+
+    return np.split(np.arange(eigenvalues.shape[0]), breaks)
+
+def block_modes(irrep, kernel):
+    """ Diagonalises the block sum_k Gamma(k) x F(k) of irrep Gamma.
+        Returns eigenvalues and eigenvectors as columns.
+    """
+    block = np.einsum('kab,kpq->apbq', irrep, kernel).reshape( \
+        irrep.shape[1] * kernel.shape[1], -1)
+    # Hermitian up to deviations of the beads from exact symmetry
+    block = (block + block.conj().T) / 2
+    if np.abs(block.imag).max() <= 1e-12 * np.abs(block.real).max():
+        # Real irreps, e.g. of C2 or of 1-dimensional real characters
+        block = block.real
+
+    return enm.diagonalise(block)
+
+def assemble_modes(blocks, rotations, permutations, unit_beads, no_eigs):
+    """ Collects the lowest no_eigs modes of the irrep blocks: every
+        block eigenvector yields d (complex) modes of the assembly, and
+        modes of equal eigenvalues are combined into real orthonormal
+        eigenvectors. Returns eigenvalues and eigenvectors as columns.
+    """
+    # Block modes by eigenvalue: (eigenvalue, block index, mode index)
+    ranked = sorted((eigenvalue, block_idx, mode_idx) \
+        for block_idx, (_, (eigenvalues, _)) in enumerate(blocks) \
+        for mode_idx, eigenvalue in enumerate(eigenvalues))
+    ranked_eigenvalues = np.array([eigenvalue for eigenvalue, _, _ in ranked])
+
+    eigenvalues = []
+    eigenvectors = []
+    for cluster in eigenvalue_clusters(ranked_eigenvalues):
+        if len(eigenvalues) >= no_eigs:
+            break
+        vectors = []
+        for idx in cluster:
+            irrep, (_, block_vectors) = blocks[ranked[idx][1]]
+            vectors.append(assembly_vectors(irrep, block_vectors[:, ranked[idx][2]], \
+                rotations, permutations, unit_beads))
+        vectors = np.concatenate(vectors, axis=1)
+        # Real and imaginary parts of degenerate modes span the real eigenspace
+        real_vectors, _, _ = np.linalg.svd(np.concatenate([vectors.real, vectors.imag], \
+            axis=1), full_matrices=False)
+        eigenvalues += [ranked_eigenvalues[cluster].mean()] * vectors.shape[1]
+        eigenvectors.append(real_vectors[:, :vectors.shape[1]])
+
+    return np.array(eigenvalues[:no_eigs]), np.concatenate(eigenvectors, axis=1)[:, :no_eigs]
+
+def assembly_vectors(irrep, block_vector, rotations, permutations, unit_beads):
+    """ Modes of the assembly of a block eigenvector of irrep Gamma:
+        copy h of mode a is R_h sum_b Gamma(h)_ab x_b. Returns (3N, d)
+        array of normalised (complex) modes.
+    """
+    no_elements, dim, _ = irrep.shape
+    no_units = unit_beads.shape[0]
+    local = np.einsum('hab,bmi->ahmi', irrep, block_vector.reshape(dim, no_units, 3))
+    vectors = np.zeros((dim, permutations.shape[1], 3), dtype=complex)
+    vectors[:, permutations[:, unit_beads], :] = np.einsum('hij,ahmj->ahmi', rotations, local)
+
+    return vectors.reshape(dim, -1).T * np.sqrt(dim / no_elements)
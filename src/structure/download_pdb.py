@@ -1,12 +1,36 @@
 # -*- coding: utf-8 -*-
+""" Fetches PDB structures (biological assemblies) from a local mirror,
+    an on-disk download cache or the PDB website, in that order.
+
+    Existing files in the output directory are reused. Downloads are
+    gzipped, streamed to disk and decompressed while streaming, so files
+    are never held in memory. Transient network errors are retried with
+    exponential backoff. A mirror is a directory (or file:// URL) with
+    files named as on the PDB website, e.g. 3r6s.pdb1.gz or 3r6s.pdb1,
+    either flat or divided by the middle two ID characters (r6/3r6s.pdb1.gz);
+    in offline mode only the mirror and the cache are used.
+"""
 import click
 import logging
 from pathlib import Path
 from dotenv import find_dotenv, load_dotenv
 
 import os
+import gzip
+import shutil
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError, URLError
+from urllib.request import urlopen
+import pandas as pd
 import src.utilities as utils
-from urllib.request import urlretrieve
+
+PDB_URL = "https://files.rcsb.org/download/"
+
+# HTTP status codes worth a retry
+RETRY_STATUS_CODES = [408, 429, 500, 502, 503, 504]
 
 @click.command()
 @click.argument('output_dir', type=click.Path())
@@ -18,42 +42,197 @@ def main_commandline(output_dir):
     logger.info('download raw PDB files from PDB website')
 
     main(output_dir)
-    
+
 
 def main(output_dir):
     """ Downloads raw PDB structures listed in YAML file
         from PDB website (saved in pdb/raw).
     """
     config = utils.read_config()
-    pdb_code = config['pdb']['id']
-    download_pdb(pdb_code, output_dir, biounit = True, compressed = False)
+    results = fetch_all(utils.pdb_codes(config), output_dir, \
+        workers=config['pdb']['downloadWorkers'], **config_fetch_options(config))
+    print(results.to_string(index=False))
 
-    return None
+    return results
 
+def config_fetch_options(config):
+    """ Fetcher settings from config.yaml.
+    """
+    return {'mirror': config['pdb']['mirror'], 'cache_dir': config['pdb']['downloadCacheDir'],
+            'retries': config['pdb']['downloadRetries'], 'offline': config['pdb']['offline']}
 
-def download_pdb(pdb_code, output_dir, biounit = True, compressed = False):
+def download_pdb(pdb_code, output_dir, biounit = True, compressed = False, **fetch_options):
     """ Downloads raw PDB files form a list of PDB IDs.
         Authored by Chris Swain (http://www.macinchem.org)
         Modified by Igors Dubanevics (https://github.com/igordub)
         Copyright CC-BY
+        fetch_options (mirror, cache_dir, retries, offline) default
+        to config.yaml, see fetch_pdb.
+    """
+    if not fetch_options:
+        fetch_options = config_fetch_options(utils.read_config())
+
+    return fetch_pdb(pdb_code, output_dir, biounit=biounit, compressed=compressed, \
+        **fetch_options)
+
+def pdb_filename(pdb_code, biounit=True):
+    """ File name of PDB entry (first biological assembly if biounit),
+        e.g. 3r6s.pdb1; ':1' suffixes of entities are removed.
+        The PDB website and mirrors use lower case names.
     """
-    # Add .pdb extension and remove ':1' suffix in entities
     filename = "{:4s}.pdb".format(pdb_code[:4])
-    
-    # Add '1' if biounit
     if biounit:
         filename = "{}1".format(filename)
-    # Add .gz extenison if compressed
-    elif compressed:
-        filename = "{}.gz".format(filename)
-    
-    url = os.path.join("https://files.rcsb.org/download/", filename.lower())
-    destination_file = os.path.join(output_dir, filename)
-    # Download file
-    urlretrieve(url, destination_file)
+
+    return filename
+
+def fetch_pdb(pdb_code, output_dir, biounit=True, compressed=False, mirror=None, \
+    cache_dir=None, retries=3, backoff=1.0, timeout=60.0, offline=False):
+    """ Fetches PDB file into output_dir, e.g. pdb/raw/3r6s.pdb1
+        (3r6s.pdb1.gz if compressed). The file is taken from output_dir
+        if it exists already, else from mirror (directory or file:// URL),
+        cache_dir or the PDB website (not if offline), and is written
+        atomically. Remote downloads are stored in cache_dir (gzipped).
+        Failed downloads are retried up to retries times, waiting
+        backoff * 2^attempt seconds before each retry.
+        Returns (file path, source).
+    """
+    filename = pdb_filename(pdb_code, biounit=biounit)
+    destination_file = os.path.join(output_dir, filename + (".gz" if compressed else ""))
+    if os.path.isfile(destination_file) and os.path.getsize(destination_file) > 0:
+        return destination_file, "existing"
+    os.makedirs(output_dir, exist_ok=True)
+
+    if mirror is not None:
+        for url in mirror_urls(mirror, filename.lower()):
+            try:
+                with urlopen(url, timeout=timeout) as response:
+                    write_stream(response, destination_file, url.endswith(".gz"), compressed)
+                return destination_file, "mirror"
+            except (OSError, EOFError, zlib.error) as error:
+                # Missing or corrupt (e.g. truncated) mirror file, try the next one
+                if not isinstance(error, (FileNotFoundError, URLError)):
+                    logging.getLogger(__name__).warning("Mirror file %s unusable: %r", \
+                        url, error)
+                continue
+
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, filename.lower() + ".gz")
+        if os.path.isfile(cache_file):
+            try:
+                with open(cache_file, 'rb') as file:
+                    write_stream(file, destination_file, True, compressed)
+                return destination_file, "cache"
+            except (OSError, EOFError, zlib.error) as error:
+                # Corrupt cache file, download it again
+                logging.getLogger(__name__).warning("Cached file %s unusable: %r", \
+                    cache_file, error)
+
+    if offline:
+        raise FileNotFoundError("{} is not in the mirror or cache (offline)".format(filename))
+
+    url = PDB_URL + filename.lower() + ".gz"
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        try:
+            with urlopen(url, timeout=timeout) as response:
+                if cache_file is None:
+                    write_stream(response, destination_file, True, compressed)
+                    return destination_file, "remote"
+                # Keep the gzipped download in the cache
+                write_stream(response, cache_file, True, True)
+            with open(cache_file, 'rb') as file:
+                write_stream(file, destination_file, True, compressed)
+            return destination_file, "remote"
+        except HTTPError as error:
+            if error.code not in RETRY_STATUS_CODES or attempt == retries:
+                raise
+        except (URLError, OSError, EOFError, zlib.error):
+            if attempt == retries:
+                raise
+        logging.getLogger(__name__).warning("Download of %s failed (attempt %d)", url, \
+            attempt + 1)
+
+def mirror_urls(mirror, filename):
+    """ Lists candidate URLs of file in mirror: gzipped and plain files,
+        flat and divided by the middle two ID characters.
+    """
+    if "://" not in mirror:
+        mirror = Path(mirror).resolve().as_uri()
+    mirror = mirror.rstrip("/")
+
+    return ["{}/{}{}".format(mirror, subdir, filename + extension) \
+        for subdir in ["", filename[1:3] + "/"] for extension in [".gz", ""]]
+
+def write_stream(source, destination_file, is_gzipped, compress):
+    """ Streams file object into destination file, decompressing or
+        compressing on the fly as needed. Writes a temporary file and
+        renames it, so destination is never partially written.
+        Corrupt gzip streams raise EOFError, OSError or zlib.error.
+    """
+    output_dir = os.path.dirname(destination_file) or "."
+    os.makedirs(output_dir, exist_ok=True)
+    file_descriptor, tmp_path = tempfile.mkstemp(dir=output_dir, suffix=".tmp")
+    try:
+        with os.fdopen(file_descriptor, 'wb') as tmp_file:
+            if is_gzipped and not compress:
+                source = gzip.GzipFile(fileobj=source, mode='rb')
+            elif compress and not is_gzipped:
+                tmp_file = gzip.GzipFile(fileobj=tmp_file, mode='wb')
+            elif is_gzipped:
+                # Verify gzipped stream while copying it unchanged
+                source = VerifiedGzip(source)
+            with tmp_file:
+                shutil.copyfileobj(source, tmp_file, 1 << 20)
+            if isinstance(source, VerifiedGzip):
+                source.check()
+        os.replace(tmp_path, destination_file)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
 
     return None
 
+class VerifiedGzip:
+    """ File object passing gzipped bytes through unchanged while
+        decompressing them, so that truncated or corrupt downloads are
+        detected without a second read.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        self.decompressor.decompress(data)
+        return data
+
+    def check(self):
+        """ Raises EOFError if the gzip stream is incomplete.
+        """
+        if not self.decompressor.eof:
+            raise EOFError("Compressed file ended before the end-of-stream marker")
+
+def fetch_all(pdb_codes, output_dir, workers=8, **options):
+    """ Fetches PDB files concurrently on workers threads, see fetch_pdb
+        for options. A failed fetch does not stop the others.
+        Returns DataFrame with file path, source and error of every ID.
+    """
+    def fetch(pdb_code):
+        try:
+            filepath, source = fetch_pdb(pdb_code, output_dir, **options)
+            return {'pdb_id': pdb_code, 'filepath': filepath, 'source': source, 'error': None}
+        except Exception as error:
+            return {'pdb_id': pdb_code, 'filepath': None, 'source': None, 'error': repr(error)}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(fetch, pdb_codes))
+
+    return pd.DataFrame(results, columns=['pdb_id', 'filepath', 'source', 'error'])
+
 
 if __name__ == '__main__':
     log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+""" Ligand-occupancy forms of multi-site assemblies.
+
+    Every ligand residue (HETATM) is a binding site. A form is an
+    occupancy pattern of the sites, i.e. which ligands are bound. Patterns
+    related by a symmetry of the assembly (see symmetry.py) are
+    equivalent, and only one representative of each class is generated,
+    with the size of the class as its multiplicity. Forms are generated
+    lazily as atom masks of the structure, so no PDB file is written
+    per form (see simulation/forms.py for the batched ENM solve).
+
+    For a homodimer with one ligand per protomer, the forms are apo,
+    holo1 (multiplicity 2) and holo2, as made by process_pdb.create_form.
+
+    List forms of a PDB file from the root directory:
+    $ python -m src.structure.occupancy pdb/processed/3r6s/2.pdb
+"""
+import click
+import itertools
+import numpy as np
+import pandas as pd
+import src.structure.symmetry as symmetry
+from src.structure.structure import read_structure
+
+# Segment ID tells apart copies of large assemblies, see transform_pdb.py
+SITE_KEYS = ['segment_id', 'chain_id', 'residue_number', 'insertion', 'residue_name']
+
+
+@click.command()
+@click.argument('pdb_filepath', type=click.Path(exists=True))
+@click.option('--no-ligands', default=None, help="Comma-separated numbers of bound ligands.")
+@click.option('--samples', 'no_samples', type=int, default=None, \
+    help="Sample this many forms instead of enumerating all.")
+def main_commandline(pdb_filepath, no_ligands, no_samples):
+    """ Lists symmetry-unique ligand-occupancy forms of a PDB structure.
+    """
+    if no_ligands is not None:
+        no_ligands = [int(value) for value in no_ligands.split(",")]
+    structure = read_structure(pdb_filepath)
+    forms = occupancy_forms(structure, no_ligands=no_ligands, no_samples=no_samples)
+    table = pd.DataFrame([{'pattern': "".join(map(str, form['pattern'].astype(int))), \
+        'no_ligands': int(form['pattern'].sum()), 'multiplicity': form['multiplicity'], \
+        'no_atoms': int(form['mask'].sum())} for form in forms])
+    click.echo(table.to_string(index=False))
+
+
+def binding_sites(structure):
+    """ Assigns HETATM records to binding sites (ligand residues, in order
+        of appearance). Returns site index of every atom (-1 for ATOM
+        records) and number of sites.
+    """
+    is_hetatm = structure.is_hetatm
+    site_idxs = np.full(len(structure), -1)
+    if not is_hetatm.any():
+        return site_idxs, 0
+
+    keys = pd.MultiIndex.from_arrays([structure[key][is_hetatm] for key in SITE_KEYS])
+    site_idxs[is_hetatm], sites = keys.factorize()
+
+    return site_idxs, sites.shape[0]
+
+def site_centres(structure, site_idxs, no_sites):
+    """ Geometric centres of binding sites. Returns (no_sites, 3) array.
+    """
+    is_site = site_idxs >= 0
+    coords = structure.coords[is_site].astype(float)
+    counts = np.bincount(site_idxs[is_site], minlength=no_sites)
+    centres = np.stack([np.bincount(site_idxs[is_site], weights=coords[:, axis], \
+        minlength=no_sites) for axis in range(3)], axis=1)
+
+    return centres / counts[:, None]
+
+def site_permutations(structure, site_idxs, no_sites, operators=None, \
+    tolerance=symmetry.DEFAULT_TOLERANCE):
+    """ Permutations of binding sites by the symmetry operators of the
+        assembly, given or inferred from its chains.
+    """
+    if operators is None:
+        operators = symmetry.chain_operators(structure, tolerance=tolerance)
+    permutations = symmetry.point_permutations(site_centres(structure, site_idxs, no_sites), \
+        operators, tolerance=tolerance)
+    if permutations.shape[0] == 0:
+        # No symmetry: identity only
+        permutations = np.arange(no_sites)[None, :]
+
+    return permutations
+
+def canonical_pattern(occupied, permutations):
+    """ Returns canonical representative (the smallest sorted tuple of
+        occupied sites) of the symmetry class of occupied sites and
+        the size of the class.
+    """
+    images = {tuple(sorted(permutation[list(occupied)])) for permutation in permutations}
+
+    return min(images), len(images)
+
+def occupancy_patterns(no_sites, permutations, no_ligands=None, no_samples=None, seed=0):
+    """ Lazily generates symmetry-unique occupancy patterns with numbers
+        of bound ligands in no_ligands (default: all). All patterns are
+        enumerated, or no_samples unique patterns are drawn at random
+        (for a random number of bound ligands). Yields (pattern, multiplicity),
+        pattern being a boolean array of occupied sites.
+    """
+    if no_ligands is None:
+        no_ligands = range(no_sites + 1)
+    no_ligands = [count for count in no_ligands if 0 <= count <= no_sites]
+
+    if no_samples is None:
+        for count in no_ligands:
+            for occupied in itertools.combinations(range(no_sites), count):
+                representative, multiplicity = canonical_pattern(occupied, permutations)
+                if representative == occupied:
+                    yield occupied_pattern(occupied, no_sites), multiplicity
+        return
+
+    rng = np.random.default_rng(seed)
+    seen = set()
+    # Give up if the sampled patterns are exhausted
+    for _ in range(10 * no_samples):
+        if len(seen) == no_samples:
+            break
+        count = rng.choice(no_ligands)
+        occupied = tuple(sorted(rng.choice(no_sites, size=count, replace=False)))
+        representative, multiplicity = canonical_pattern(occupied, permutations)
+        if representative in seen:
+            continue
+        seen.add(representative)
+        yield occupied_pattern(representative, no_sites), multiplicity
+
+def occupied_pattern(occupied, no_sites):
+    """ Boolean pattern of occupied sites.
+    """
+    pattern = np.zeros(no_sites, dtype=bool)
+    pattern[list(occupied)] = True
+
+    return pattern
+
+def occupancy_forms(structure, operators=None, no_ligands=None, no_samples=None, seed=0, \
+    tolerance=symmetry.DEFAULT_TOLERANCE):
+    """ Lazily generates symmetry-unique ligand-occupancy forms of
+        structure (see occupancy_patterns). Yields dictionaries with
+        occupancy pattern, multiplicity and atom mask of the form
+        (all ATOM records and HETATM records of occupied sites).
+    """
+    site_idxs, no_sites = binding_sites(structure)
+    permutations = site_permutations(structure, site_idxs, no_sites, operators=operators, \
+        tolerance=tolerance)
+    is_atom = site_idxs < 0
+
+    for pattern, multiplicity in occupancy_patterns(no_sites, permutations, \
+        no_ligands=no_ligands, no_samples=no_samples, seed=seed):
+        mask = is_atom.copy()
+        mask[~is_atom] = pattern[site_idxs[~is_atom]]
+        yield {'pattern': pattern, 'multiplicity': multiplicity, 'mask': mask}
+
+
+if __name__ == '__main__':
+    main_commandline()
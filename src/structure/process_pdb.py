@@ -5,10 +5,9 @@ from pathlib import Path
 from dotenv import find_dotenv, load_dotenv
 
 import os
-import pandas as pd
-from biopandas.pdb import PandasPdb
-from copy import deepcopy
+import numpy as np
 import src.utilities as utils
+from src.structure.structure import read_structure, cache_structure
 
 @click.command()
 @click.argument('input_dir', type=click.Path(exists=True))
@@ -21,12 +20,14 @@ def main_commandline(input_dir, output_dir):
     logger.info('making processed PDB forms from interim PDB structures')
     main(input_dir, output_dir)
 
-def main(input_dir, output_dir):
+def main(input_dir, output_dir, pdb_code=None, form_idxs=(0, 1, 2)):
     """ Proccesses interim PDB structures (from pdb/interim/) and creates PDB 
         structural forms for simulations (saved in pdb/processed/).
+        pdb_code defaults to the PDB ID in config.yaml.
     """
-    config = utils.read_config()
-    pdb_code = config['pdb']['id']
+    if pdb_code is None:
+        config = utils.read_config()
+        pdb_code = config['pdb']['id']
 
     # Data import
     pdb_struct = load_structure(pdb_code, input_dir, file_extension="pdb") 
@@ -36,53 +37,51 @@ def main(input_dir, output_dir):
     # pdb_struct.df['ATOM'] = pdb_struct.df['ATOM'][(pdb_struct.df['ATOM']['residue_number'] != 1) \
     #     & (pdb_struct.df['ATOM']['residue_number'] != 216)]
 
-    # Create structural forms
-    pdb_0 = create_form(pdb_struct, form_idx=0)
-    pdb_1 = create_form(pdb_struct, form_idx=1)
-    pdb_2 = create_form(pdb_struct, form_idx=2)
+    # Create and save structural forms
+    for form_idx in form_idxs:
+        pdb_form = create_form(pdb_struct, form_idx=form_idx)
+        save_structure(pdb_form, form_idx, output_dir)
 
-    # Save processed data
-    save_structure(pdb_0, 0, output_dir)
-    save_structure(pdb_1, 1, output_dir)
-    save_structure(pdb_2, 2, output_dir)
+    return None
 
 
 
 def load_structure(pdb_code, input_dir, file_extension="pdb"):
-    """ Loads PDB file inot BioPandas object.
+    """ Loads PDB file into array-backed structure
+        (through the parse cache, see structure.read_structure).
     """
     pdb_filepath = os.path.join(input_dir, "{}.{}".format(pdb_code, file_extension))
-    return PandasPdb().read_pdb(pdb_filepath)
+    return read_structure(pdb_filepath)
 
 def create_form(data, form_idx=0):
-    """ Creates PDB structure forms.
+    """ Creates PDB structure forms as views of the structure
+        (no atoms are copied).
         form_idx = 0 is apo; 1 - holo1; and 2 - holo2
-        Note: Only works for homodimers.
+        Note: Only works for homodimers, see occupancy.py for
+        assemblies with more binding sites.
     """
-    # Make a deep copy of BioPandas object to make changes
-    data_out = deepcopy(data)
-    
-    # If form_idx == 2 that's holo2 already
+    # Apo: delete all 'HETATM' records
+    is_kept = ~data.is_hetatm
+
     if form_idx == 1:
-        hetatm_record_len = data_out.df['HETATM'].shape[0]
-        # Keep only one ligand
-        data_out.df['HETATM'] = data_out.df['HETATM'][:int(hetatm_record_len/2)]
-        
-    elif form_idx == 0:
-        # Delete all 'HETATM' records
-        data_out.df['HETATM'] = pd.DataFrame(columns=data_out.df['HETATM'].columns)
+        # Keep only one ligand: the first half of 'HETATM' records
+        hetatm_idxs = np.flatnonzero(~is_kept)
+        is_kept[hetatm_idxs[:hetatm_idxs.shape[0] // 2]] = True
+
+    # If form_idx == 2 that's holo2 already
+    elif form_idx == 2:
+        is_kept[:] = True
 
-    return data_out
+    return data.view(is_kept)
 
 def save_structure(data, form_idx, output_dir):
-    """ Save BioPandas object as a PDB record file.
+    """ Save structure as a PDB record file (and its parse cache entry,
+        so that simulations open it without parsing).
     """
-    output_filename = "{}.pdb".format(form_idx)
+    output_filepath = os.path.join(output_dir, "{}.pdb".format(form_idx))
 
-    data.to_pdb(path=os.path.join(output_dir, output_filename),
-                    records=['ATOM', 'HETATM'],
-                    gz=False,
-                    append_newline=True)
+    data.write_pdb(output_filepath)
+    cache_structure(output_filepath)
             
 if __name__ == '__main__':
     log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+""" Array-backed container of ATOM and HETATM records.
+
+    Coordinates are an (N, 3) float32 array and per-atom fields are typed
+    NumPy arrays (fixed-width byte strings, integers and floats), in the
+    order of the PDB file. Substructures, e.g. structural forms, are views
+    that share the arrays of their parent and only hold atom indices.
+    Nothing is serialised until write_pdb or save is called.
+
+    Structures are saved as one memory-mappable NumPy record array (.npy),
+    which opens in milliseconds. read_structure keeps such binary copies
+    of parsed PDB files in a cache directory, so every PDB file is parsed
+    once: a cached copy is used as long as the size and modification time
+    of the file, or else its content hash, are unchanged. The cache is
+    configured in config.yaml (pdb.parseCacheDir, pdb.parseCacheMaxSizeGB)
+    and least recently used copies are evicted beyond its size limit.
+"""
+import os
+import gzip
+import json
+import hashlib
+import tempfile
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+import src.utilities as utils
+
+# Binary format version, part of the cache key;
+# bump it whenever FIELDS or the parser change
+FORMAT_VERSION = "1"
+
+# Per-atom fields and their types
+FIELDS = {'record_name': 'S6', 'atom_number': np.int32, 'atom_name': 'S4',
+          'alt_loc': 'S1', 'residue_name': 'S3', 'chain_id': 'S1',
+          'residue_number': np.int32, 'insertion': 'S1', 'occupancy': np.float32,
+          'b_factor': np.float32, 'segment_id': 'S4', 'element_symbol': 'S2',
+          'charge': 'S2', 'model_number': np.int32}
+
+# Columns (start, stop) of the fields in fixed-width PDB records
+COLUMNS = {'record_name': (0, 6), 'atom_number': (6, 11), 'atom_name': (12, 16),
+           'alt_loc': (16, 17), 'residue_name': (17, 20), 'chain_id': (21, 22),
+           'residue_number': (22, 26), 'insertion': (26, 27), 'x_coord': (30, 38),
+           'y_coord': (38, 46), 'z_coord': (46, 54), 'occupancy': (54, 60),
+           'b_factor': (60, 66), 'segment_id': (72, 76), 'element_symbol': (76, 78),
+           'charge': (78, 80)}
+
+
+class Structure:
+    """ ATOM and HETATM records of a PDB structure, or a view of
+        a subset of the atoms of another structure.
+    """
+
+    def __init__(self, coords, fields, idxs=None):
+        """ coords is an (N, 3) array and fields a dictionary of per-atom
+            arrays (see FIELDS); idxs selects the atoms of a view.
+        """
+        self._coords = np.asarray(coords, dtype=np.float32)
+        self._fields = {name: np.asarray(fields[name], dtype=dtype) \
+            for name, dtype in FIELDS.items()}
+        self.idxs = idxs
+
+    def __len__(self):
+        return self._coords.shape[0] if self.idxs is None else self.idxs.shape[0]
+
+    def __getitem__(self, name):
+        """ Per-atom field array (copy for views).
+        """
+        return self._select(self._fields[name])
+
+    @property
+    def coords(self):
+        """ Coordinates (N, 3) array (copy for views).
+        """
+        return self._select(self._coords)
+
+    @property
+    def is_hetatm(self):
+        return self['record_name'] == b"HETATM"
+
+    def _select(self, array):
+        return array if self.idxs is None else array[self.idxs]
+
+    def view(self, selection):
+        """ Returns view of atoms selected by boolean mask or indices
+            (into this structure), sharing the arrays of this structure.
+        """
+        selection = np.asarray(selection)
+        if selection.dtype == bool:
+            selection = np.flatnonzero(selection)
+        if self.idxs is not None:
+            selection = self.idxs[selection]
+
+        view = Structure.__new__(Structure)
+        view._coords = self._coords
+        view._fields = self._fields
+        view.idxs = selection
+
+        return view
+
+    def with_fields(self, **fields):
+        """ Returns new structure of the atoms of this structure (copied)
+            with the given fields replaced by per-atom arrays.
+        """
+        return Structure(self.coords, {name: fields.get(name, self[name]) for name in FIELDS})
+
+    def to_frame(self):
+        """ Returns atoms as DataFrame with the columns of BioPandas
+            ATOM/HETATM records (strings decoded).
+        """
+        frame = pd.DataFrame({name: np.char.decode(self[name], 'ascii') \
+            if isinstance(dtype, str) else self[name] for name, dtype in FIELDS.items()})
+        # PDB coordinates have 3 decimals: rounding recovers the float64
+        # values of the text (float32 error is far below 0.0005)
+        frame[['x_coord', 'y_coord', 'z_coord']] = self.coords.astype(float).round(3)
+
+        return frame
+
+    def pdb_lines(self):
+        """ Formats atoms as fixed-width PDB records.
+        """
+        fields = {name: self[name] for name in FIELDS}
+        for name, dtype in FIELDS.items():
+            if isinstance(dtype, str):
+                fields[name] = np.char.decode(fields[name], 'ascii')
+        coords = self.coords
+
+        lines = []
+        for idx in range(len(self)):
+            atom_name = fields['atom_name'][idx]
+            if len(atom_name) < 4:
+                atom_name = " " + atom_name
+            lines.append(("{:6s}{:>5d} {:4s}{:1s}{:>3s} {:1s}{:>4d}{:1s}   {:8.3f}{:8.3f}"
+                          "{:8.3f}{:6.2f}{:6.2f}      {:4s}{:>2s}{:2s}").format(
+                fields['record_name'][idx], fields['atom_number'][idx], atom_name,
+                fields['alt_loc'][idx], fields['residue_name'][idx], fields['chain_id'][idx],
+                fields['residue_number'][idx], fields['insertion'][idx], *coords[idx],
+                fields['occupancy'][idx], fields['b_factor'][idx], fields['segment_id'][idx],
+                fields['element_symbol'][idx], fields['charge'][idx]).ljust(80))
+
+        return lines
+
+    def write_pdb(self, filepath):
+        """ Writes atoms as PDB file of ATOM and HETATM records.
+        """
+        with open(filepath, 'w') as file:
+            file.write("\n".join(self.pdb_lines()) + "\n")
+
+        return None
+
+    def save(self, filepath):
+        """ Saves atoms as NumPy record array (.npy), written atomically.
+        """
+        records = np.empty(len(self), dtype=record_dtype())
+        records['coords'] = self.coords
+        for name in FIELDS:
+            records[name] = self[name]
+
+        output_dir = os.path.dirname(filepath) or "."
+        os.makedirs(output_dir, exist_ok=True)
+        file_descriptor, tmp_path = tempfile.mkstemp(dir=output_dir, suffix=".tmp")
+        try:
+            with os.fdopen(file_descriptor, 'wb') as file:
+                np.save(file, records)
+            os.replace(tmp_path, filepath)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        return None
+
+    @classmethod
+    def load(cls, filepath, mmap=True):
+        """ Loads structure saved by save, memory-mapped (read-only)
+            unless mmap is False.
+        """
+        records = np.load(filepath, mmap_mode='r' if mmap else None)
+
+        return cls(records['coords'], {name: records[name] for name in FIELDS})
+
+    @classmethod
+    def read_pdb(cls, filepath):
+        """ Reads ATOM and HETATM records of PDB file (any extension,
+            gzipped if .gz), see parse_pdb.
+        """
+        opener = gzip.open if filepath.endswith(".gz") else open
+        with opener(filepath, 'rb') as file:
+            return parse_pdb(file.read())
+
+
+def record_dtype():
+    """ NumPy record type of saved structures.
+    """
+    return np.dtype([('coords', np.float32, (3,))] + \
+        [(name, dtype) for name, dtype in FIELDS.items()])
+
+def parse_pdb(data):
+    """ Parses ATOM and HETATM records of PDB file contents (bytes) into
+        a structure. Records are cut into fixed-width columns of one
+        character matrix, so fields are decoded in bulk, not line by line.
+        Models are numbered by MODEL records (0 if there are none).
+    """
+    lines = np.array(data.splitlines(), dtype='S80')
+    record_names = lines.astype('S6')
+    model_numbers = np.cumsum(record_names == b"MODEL ")
+    is_atom = (record_names == b"ATOM  ") | (record_names == b"HETATM")
+
+    # Lines shorter than 80 characters are padded with blanks
+    matrix = lines[is_atom].view(np.uint8).reshape(-1, 80).copy()
+    matrix[matrix == 0] = ord(" ")
+
+    def column(name):
+        start, stop = COLUMNS[name]
+        strings = np.ascontiguousarray(matrix[:, start:stop]).view( \
+            "S{}".format(stop - start)).ravel()
+        return np.char.strip(strings)
+
+    def number_column(name, dtype):
+        strings = column(name)
+        # Blank numbers are read as 0
+        strings[strings == b""] = b"0"
+        return strings.astype(dtype)
+
+    coords = np.stack([number_column(axis, np.float32) \
+        for axis in ['x_coord', 'y_coord', 'z_coord']], axis=1)
+    fields = {'model_number': model_numbers[is_atom]}
+    for name, dtype in FIELDS.items():
+        if name in COLUMNS:
+            fields[name] = column(name) if isinstance(dtype, str) \
+                else number_column(name, dtype)
+
+    return Structure(coords, fields)
+
+def read_structure(filepath, cache_dir=None, max_size=None):
+    """ Reads structure of PDB file through the parse cache in cache_dir
+        (see cache_structure). The cached binary copy is used if the size
+        and modification time, or else the content hash, of the file are
+        those it was cached with; the file is parsed (and cached) otherwise.
+        The structure is memory-mapped from the cache.
+    """
+    cache_dir, max_size = cache_options(cache_dir, max_size)
+    if cache_dir is None:
+        return Structure.read_pdb(filepath)
+
+    index_path = cache_index_path(filepath, cache_dir)
+    stat = os.stat(filepath)
+    try:
+        with open(index_path) as file:
+            index = json.load(file)
+    except (FileNotFoundError, ValueError):
+        index = None
+
+    if index is not None:
+        entry_path = cache_entry_path(index['sha256'], cache_dir)
+        if os.path.isfile(entry_path):
+            if [index['size'], index['mtime_ns']] == [stat.st_size, stat.st_mtime_ns] or \
+                file_digest(filepath) == index['sha256']:
+                if index['mtime_ns'] != stat.st_mtime_ns:
+                    # Touched but unchanged: revalidate the index
+                    write_cache_index(index_path, index['sha256'], stat)
+                try:
+                    # Mark as recently used
+                    os.utime(entry_path)
+                    return Structure.load(entry_path)
+                except (FileNotFoundError, ValueError):
+                    # Evicted concurrently or partially written
+                    pass
+
+    return Structure.load(cache_structure(filepath, cache_dir=cache_dir, max_size=max_size, \
+        stat=stat))
+
+def cache_structure(filepath, cache_dir=None, max_size=None, stat=None):
+    """ Parses PDB file (gzipped if .gz) into the parse cache, e.g. right
+        after writing it. Binary copies are addressed by the content hash
+        of the file and indexed by its path, size and modification time
+        (stat, taken before the file is read). Least recently used copies
+        are evicted if the cache grows beyond max_size (bytes).
+        cache_dir and max_size default to config.yaml (see cache_options).
+        Returns path of the binary copy (None if there is no cache).
+    """
+    cache_dir, max_size = cache_options(cache_dir, max_size)
+    if cache_dir is None:
+        return None
+    if stat is None:
+        stat = os.stat(filepath)
+
+    with open(filepath, 'rb') as file:
+        data = file.read()
+    digest = hashlib.sha256(FORMAT_VERSION.encode())
+    digest.update(data)
+    digest = digest.hexdigest()
+
+    entry_path = cache_entry_path(digest, cache_dir)
+    if not os.path.isfile(entry_path):
+        if filepath.endswith(".gz"):
+            data = gzip.decompress(data)
+        parse_pdb(data).save(entry_path)
+        if max_size is not None:
+            prune_cache(cache_dir, max_size)
+    write_cache_index(cache_index_path(filepath, cache_dir), digest, stat)
+
+    return entry_path
+
+def cache_options(cache_dir=None, max_size=None):
+    """ Returns parse cache directory and size limit (bytes). If cache_dir
+        is not given, both are taken from config.yaml (pdb.parseCacheDir,
+        pdb.parseCacheMaxSizeGB); there is no cache without config.yaml.
+    """
+    if cache_dir is not None:
+        return cache_dir, max_size
+
+    return configured_cache()
+
+@lru_cache(maxsize=None)
+def configured_cache():
+    """ Reads parse cache settings from config.yaml once per process.
+    """
+    try:
+        config = utils.read_config()
+    except FileNotFoundError:
+        return None, None
+    cache_dir = config['pdb'].get('parseCacheDir')
+    max_size = config['pdb'].get('parseCacheMaxSizeGB')
+    if max_size is not None:
+        max_size = max_size * 1e9
+
+    return cache_dir, max_size
+
+def prune_cache(cache_dir, max_size):
+    """ Evicts least recently used binary copies until the parse cache
+        is at most max_size bytes. Returns number of removed copies.
+    """
+    entries = []
+    for root, _, filenames in os.walk(cache_dir):
+        for filename in filenames:
+            if filename.endswith(".npy"):
+                try:
+                    stat = os.stat(os.path.join(root, filename))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(root, filename)))
+
+    # Sizes remaining from the most recently used copy down
+    entries.sort(reverse=True)
+    kept_size = np.cumsum([size for _, size, _ in entries])
+    no_removed = 0
+    for (_, _, path), size in zip(entries, kept_size):
+        if size > max_size:
+            try:
+                os.remove(path)
+                no_removed += 1
+            except FileNotFoundError:
+                pass
+
+    return no_removed
+
+def cache_entry_path(digest, cache_dir):
+    """ Path of binary copy of PDB file with content hash digest.
+    """
+    return os.path.join(cache_dir, digest[:2], "{}.npy".format(digest))
+
+def cache_index_path(filepath, cache_dir):
+    """ Path of index record of PDB file (keyed by absolute path).
+    """
+    key = hashlib.sha256(os.path.abspath(filepath).encode()).hexdigest()
+
+    return os.path.join(cache_dir, "index", "{}.json".format(key))
+
+def write_cache_index(index_path, digest, stat):
+    """ Writes index record atomically.
+    """
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    file_descriptor, tmp_path = tempfile.mkstemp(dir=os.path.dirname(index_path), suffix=".tmp")
+    with os.fdopen(file_descriptor, 'w') as file:
+        json.dump({'sha256': digest, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}, file)
+    os.replace(tmp_path, index_path)
+
+    return None
+
+def file_digest(filepath):
+    """ SHA-256 of file contents and the binary format version.
+    """
+    digest = hashlib.sha256(FORMAT_VERSION.encode())
+    with open(filepath, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
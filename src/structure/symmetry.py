@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+""" Symmetry operators of homo-oligomeric assemblies.
+
+    An operator is a (rotation, translation) pair acting on coordinates
+    as coords @ rotation.T + translation. Operators of an assembly are
+    inferred by superposing its first chain on every chain (carbon
+    alphas) and keeping superpositions that map the whole assembly
+    onto itself, or read from the BIOMT records (REMARK 350) of a
+    biological assembly file.
+"""
+import gzip
+import numpy as np
+from scipy.spatial import cKDTree
+from src.structure.structure import read_structure
+
+# Largest RMSD (angstroms) of symmetry-equivalent carbon alphas
+DEFAULT_TOLERANCE = 1.0
+
+
+def superpose(coords, target_coords):
+    """ Least-squares superposition (Kabsch) of coords on target_coords.
+        Returns operator (rotation, translation).
+    """
+    centre = coords.mean(axis=0)
+    target_centre = target_coords.mean(axis=0)
+    covariance = (coords - centre).T @ (target_coords - target_centre)
+    u, _, vt = np.linalg.svd(covariance)
+    # Proper rotation (no reflection)
+    sign = np.sign(np.linalg.det(u @ vt))
+    rotation = (u @ np.diag([1.0, 1.0, sign]) @ vt).T
+
+    return rotation, target_centre - centre @ rotation.T
+
+def apply_operator(operator, coords):
+    """ Applies operator (rotation, translation) to coordinates.
+    """
+    rotation, translation = operator
+
+    return coords @ rotation.T + translation
+
+def chain_operators(structure, tolerance=DEFAULT_TOLERANCE):
+    """ Infers symmetry operators of homo-oligomeric structure (see
+        structure.Structure) from its carbon alphas: the superposition
+        of the first chain (segment and chain ID) on every chain of the
+        same sequence that maps all carbon alphas onto carbon alphas
+        within tolerance (RMSD).
+        The first operator is the identity.
+    """
+    is_ca = ~structure.is_hetatm & (structure['atom_name'] == b"CA")
+    ca_coords = structure.coords[is_ca].astype(float)
+    # Chains of large assemblies are told apart by segment ID (copy),
+    # see transform_pdb.rename_chains
+    chain_ids = np.char.add(structure['segment_id'][is_ca], structure['chain_id'][is_ca])
+    residue_names = structure['residue_name'][is_ca]
+
+    chains = list(dict.fromkeys(chain_ids))
+    first_chain = chain_ids == chains[0]
+    tree = cKDTree(ca_coords)
+
+    operators = []
+    for chain in chains:
+        is_chain = chain_ids == chain
+        if is_chain.sum() != first_chain.sum() or \
+            np.any(residue_names[is_chain] != residue_names[first_chain]):
+            continue
+        operator = superpose(ca_coords[first_chain], ca_coords[is_chain])
+        distances, _ = tree.query(apply_operator(operator, ca_coords))
+        if np.sqrt(np.mean(distances ** 2)) <= tolerance:
+            operators.append(operator)
+
+    return operators
+
+def point_permutations(points, operators, tolerance=DEFAULT_TOLERANCE):
+    """ Permutations of points (e.g. binding site centres) by symmetry
+        operators: row g maps point i onto point permutations[g, i].
+        Operators that do not map the points onto themselves (within
+        tolerance) are skipped. Returns (no_operators, no_points) array.
+    """
+    tree = cKDTree(points)
+    permutations = []
+    for operator in operators:
+        distances, idxs = tree.query(apply_operator(operator, points))
+        if np.all(distances <= tolerance) and np.unique(idxs).shape[0] == idxs.shape[0]:
+            permutations.append(idxs)
+
+    return np.array(permutations, dtype=int).reshape(-1, points.shape[0])
+
+def read_biomt(filepath):
+    """ Reads operators of the first biomolecule in the BIOMT records
+        (REMARK 350) of PDB file (gzipped if .gz).
+        Returns list of operators, empty if there are no BIOMT records.
+    """
+    opener = gzip.open if filepath.endswith(".gz") else open
+    rows = {}
+    no_biomolecules = 0
+    with opener(filepath, 'rt') as file:
+        for line in file:
+            if not line.startswith("REMARK 350"):
+                continue
+            if "BIOMOLECULE:" in line:
+                no_biomolecules += 1
+                if no_biomolecules > 1:
+                    break
+            # REMARK 350   BIOMTn   k  r_n1 r_n2 r_n3  t_n
+            tokens = line.split()
+            if len(tokens) == 8 and tokens[2].startswith("BIOMT"):
+                rows.setdefault(int(tokens[3]), []).append([float(value) \
+                    for value in tokens[4:8]])
+
+    operators = []
+    for operator_rows in rows.values():
+        matrix = np.array(operator_rows[:3])
+        operators.append((matrix[:, :3], matrix[:, 3]))
+
+    return operators
+
+def pdb_operators(pdb_filepath, tolerance=DEFAULT_TOLERANCE):
+    """ Symmetry operators of the assembly in PDB file: its BIOMT
+        records if it has any (e.g. pdb/raw/*.pdb1), else inferred
+        from its chains (e.g. processed forms, see chain_operators).
+    """
+    operators = read_biomt(pdb_filepath)
+    if operators:
+        return operators
+
+    return chain_operators(read_structure(pdb_filepath), tolerance=tolerance)
@@ -5,10 +5,16 @@ from pathlib import Path
 from dotenv import find_dotenv, load_dotenv
 
 import os
+import string
+import numpy as np
 import pandas as pd
-from biopandas.pdb import PandasPdb
-from copy import deepcopy
 import src.utilities as utils
+from src.structure.structure import read_structure, cache_structure
+
+# Single-character chain labels of PDB files
+CHAIN_LABELS = list(string.ascii_uppercase + string.ascii_lowercase + string.digits)
+# Copy numbers fitting the four-character segment ID
+MAX_SEGMENT_COPIES = 9999
 
 @click.command()
 @click.argument('input_dir', type=click.Path(exists=True))
@@ -21,33 +27,21 @@ def main_commandline(input_dir, output_dir):
     logger.info('process raw PDB structure')
     main(input_dir, output_dir)
 
-def main(input_dir, output_dir):
+def main(input_dir, output_dir, pdb_code=None):
     """ Make interim PDB structures (from pdb/raw/) 
         for final processing (saved in pdb/processed/).
+        pdb_code defaults to the PDB ID in config.yaml.
     """
     config = utils.read_config()
-    pdb_code = config['pdb']['id']
+    if pdb_code is None:
+        pdb_code = config['pdb']['id']
 
     # Data import
     pdb_struct = load_structure(pdb_code, input_dir, file_extension="pdb1")                    
 
-    # Data processing
-    pdb_models = get_models(pdb_struct)
-
-    # Remove water
-    pdb_struct.df['HETATM'] = pdb_struct.df['HETATM'][pdb_struct.df['HETATM']['residue_name'] != 'HOH']
-    # Remove HEZ
-    pdb_struct.df['HETATM'] = pdb_struct.df['HETATM'][pdb_struct.df['HETATM']['residue_name'] != 'HEZ']
-
-    # Select A form
-    pdb_struct.df['ATOM'] = pdb_struct.df['ATOM'][pdb_struct.df['ATOM']['residue_name'] != 'BGLU']
-    pdb_struct.df['ATOM']['occupancy'] = 1.00
-    
-    # Rename chains
-    pdb_struct.df['ATOM']['chain_id'] = rename_chains(pdb_struct.df['ATOM']['chain_id'], \
-        no_protomers=pdb_models)
-    pdb_struct.df['HETATM']['chain_id'] = rename_chains(pdb_struct.df['HETATM']['chain_id'], \
-        no_protomers=pdb_models)
+    # Data processing: remove waters and additives, select A form
+    # and rename chains of all protomers
+    pdb_struct = clean_structure(pdb_struct, config['cleanup'])
 
     # Save data
     save_structure(pdb_struct, pdb_code, output_dir)
@@ -55,47 +49,65 @@ def main(input_dir, output_dir):
     return None
 
 def load_structure(pdb_code, input_dir, file_extension="pdb"):
-    """ Loads PDB file inot BioPandas object.
+    """ Loads PDB file into array-backed structure (see structure.py).
     """
     pdb_filepath = os.path.join(input_dir, "{}.{}".format(pdb_code, file_extension))
-
-    return PandasPdb().read_pdb(pdb_filepath)
-
-def get_models(data):
-    """ Extracts number of MODEL records from BioPandas object.
+    return read_structure(pdb_filepath)
+
+def clean_structure(data, rules):
+    """ Applies cleanup rules (see config.yaml) to ATOM and HETATM records
+        of structure in one boolean mask pass: removes excluded residues
+        and chains and alternate locations not kept, resets occupancies
+        of ATOM records (if resetOccupancy) and renames chains of all
+        protomers (see rename_chains). Returns cleaned structure.
     """
-    return data.df['OTHERS'][data.df['OTHERS']['record_name'] == 'MODEL'].shape[0]
-
-def rename_chains(data, no_protomers=2):
-    """ Standartizes chain ID labels for homo-multi-mers.
-        Note: all chains must be of the equal length. 
+    def decoded(name):
+        return np.char.decode(data[name], 'ascii')
+
+    mask = ~np.isin(decoded('residue_name'), rules['excludeResidues']) \
+        & np.isin(decoded('alt_loc'), rules['keepAltlocs']) \
+        & ~np.isin(decoded('chain_id'), rules['excludeChains'])
+    data = data.view(mask)
+
+    occupancy = data['occupancy']
+    if rules['resetOccupancy']:
+        occupancy = np.where(data.is_hetatm, occupancy, 1.00)
+
+    chain_labels, segment_ids = rename_chains(data['chain_id'], data['model_number'], \
+        data['segment_id'])
+
+    return data.with_fields(chain_id=chain_labels, segment_id=segment_ids, \
+        occupancy=occupancy)
+
+def rename_chains(chain_ids, model_ids, segment_ids):
+    """ Standartizes chain ID labels for homo-multi-mers: every chain of
+        every model (protomer of a biological assembly) gets its own
+        label, A-Z, a-z and then 0-9, in order of appearance.
+        Assemblies with more chains than labels, e.g. capsids of 60
+        multi-chain protomers, keep a label per chain of the protomer
+        and carry the copy (model) number, from 1, as segment ID.
+        Returns arrays of chain labels and segment IDs.
     """
-    chain_id_labels = ['A', 'B', 'C', 'D', 'E', 'F']
-
-    unique_chain_ids = data.unique()
+    protomer_idxs, protomers = pd.MultiIndex.from_arrays([model_ids, chain_ids]).factorize()
+    if protomers.shape[0] <= len(CHAIN_LABELS):
+        return np.array(CHAIN_LABELS)[protomer_idxs], segment_ids
 
-    if no_protomers == 1 and unique_chain_ids[0] == "A":
-        pass
+    chain_idxs, chains = pd.factorize(chain_ids)
+    copy_idxs, copies = pd.factorize(model_ids)
+    if chains.shape[0] > len(CHAIN_LABELS) or copies.shape[0] > MAX_SEGMENT_COPIES:
+        raise ValueError("{} chains in {} copies exceed the PDB chain and segment " \
+            "labels".format(chains.shape[0], copies.shape[0]))
+    segment_ids = np.char.encode((copy_idxs + 1).astype(str), 'ascii')
 
-    else:
-        atoms_per_protomer = data.shape[0] / no_protomers
-        
-        for protomer_id in range(no_protomers):
-            slice_start = int(protomer_id * atoms_per_protomer)
-            slice_end = int((protomer_id + 1) * atoms_per_protomer + 1)
-            data.iloc[slice_start:slice_end] = chain_id_labels[protomer_id]
-    
-    return data
+    return np.array(CHAIN_LABELS)[chain_idxs], segment_ids
 
 def save_structure(data, pdb_code, output_dir):
-    """ Save BioPandas object as a PDB record file.
+    """ Save structure as a PDB record file (and its parse cache entry).
     """
-    output_filename = "{}.pdb".format(pdb_code)
+    output_filepath = os.path.join(output_dir, "{}.pdb".format(pdb_code))
 
-    data.to_pdb(path=os.path.join(output_dir, output_filename),
-                    records=['ATOM', 'HETATM'],
-                    gz=False,
-                    append_newline=True)
+    data.write_pdb(output_filepath)
+    cache_structure(output_filepath)
 
     return None
             
@@ -13,4 +13,22 @@ def read_config():
         # Convert list into dict
         config_dict = {key: value for dict in config_list for key, value in dict.items()}
     return config_dict
+
+def pdb_codes(config):
+    # PDB IDs of batch runs (ID list or file) or the single PDB ID
+    id_list = config['pdb']['idList']
+    if id_list is None:
+        return [config['pdb']['id']]
+    if isinstance(id_list, str):
+        return read_pdb_codes(id_list)
+    return [str(pdb_code) for pdb_code in id_list]
+
+def read_pdb_codes(filepath):
+    # Read PDB IDs separated by whitespace or commas; '#' starts a comment
+    pdb_codes = []
+    with open(filepath) as file:
+        for line in file:
+            line = line.split("#")[0].replace(",", " ")
+            pdb_codes += [pdb_code for pdb_code in line.split() if pdb_code not in pdb_codes]
+    return pdb_codes
     
\ No newline at end of file
@@ -14,6 +14,7 @@ import seaborn as sns
 import numpy as np
 from pymol import cmd
 import src.utilities as utils
+import src.instrument as instr
 from src.visualization.modevectors import modevectors
 import src.visualization.viz_1point as viz_1point
 
@@ -32,19 +33,20 @@ def main_commandline(input_dir, output_dir):
     
 ###################################################################################
 
+@instr.traced()
 def main(input_dir, output_dir):
     """ Runs data visualization scripts to turn processed data (from data/processed)
         into plots (saved in scratch/).
     """
     config = utils.read_config()
-    pdb_codes = config['pdb']['codeList']
 
     mpl.rcParams.update(mpl.rcParamsDefault)  # VS Code plots not black
     plt.style.use(config['viz']['jupyter'])
 
     # Get paths
     # Directory path example: "data/processed/-c09.50/-mass-ca-het/0"
-    cutoff_paths = sorted(glob.glob(join_paths(input_dir, "*"), recursive=True))
+    cutoff_paths = sorted(path for path in glob.glob(join_paths(input_dir, "*")) \
+        if os.path.isdir(path))
 
     # Plot parameters
     eigenvals_ylims = [-350, -100]
@@ -121,7 +123,8 @@ def main(input_dir, output_dir):
 
         fig1.tight_layout(w_pad=1)
         
-        plt.savefig(join_paths(output_dir, figure_path), bbox_inches='tight')
+        with instr.stage("visualize.savefig", cutoff=cutoff_flag):
+            plt.savefig(join_paths(output_dir, figure_path), bbox_inches='tight')
         plt.close(fig1)
 
     